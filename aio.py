@@ -0,0 +1,69 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+
+class EventLoopThread:
+    """
+    Цикл событий asyncio в отдельном потоке. Сетевые запросы выполняются в нем
+    сопрограммами, поэтому сотни одновременных запросов не требуют потоков.
+    Блокирующая работа (SQLAlchemy, отправка в telegram) выносится в небольшой
+    пул потоков через offload. Цикл запускается при первой задаче
+    """
+
+    def __init__(self, name: str, workers: int, logger: logging.Logger) -> None:
+        self.name = name
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='{}_offload'.format(name))
+        self._thread = None  # type: Optional[threading.Thread]
+        self._lock = threading.Lock()
+
+    def submit(self, coro: Awaitable) -> concurrent.futures.Future:
+        """Запускает сопрограмму в цикле из любого потока"""
+        self._start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, coro: Awaitable, timeout: Optional[float] = None) -> Any:
+        """Выполняет сопрограмму и ждет результат в вызывающем потоке"""
+        return self.submit(coro).result(timeout)
+
+    async def offload(self, fn: Callable, *args, **kwargs) -> Any:
+        """Выполняет блокирующую функцию в пуле потоков, не останавливая цикл"""
+        return await self.loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    def stop(self) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            thread.join()
+        self.executor.shutdown(wait=True)
+        if not self.loop.is_closed():
+            self.loop.close()
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            if self.loop.is_closed():
+                raise RuntimeError('Event loop {} is stopped'.format(self.name))
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            # Незавершенные задачи отменяются, чтобы цикл можно было закрыть
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
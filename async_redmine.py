@@ -0,0 +1,148 @@
+import asyncio
+import datetime as dt
+import functools
+import json
+from typing import TYPE_CHECKING, Dict, List, Optional
+from urllib.parse import urlparse
+
+from breaker import CircuitBreaker
+from redmine_pool import RedmineCall
+
+if TYPE_CHECKING:
+    import aiohttp
+
+# Столько записей python-redmine запрашивает за одну страницу
+PAGE_SIZE = 100
+
+
+@functools.lru_cache(maxsize=None)
+def network_errors() -> tuple:
+    """Ошибки aiohttp, которые значат, что redmine не ответил"""
+    import aiohttp
+    return aiohttp.ClientError, asyncio.TimeoutError
+
+
+def _encode(value):
+    if isinstance(value, (dt.date, dt.datetime)):
+        return value.isoformat()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def _process_response(status: int, body: bytes):
+    """Разбор ответа и исключения как в python-redmine"""
+    from redminelib import exceptions
+
+    if status in (200, 201, 204):
+        return json.loads(body.decode('utf-8')) if body.strip() else True
+    if status == 401:
+        raise exceptions.AuthError
+    if status == 403:
+        raise exceptions.ForbiddenError
+    if status == 404:
+        raise exceptions.ResourceNotFoundError
+    if status == 409:
+        raise exceptions.ConflictError
+    if status == 412:
+        raise exceptions.ImpersonateError
+    if status == 413:
+        raise exceptions.RequestEntityTooLargeError
+    if status == 422:
+        errors = json.loads(body.decode('utf-8'))['errors']
+        raise exceptions.ValidationError(', '.join(': '.join(e) if isinstance(e, list) else e
+                                                   for e in errors))
+    raise exceptions.UnknownError(status)
+
+
+class AsyncRedmine:
+    """
+    Неблокирующий клиент REST API redmine для запросов бота: текущий пользователь,
+    назначенные задачи, поиск и создание time_entries. Работает на aiohttp в цикле
+    событий EventLoopThread и держит до pool_size keep-alive соединений.
+    Размыкатель цепи и метрики общие с RedmineClients, а ошибки - те же исключения
+    python-redmine и RedmineUnavailable, поэтому вызывающий код не различает клиентов
+    """
+
+    def __init__(self, url: str, pool_size: int, connect_timeout: float,
+                 read_timeout: float, breaker: CircuitBreaker) -> None:
+        self.url = url.rstrip('/')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breaker = breaker
+
+        # Создается в цикле событий при первом запросе
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+
+    async def auth(self, key: str, timeout: Optional[float] = None) -> dict:
+        return (await self.request('GET', '/users/current.json', key, timeout=timeout))['user']
+
+    async def assigned_issues(self, key: str, timeout: Optional[float] = None) -> Dict[int, str]:
+        """Открытые задачи владельца ключа, как redmine.auth().issues"""
+        user = await self.auth(key, timeout)
+        issues = await self.all('/issues.json', 'issues', key, {'assigned_to_id': user['id']},
+                                timeout)
+        return {issue['id']: issue['subject'] for issue in issues}
+
+    async def time_entries(self, key: str, params: dict,
+                           timeout: Optional[float] = None) -> List[dict]:
+        return await self.all('/time_entries.json', 'time_entries', key, params, timeout)
+
+    async def create_time_entry(self, key: str, timeout: Optional[float] = None,
+                                **fields) -> dict:
+        response = await self.request('POST', '/time_entries.json', key,
+                                      data={'time_entry': fields}, timeout=timeout)
+        return response['time_entry']
+
+    async def all(self, path: str, container: str, key: str, params: dict,
+                  timeout: Optional[float] = None) -> List[dict]:
+        """Все страницы списка. Страницы после первой запрашиваются одновременно"""
+        first = await self.request('GET', path, key, dict(params, limit=PAGE_SIZE, offset=0),
+                                   timeout=timeout)
+        items = first[container]
+        total = first.get('total_count')
+        if total is None or total <= PAGE_SIZE:
+            return items
+
+        pages = await asyncio.gather(*(
+            self.request('GET', path, key, dict(params, limit=PAGE_SIZE, offset=offset),
+                         timeout=timeout)
+            for offset in range(PAGE_SIZE, total, PAGE_SIZE)))
+        for page in pages:
+            items.extend(page[container])
+        return items
+
+    async def request(self, method: str, path: str, key: str, params: Optional[dict] = None,
+                      data: Optional[dict] = None, timeout: Optional[float] = None):
+        import aiohttp
+
+        session = self._get_session()
+        url = self.url + path
+        # Повторная отправка после обрыва переиспользованного соединения остается aiohttp:
+        # он повторяет только идемпотентные запросы, поэтому POST не задвоит время в redmine
+        with RedmineCall(self.breaker, method, urlparse(url).path, network_errors()) as call:
+            async with session.request(
+                    method, url,
+                    headers={'X-Redmine-API-Key': key},
+                    params={name: str(value) for name, value in (params or {}).items()},
+                    json=data,
+                    timeout=aiohttp.ClientTimeout(connect=self.connect_timeout,
+                                                  sock_read=timeout or self.read_timeout)) \
+                    as response:
+                body = await response.read()
+        call.check(response.status)
+        return _process_response(response.status, body)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        import aiohttp
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                headers={'Accept': 'application/json'},
+                json_serialize=functools.partial(json.dumps, default=_encode))
+        return self._session
@@ -0,0 +1,137 @@
+import datetime as dt
+import logging
+import threading
+from typing import Optional, Tuple
+
+from sqlalchemy.engine import Engine
+
+import db
+from redmine_pool import RedmineClients, RedmineUnavailable
+
+
+class TimeEntryBackfill:
+    """
+    Фоновая загрузка time_entries пользователей из redmine в таблицу time_entry,
+    в том числе записей, сделанных не через бота. Записи каждого пользователя
+    забираются страницами по возрастанию spent_on начиная с его отметки, поэтому
+    прерванная загрузка продолжается с того же места. Последние overlap_days дней
+    перед отметкой перечитываются: в redmine время часто трекают задним числом
+    """
+
+    WATERMARK = 'time_entry_backfill:{}'
+
+    def __init__(self, engine: Engine, redmine_clients: RedmineClients,
+                 redmine_host: str, logger: logging.Logger, interval: float = 3600,
+                 page_size: int = 100, overlap_days: int = 7, batch_size: int = 100,
+                 shard: Optional[Tuple[int, int]] = None) -> None:
+        self.engine = engine
+        self.redmine_clients = redmine_clients
+        self.redmine_host = redmine_host
+        self.logger = logger
+        self.interval = interval
+        self.page_size = page_size
+        self.overlap = dt.timedelta(days=overlap_days)
+        self.batch_size = batch_size
+        self.shard = shard
+
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='time_entry_backfill', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def backfill_all(self) -> int:
+        """Проходит всех пользователей пачками по batch_size, возвращает число новых записей"""
+        from redminelib.exceptions import AuthError, ForbiddenError
+
+        added = 0
+        after_id = 0
+        while not self._stop.is_set():
+            session = db.create_session(self.engine)
+            try:
+                users = db.find_backfill_users(session, after_id, self.batch_size, self.shard)
+            finally:
+                session.close()
+
+            for user_id, key in users:
+                if self._stop.is_set():
+                    break
+                try:
+                    added += self.backfill(user_id, key)
+                except (AuthError, ForbiddenError) as e:
+                    self.logger.warning('Time entries of user %s not loaded: %r', user_id, e)
+                except RedmineUnavailable as e:
+                    # Остальные пользователи подождут следующего запуска
+                    self.logger.warning('Time entry backfill stopped: %s', e)
+                    return added
+                except Exception:
+                    self.logger.exception('Failed to load time entries of user %s', user_id)
+
+            if len(users) < self.batch_size:
+                break
+            after_id = users[-1][0]
+
+        return added
+
+    def backfill(self, user_id: int, key: str) -> int:
+        redmine = self.redmine_clients.get(self.redmine_host, key)
+        name = self.WATERMARK.format(user_id)
+        session = db.create_session(self.engine)
+        try:
+            watermark = db.get_watermark(session, name)
+            from_date = dt.date(1970, 1, 1) if watermark is None else watermark.date() - self.overlap
+            # Сколько записей с spent_on == from_date уже забрано на предыдущих страницах
+            offset = 0
+            added = 0
+
+            while not self._stop.is_set():
+                page = list(redmine.time_entry.filter(user_id='me', from_date=from_date,
+                                                      sort='spent_on',
+                                                      limit=self.page_size,
+                                                      offset=offset))
+
+                rows = [self._entry_to_row(entry) for entry in page]
+                added += db.upsert_time_entries(session, user_id, rows)
+                if rows:
+                    last = rows[-1]['spent_on']
+                    offset = offset + len(rows) if last == from_date else \
+                        sum(1 for row in rows if row['spent_on'] == last)
+                    from_date = last
+                    # Отметка не сдвигается назад, пока перечитываются последние дни
+                    if watermark is None or last > watermark.date():
+                        watermark = dt.datetime.combine(last, dt.time())
+                        db.set_watermark(session, name, watermark)
+                session.commit()
+
+                if len(rows) < self.page_size:
+                    break
+
+            return added
+        finally:
+            session.close()
+
+    @staticmethod
+    def _entry_to_row(entry) -> dict:
+        return {
+            'redmine_id': entry.id,
+            'issue_id': getattr(getattr(entry, 'issue', None), 'id', None),
+            'spent_on': entry.spent_on,
+            'hours': entry.hours,
+            'comments': getattr(entry, 'comments', ''),
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                added = self.backfill_all()
+                if added:
+                    self.logger.info('Loaded %s time entries from redmine', added)
+            except Exception:
+                self.logger.exception('Failed to load time entries from redmine')
+            self._stop.wait(self.interval)
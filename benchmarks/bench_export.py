@@ -0,0 +1,80 @@
+"""
+Время и пик памяти выгрузки /export в зависимости от числа записей пользователя.
+
+Запуск из корня репозитория: python -m benchmarks.bench_export [--rows 1000000]
+"""
+import argparse
+import datetime as dt
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import db
+from benchmarks.bench_report import seed
+from benchmarks.bench_session import BenchConfig
+from db import TimeEntry
+from utility import write_csv
+
+HEADER = ('spent_on', 'issue_id', 'issue', 'hours', 'comments', 'redmine_id', 'sync_status')
+
+
+def add_user_rows(engine, user_id: int, rows: int, days: int, chunk: int = 50000) -> None:
+    today = dt.date.today()
+    insert = TimeEntry.__table__.insert()
+    with engine.begin() as connection:
+        for start in range(0, rows, chunk):
+            connection.execute(insert, [{
+                'user_id': user_id,
+                'issue_id': random.randint(1, 500),
+                'spent_on': today - dt.timedelta(days=random.randrange(days)),
+                'hours': 1,
+                'comments': 'bench export',
+                'saved': True,
+                'sync_status': db.SYNC_DONE,
+            } for _ in range(start, min(start + chunk, rows))])
+
+
+def export(engine, user_id: int, period, batch_size: int, spool_size: int) -> int:
+    session = db.create_session(engine)
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=spool_size) as file:
+            return write_csv(file, HEADER,
+                             db.iter_time_entries(session, user_id, *period, batch_size))
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--spool-size', type=int, default=1024 * 1024)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = db.create_engine_from_config(
+            BenchConfig('sqlite:///' + os.path.join(tmp, 'export.db')))
+
+        started = time.perf_counter()
+        # У пользователя 1 половина всех записей, остальные распределены между всеми
+        seed(engine, args.rows - args.rows // 2, args.users, 730)
+        add_user_rows(engine, 1, args.rows // 2, 730)
+        print('seeded {} rows in {:.1f} s'.format(args.rows, time.perf_counter() - started))
+
+        today = dt.date.today()
+        for user_id, days in ((2, 7), (2, 730), (1, 30), (1, 730)):
+            period = (today - dt.timedelta(days=days), today)
+            tracemalloc.start()
+            started = time.perf_counter()
+            count = export(engine, user_id, period, args.batch_size, args.spool_size)
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:>8} rows  {:7.2f} s  peak {:6.1f} MB'.format(count, elapsed, peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Задержка запроса /report на большой таблице time_entry.
+
+Запуск из корня репозитория: python -m benchmarks.bench_report [--rows 1000000]
+"""
+import argparse
+import datetime as dt
+import logging
+import os
+import random
+import tempfile
+import time
+
+import db
+from benchmarks.bench_session import BenchConfig
+from db import TimeEntry
+from migrations import migrate
+
+
+def seed(engine, rows: int, users: int, days: int, chunk: int = 50000) -> None:
+    migrate(engine, logging.getLogger(__name__))
+    session = db.create_session(engine)
+    session.add_all(db.User(telegram_id=id, telegram_name='user{}'.format(id))
+                    for id in range(1, users + 1))
+    session.commit()
+    session.close()
+
+    today = dt.date.today()
+    insert = TimeEntry.__table__.insert()
+    random.seed(1)
+    with engine.begin() as connection:
+        for start in range(0, rows, chunk):
+            connection.execute(insert, [{
+                'user_id': random.randint(1, users),
+                'issue_id': random.randint(1, 500),
+                'spent_on': today - dt.timedelta(days=random.randrange(days)),
+                'hours': random.choice((0.5, 1, 2, 4)),
+                'comments': 'bench',
+                'saved': True,
+                'sync_status': db.SYNC_DONE,
+                'sync_attempts': 1,
+            } for _ in range(start, min(start + chunk, rows))])
+
+
+def percentile(values, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = db.create_engine_from_config(
+            BenchConfig('sqlite:///' + os.path.join(tmp, 'report.db')))
+
+        started = time.perf_counter()
+        seed(engine, args.rows, args.users, args.days)
+        print('seeded {} rows in {:.1f} s'.format(args.rows, time.perf_counter() - started))
+
+        today = dt.date.today()
+        periods = {
+            'week': (today - dt.timedelta(days=today.weekday()), today),
+            'month': (today.replace(day=1), today),
+            'year': (today - dt.timedelta(days=365), today),
+        }
+        for name, period in periods.items():
+            timings = []
+            for _ in range(args.queries):
+                session = db.create_session(engine)
+                started = time.perf_counter()
+                db.report_hours(session, random.randint(1, args.users), *period)
+                timings.append((time.perf_counter() - started) * 1000)
+                session.close()
+
+            print('{:<6} p50 {:6.2f} ms   p95 {:6.2f} ms   p99 {:6.2f} ms'.format(
+                name, percentile(timings, 0.5), percentile(timings, 0.95),
+                percentile(timings, 0.99)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Сравнение открытия/закрытия сессии и поиска пользователя до и после
+кэширования sessionmaker и настройки движка.
+
+Запуск из корня репозитория: python -m benchmarks.bench_session
+"""
+import argparse
+import logging
+import os
+import tempfile
+import timeit
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import db
+from migrations import migrate
+
+
+class BenchConfig:
+
+    def __init__(self, dsn_db: str) -> None:
+        self.dsn_db = dsn_db
+        self.db_echo = False
+        self.db_pool_size = 10
+        self.db_max_overflow = 10
+        self.db_pool_pre_ping = True
+        self.db_sqlite_pragmas = {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+        }
+
+
+# Так сессия создавалась раньше: новый sessionmaker на каждый вызов
+def legacy_create_session(engine):
+    Session = sessionmaker()
+    Session.configure(bind=engine)
+    return Session()
+
+
+def seed(engine, users: int) -> None:
+    migrate(engine, logging.getLogger(__name__))
+    session = db.create_session(engine)
+    session.add_all(db.User(telegram_id=id, telegram_name='user{}'.format(id),
+                            redmine_password='key{}'.format(id)) for id in range(users))
+    session.commit()
+    session.close()
+
+
+def run_case(engine, create_session, number: int, users: int) -> dict:
+    def open_close():
+        create_session(engine).close()
+
+    def lookup():
+        session = create_session(engine)
+        db.find_user(session, users // 2).redmine_user.empty()
+        session.close()
+
+    return {
+        'open_close_us': timeit.timeit(open_close, number=number) / number * 1e6,
+        'find_user_us': timeit.timeit(lookup, number=number) / number * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before_dsn = 'sqlite:///' + os.path.join(tmp, 'before.db')
+        after_dsn = 'sqlite:///' + os.path.join(tmp, 'after.db')
+
+        before = create_engine(before_dsn)
+        after = db.create_engine_from_config(BenchConfig(after_dsn))
+        seed(before, args.users)
+        seed(after, args.users)
+
+        results = {
+            'before': run_case(before, legacy_create_session, args.number, args.users),
+            'after': run_case(after, db.create_session, args.number, args.users),
+        }
+
+    for name, result in results.items():
+        print('{:<8} open/close {:8.1f} us   open+find_user+close {:8.1f} us'.format(
+            name, result['open_close_us'], result['find_user_us']))
+
+
+if __name__ == '__main__':
+    main()
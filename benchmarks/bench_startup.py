@@ -0,0 +1,147 @@
+"""
+Холодный старт бота: импорт tg-tracking, проверка схемы и создание BotTracking
+с поддельным ботом. Каждый замер - отдельный процесс, печатаются медианы.
+Для сравнения замеряется прежний initialize_table, который на каждом старте
+проверял все таблицы и индексы.
+
+Запуск из корня репозитория: python -m benchmarks.bench_startup [--repeat 10]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули, загрузка которых отложена до первого обращения к redmine
+DEFERRED_MODULES = ('redminelib', 'requests')
+
+
+def legacy_initialize_table(engine) -> None:
+    """Проверка схемы до появления migrations.py (без создания таблиц)"""
+    from sqlalchemy import inspect
+
+    import db
+
+    for table in db.Base.metadata.sorted_tables:
+        if engine.dialect.has_table(engine, table.name):
+            existing = {index['name'] for index in inspect(engine).get_indexes(table.name)}
+            assert all(index.name in existing for index in table.indexes)
+
+
+def child_ready(dsn: str) -> dict:
+    started = time.perf_counter()
+    from benchmarks.load_test import load_tg_tracking
+
+    tg_tracking = load_tg_tracking()
+    from benchmarks.fakes import FakeBot
+    from config import Config
+    import db
+    from migrations import migrate
+
+    imported = time.perf_counter()
+    config = Config()
+    config.dsn_db = dsn
+    config.metrics_port = None
+    config.webhook_url = None
+    config.reminder_time = None
+    config.record_updates_dir = None
+    config.redmine_sync_key = None
+    engine = db.create_engine_from_config(config)
+    migrate(engine, logging.getLogger(__name__))
+
+    migrated = time.perf_counter()
+    tracking = tg_tracking.BotTracking(config, engine, bot=FakeBot(record=False))
+    ready = time.perf_counter()
+
+    loaded = [name for name in DEFERRED_MODULES if name in sys.modules]
+    import redminelib.exceptions  # noqa: F401
+    deferred = time.perf_counter()
+
+    tracking.submitter.stop()
+    engine.dispose()
+    return {
+        'import_ms': (imported - started) * 1000,
+        'migrate_ms': (migrated - imported) * 1000,
+        'bot_ms': (ready - migrated) * 1000,
+        'ready_ms': (ready - started) * 1000,
+        'deferred_import_ms': (deferred - ready) * 1000,
+        'loaded_at_ready': loaded,
+    }
+
+
+def child_legacy(dsn: str) -> dict:
+    import db
+    from migrations import migrate
+    from sqlalchemy import create_engine
+
+    engine = create_engine(dsn)
+    started = time.perf_counter()
+    legacy_initialize_table(engine)
+    checked = time.perf_counter()
+    engine.dispose()
+
+    engine = create_engine(dsn)
+    migrate(engine, logging.getLogger(__name__))
+    migrated = time.perf_counter()
+    engine.dispose()
+    return {
+        'legacy_check_ms': (checked - started) * 1000,
+        'migrate_current_ms': (migrated - checked) * 1000,
+        'tables': len(db.Base.metadata.sorted_tables),
+    }
+
+
+def run_child(case: str, dsn: str) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_startup', '--child', case, dsn],
+                            cwd=ROOT, check=True, stdout=subprocess.PIPE).stdout
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    # Вместе с запуском интерпретатора
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def medians(results: list) -> dict:
+    return {key: statistics.median(result[key] for result in results)
+            for key, value in results[0].items() if isinstance(value, (int, float))}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        logging.getLogger().setLevel(logging.WARNING)
+        case, dsn = args.child
+        result = child_ready(dsn) if case == 'ready' else child_legacy(dsn)
+        print(json.dumps(result))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dsn = 'sqlite:///' + os.path.join(tmp, 'startup.db')
+        fresh = run_child('ready', dsn)
+        current = medians([run_child('ready', dsn) for _ in range(args.repeat)])
+        legacy = medians([run_child('legacy', dsn) for _ in range(args.repeat)])
+
+    print('fresh db:   migrate {:7.1f} ms   ready {:7.1f} ms   process {:7.1f} ms'.format(
+        fresh['migrate_ms'], fresh['ready_ms'], fresh['process_ms']))
+    print('current db: migrate {:7.1f} ms   ready {:7.1f} ms   process {:7.1f} ms'.format(
+        current['migrate_ms'], current['ready_ms'], current['process_ms']))
+    print('            import {:7.1f} ms   BotTracking {:7.1f} ms'.format(
+        current['import_ms'], current['bot_ms']))
+    print('schema check on {} tables: initialize_table {:.1f} ms, migrate {:.1f} ms'.format(
+        legacy['tables'], legacy['legacy_check_ms'], legacy['migrate_current_ms']))
+    print('deferred until first redmine call: {:.1f} ms ({} loaded at ready: {})'.format(
+        current['deferred_import_ms'], ', '.join(DEFERRED_MODULES),
+        ', '.join(fresh['loaded_at_ready']) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+Подделки внешних сервисов для нагрузочных тестов: бот telegram, который
+записывает вызовы API вместо отправки, и HTTP заглушка API redmine.
+"""
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+STUB_THREAD = 'redmine_stub_connection'
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'tracking_bot'}
+
+
+class FakeRequest(Request):
+    """
+    Отвечает на запросы Bot API локально, поэтому разбор ответов в Bot
+    работает так же, как с настоящим telegram. Все вызовы записываются
+    """
+
+    def __init__(self, latency: float = 0.0, record: bool = True) -> None:
+        super().__init__()
+        self.latency = latency
+        self.record = record
+        self.calls = []  # type: List[Tuple[str, dict]]
+        self.counts = Counter()
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def get(self, url, timeout=None):
+        return self.post(url, {}, timeout=timeout)
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.counts[method] += 1
+            if self.record:
+                self.calls.append((method, dict(data)))
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getMyCommands':
+            return []
+        if method.startswith('send'):
+            return {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': 'private'},
+                'from': BOT_USER,
+                'text': data.get('text', ''),
+            }
+        return True
+
+
+class FakeBot(Bot):
+
+    def __init__(self, latency: float = 0.0, record: bool = True) -> None:
+        super().__init__('123456:FAKE', request=FakeRequest(latency, record))
+        self.get_me()
+
+    @property
+    def calls(self) -> List[Tuple[str, dict]]:
+        return self._request.calls
+
+    @property
+    def counts(self) -> Counter:
+        return self._request.counts
+
+
+class _RedmineRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server = None  # type: RedmineStub
+
+    def setup(self):
+        super().setup()
+        # Потоки заглушки не считаются в потоках бота (см. load_test.ThreadSampler)
+        threading.current_thread().name = STUB_THREAD
+
+    def do_GET(self):
+        if not self._begin():
+            return
+
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith('/users/current'):
+            self._reply(200, {'user': {'id': 1, 'login': 'user', 'firstname': 'User',
+                                       'lastname': 'Stub'}})
+        elif url.path.startswith('/issues'):
+            issues = self.server.issues
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', 25))
+            self._reply(200, {'issues': issues[offset:offset + limit],
+                              'total_count': len(issues), 'offset': offset, 'limit': limit})
+        elif url.path.startswith('/time_entries'):
+            entries = [entry for entry in self.server.time_entries(self.headers.get('X-Redmine-API-Key'))
+                       if query.get('from', '') <= entry['spent_on'] <= query.get('to', '9999')
+                       and str(entry['issue']['id']) == query.get('issue_id', str(entry['issue']['id']))]
+            offset, limit = int(query.get('offset', 0)), int(query.get('limit', 25))
+            self._reply(200, {'time_entries': entries[offset:offset + limit],
+                              'total_count': len(entries), 'offset': offset, 'limit': limit})
+        else:
+            self._reply(404, {})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not self._begin():
+            return
+
+        if urlparse(self.path).path.startswith('/time_entries'):
+            entry = dict(json.loads(body.decode('utf-8'))['time_entry'],
+                         id=self.server.next_id())
+            self.server.add_time_entry(self.headers.get('X-Redmine-API-Key'), entry)
+            self._reply(201, {'time_entry': entry})
+        else:
+            self._reply(404, {})
+
+    def _begin(self) -> bool:
+        self.server.count(self.command, urlparse(self.path).path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.failure_rate and random.random() < self.server.failure_rate:
+            self._reply(500, {})
+            return False
+        return True
+
+    def _reply(self, code: int, data: dict) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RedmineStub(ThreadingHTTPServer):
+    """
+    Заглушка API redmine: текущий пользователь, задачи, создание и список time_entries.
+    Записи хранятся отдельно для каждого ключа и отдаются по возрастанию spent_on.
+    Каждый запрос задерживается на latency секунд и с вероятностью
+    failure_rate завершается ошибкой 500
+    """
+
+    daemon_threads = True
+    # Как у настоящего веб-сервера: при всплеске соединений клиенты не ждут повтора SYN
+    request_queue_size = 128
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0,
+                 issues: Optional[List[dict]] = None) -> None:
+        super().__init__(('127.0.0.1', 0), _RedmineRequestHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.issues = issues if issues is not None else [
+            {'id': id, 'subject': 'Stub issue {}'.format(id),
+             'project': {'id': 1, 'name': 'Stub'}, 'status': {'id': 1, 'name': 'New'},
+             'updated_on': '2019-01-01T00:00:00Z'}
+            for id in range(1, 11)]
+        self.counts = Counter()
+        self._time_entries = {}  # type: Dict[str, List[dict]]
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def add_time_entry(self, key: str, entry: dict) -> None:
+        """Запись в формате ответа redmine из полей запроса на создание"""
+        # Как redmine, часы хранятся с двумя знаками
+        entry = dict(entry, issue={'id': entry.get('issue_id')},
+                     spent_on=str(entry['spent_on']), hours=round(float(entry['hours']), 2))
+        entry.pop('issue_id', None)
+        with self._lock:
+            entries = self._time_entries.setdefault(key, [])
+            entries.append(entry)
+            entries.sort(key=lambda entry: (entry['spent_on'], entry['id']))
+
+    def time_entries(self, key: str) -> List[dict]:
+        with self._lock:
+            return list(self._time_entries.get(key, []))
+
+    def count(self, method: str, path: str) -> None:
+        with self._lock:
+            self.counts['{} {}'.format(method, path)] += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='redmine_stub',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
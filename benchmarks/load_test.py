@@ -0,0 +1,388 @@
+"""
+Нагрузочный тест диалога /track без сети: поддельный бот telegram и
+заглушка redmine. N пользователей проходят
+start -> spent_on -> issue -> comment -> add_hours -> done, после чего
+записи отправляются в заглушку redmine.
+
+Результат (обновлений в секунду, p50/p95/p99 по обработчикам, число
+SQL запросов) печатается и сохраняется в JSON для сравнения запусков.
+
+Запуск из корня репозитория:
+python -m benchmarks.load_test --users 200 --sessions 5 --output after.json --compare before.json
+
+Сравнение отправки в redmine потоками и через asyncio при медленном redmine:
+python -m benchmarks.load_test --redmine-latency 0.05 --sync-concurrency 64 --output threads.json
+python -m benchmarks.load_test --redmine-latency 0.05 --sync-concurrency 64 --redmine-async \
+    --compare threads.json
+"""
+import argparse
+import datetime as dt
+import functools
+import importlib.util
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func
+from telegram import CallbackQuery, Chat, Message, MessageEntity, Update, User as TelegramUser
+
+import db
+from benchmarks.bench_report import percentile
+from benchmarks.fakes import STUB_THREAD, FakeBot, RedmineStub
+from metrics import instrument_dispatcher
+from migrations import migrate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_tg_tracking():
+    """Загружает tg-tracking.py как модуль. Без config.py используется config.sample.py"""
+    try:
+        import config  # noqa: F401
+    except ImportError:
+        spec = importlib.util.spec_from_file_location('config', os.path.join(ROOT, 'config.sample.py'))
+        config = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(config)
+        sys.modules['config'] = config
+
+    spec = importlib.util.spec_from_file_location('tg_tracking', os.path.join(ROOT, 'tg-tracking.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class UpdateFactory:
+    """Синтетические обновления от пользователей"""
+
+    def __init__(self, bot: FakeBot) -> None:
+        self.bot = bot
+        self._update_id = 0
+        self._lock = threading.Lock()
+
+    def _next_id(self) -> int:
+        with self._lock:
+            self._update_id += 1
+            return self._update_id
+
+    def message(self, telegram_id: int, text: str) -> Update:
+        user = TelegramUser(telegram_id, 'user{}'.format(telegram_id), False)
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0]))] \
+            if text.startswith('/') else []
+        update_id = self._next_id()
+        return Update(update_id, message=Message(update_id, user, dt.datetime.now(),
+                                                 Chat(telegram_id, Chat.PRIVATE),
+                                                 text=text, entities=entities, bot=self.bot))
+
+    def callback(self, telegram_id: int, data: str) -> Update:
+        user = TelegramUser(telegram_id, 'user{}'.format(telegram_id), False)
+        update_id = self._next_id()
+        message = Message(update_id, self.bot.bot, dt.datetime.now(),
+                          Chat(telegram_id, Chat.PRIVATE), text='', bot=self.bot)
+        return Update(update_id, callback_query=CallbackQuery(
+            str(update_id), user, str(telegram_id), message=message, data=data, bot=self.bot))
+
+    def track_session(self, telegram_id: int, issue_id: int) -> List[Update]:
+        return [
+            self.message(telegram_id, '/track'),
+            self.callback(telegram_id, str(dt.date.today())),
+            self.callback(telegram_id, str(issue_id)),
+            self.message(telegram_id, 'load test'),
+            self.callback(telegram_id, '1'),
+            self.callback(telegram_id, '0.5'),
+            self.callback(telegram_id, 'Done'),
+        ]
+
+
+class HandlerStats:
+    """Время обработчиков и SQL запросы с привязкой к обработчику, в котором они выполнены"""
+
+    def __init__(self) -> None:
+        self.timings = defaultdict(list)  # type: Dict[str, List[float]]
+        self.errors = Counter()
+        self.queries = Counter()
+        self.statements = Counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def wrap(self, callback: Callable) -> Callable:
+        name = callback.__qualname__
+
+        @functools.wraps(callback)
+        def wrapper(*args, **kwargs):
+            self._local.handler = name
+            started = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                self._local.handler = None
+                with self._lock:
+                    self.timings[name].append(elapsed * 1000)
+
+        return wrapper
+
+    def attach(self, engine) -> None:
+        @event.listens_for(engine, 'before_cursor_execute')
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            handler = getattr(self._local, 'handler', None) or 'background'
+            with self._lock:
+                self.queries[handler] += 1
+                self.statements[statement.lstrip().split(None, 1)[0].upper()] += 1
+
+
+class ThreadSampler:
+    """Пиковое число потоков бота за время замера (без потоков заглушки redmine)"""
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.peak = self.count()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def __enter__(self) -> 'ThreadSampler':
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='thread_sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.count())
+
+    @staticmethod
+    def count() -> int:
+        return sum(1 for thread in threading.enumerate()
+                   if thread.name not in (STUB_THREAD, 'thread_sampler'))
+
+
+class Harness:
+    """
+    BotTracking с поддельным ботом, заглушкой redmine и временной sqlite базой.
+    Обновления подаются в диспетчер, как если бы они пришли от telegram
+    """
+
+    def __init__(self, directory: str, workers: int, redmine_latency: float = 0.0,
+                 redmine_failure_rate: float = 0.0, telegram_latency: float = 0.0,
+                 redmine_async: bool = False, sync_concurrency: Optional[int] = None) -> None:
+        tg_tracking = load_tg_tracking()
+        from config import Config
+
+        self.redmine = RedmineStub(latency=redmine_latency, failure_rate=redmine_failure_rate)
+        self.redmine.start()
+        self.bot = FakeBot(latency=telegram_latency, record=False)
+
+        config = Config()
+        config.dsn_db = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        config.redmine_host = self.redmine.url
+        config.workers = workers
+        config.metrics_port = None
+        config.webhook_url = None
+        config.reminder_time = None
+        config.record_updates_dir = None
+        config.redmine_sync_key = None
+        config.redmine_async = redmine_async
+        if sync_concurrency:
+            config.redmine_sync_concurrency = sync_concurrency
+            config.redmine_pool_size = max(config.redmine_pool_size, sync_concurrency)
+
+        self.engine = db.create_engine_from_config(config)
+        migrate(self.engine, logging.getLogger(__name__))
+        self.tracking = tg_tracking.BotTracking(config, self.engine, bot=self.bot)
+        self.stats = HandlerStats()
+        instrument_dispatcher(self.tracking.updater.dispatcher, self.stats.wrap)
+        self.stats.attach(self.engine)
+
+        self.updates = 0
+        self.lags = []  # type: List[float]
+        self.dispatch_seconds = 0.0
+        self.sync_seconds = 0.0
+        self.sync_attempts = 0
+        self.threads = ThreadSampler()
+
+    def add_users(self, telegram_ids: Iterable[int]) -> None:
+        session = db.create_session(self.engine)
+        session.add_all(db.User(id, 'user{}'.format(id), 'user{}'.format(id), 'key{}'.format(id))
+                        for id in telegram_ids)
+        session.commit()
+        session.close()
+
+    def dispatch(self, updates: Iterable[Tuple[Optional[float], Update]]) -> None:
+        """
+        Подает обновления в диспетчер и ждет их обработки. Для каждого обновления
+        можно задать момент подачи от начала (сек.), None - сразу
+        """
+        dispatcher = self.tracking.updater.dispatcher
+        dispatcher.scheduler.start()
+        started = time.perf_counter()
+        with self.threads:
+            self._dispatch(dispatcher, started, updates)
+        self.dispatch_seconds = time.perf_counter() - started
+
+    def _dispatch(self, dispatcher, started: float,
+                  updates: Iterable[Tuple[Optional[float], Update]]) -> None:
+        for at, update in updates:
+            if at is not None:
+                wait = started + at - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    # Насколько подача отстала от расписания из-за переполненных очередей
+                    self.lags.append(-wait * 1000)
+            dispatcher.process_update(update)
+            self.updates += 1
+        dispatcher.scheduler.stop()
+
+    def sync(self) -> None:
+        started = time.perf_counter()
+        with self.threads:
+            while True:
+                submitted = self.tracking.submitter.drain()
+                if not submitted:
+                    break
+                self.sync_attempts += submitted
+        self.sync_seconds = time.perf_counter() - started
+
+    def result(self, params: dict) -> dict:
+        session = db.create_session(self.engine)
+        statuses = dict(session.query(db.TimeEntry.sync_status, func.count())
+                        .group_by(db.TimeEntry.sync_status))
+        session.close()
+
+        total_queries = sum(self.stats.queries.values())
+        return {
+            'params': params,
+            'updates': self.updates,
+            'dispatch_seconds': self.dispatch_seconds,
+            'updates_per_second': self.updates / self.dispatch_seconds,
+            'lag_p99_ms': percentile(self.lags, 0.99) if self.lags else 0.0,
+            'lag_max_ms': max(self.lags, default=0.0),
+            'sync_seconds': self.sync_seconds,
+            'sync_attempts': self.sync_attempts,
+            'threads_peak': self.threads.peak,
+            'time_entries': statuses,
+            'handlers': {
+                name: {
+                    'count': len(timings),
+                    'errors': self.stats.errors[name],
+                    'p50_ms': percentile(timings, 0.5),
+                    'p95_ms': percentile(timings, 0.95),
+                    'p99_ms': percentile(timings, 0.99),
+                } for name, timings in sorted(self.stats.timings.items())
+            },
+            'db_queries': {
+                'total': total_queries,
+                'per_update': total_queries / max(self.updates, 1),
+                'by_handler': dict(self.stats.queries),
+                'by_statement': dict(self.stats.statements),
+            },
+            'redmine_requests': dict(self.redmine.counts),
+            'telegram_requests': dict(self.bot.counts),
+        }
+
+    def close(self) -> None:
+        self.tracking.submitter.stop()
+        self.tracking.close_redmine()
+        self.engine.dispose()
+        self.redmine.stop()
+
+
+def run(args) -> dict:
+    # Отладочный вывод бота заметно искажает замеры
+    logging.getLogger().setLevel(args.log_level)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        harness = Harness(tmp, args.workers, args.redmine_latency, args.redmine_failure_rate,
+                          args.telegram_latency, redmine_async=args.redmine_async,
+                          sync_concurrency=args.sync_concurrency)
+        try:
+            telegram_ids = [100000 + i for i in range(args.users)]
+            harness.add_users(telegram_ids)
+
+            # Шаги пользователей чередуются, как если бы все работали одновременно
+            factory = UpdateFactory(harness.bot)
+            issues = harness.redmine.issues
+            sessions = [[update for _ in range(args.sessions)
+                         for update in factory.track_session(id, issues[id % len(issues)]['id'])]
+                        for id in telegram_ids]
+            harness.dispatch((None, update) for step in zip(*sessions) for update in step)
+            harness.sync()
+            return harness.result(vars(args))
+        finally:
+            harness.close()
+
+
+def print_result(result: dict, previous: dict = None) -> None:
+    def delta(new, old):
+        return '' if old is None else ' ({:+.1f}%)'.format((new - old) / old * 100 if old else 0)
+
+    previous_handlers = previous['handlers'] if previous else {}
+    print('{} updates in {:.2f} s: {:.0f} updates/s{}'.format(
+        result['updates'], result['dispatch_seconds'], result['updates_per_second'],
+        delta(result['updates_per_second'], previous and previous['updates_per_second'])))
+    if result['lag_max_ms']:
+        print('schedule lag: p99 {:.1f} ms, max {:.1f} ms'.format(result['lag_p99_ms'],
+                                                                 result['lag_max_ms']))
+    print('sync: {} attempts in {:.2f} s{}, entries {}'.format(
+        result['sync_attempts'], result['sync_seconds'],
+        delta(result['sync_seconds'], previous and previous['sync_seconds']),
+        result['time_entries']))
+    if 'threads_peak' in result:
+        print('threads: peak {}{}'.format(result['threads_peak'], delta(
+            result['threads_peak'], previous and previous.get('threads_peak'))))
+    print('db queries: {} ({:.2f} per update){}'.format(
+        result['db_queries']['total'], result['db_queries']['per_update'],
+        delta(result['db_queries']['per_update'], previous and previous['db_queries']['per_update'])))
+
+    for name, stats in result['handlers'].items():
+        old = previous_handlers.get(name)
+        print('{:<36} n={:<6} p50 {:7.2f} ms   p95 {:7.2f} ms{}   p99 {:7.2f} ms   errors {}'.format(
+            name, stats['count'], stats['p50_ms'], stats['p95_ms'],
+            delta(stats['p95_ms'], old and old['p95_ms']), stats['p99_ms'], stats['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=3, help='диалогов /track на пользователя')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--redmine-latency', type=float, default=0.0)
+    parser.add_argument('--redmine-failure-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--redmine-async', action='store_true',
+                        help='запросы к redmine через asyncio (redmine_async в настройках)')
+    parser.add_argument('--sync-concurrency', type=int,
+                        help='параллельность отправки в redmine (redmine_sync_concurrency)')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='куда сохранить результат в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    result = run(args)
+    print_result(result, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
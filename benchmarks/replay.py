@@ -0,0 +1,101 @@
+"""
+Воспроизведение записанных обновлений (record_updates_dir в настройках бота)
+против поддельного бота и заглушки redmine. Подача идет с исходными
+интервалами, ускоренно в N раз или без пауз (--speed 0).
+
+Запуск из корня репозитория:
+python -m benchmarks.replay captures/ --speed 10 --workers 16 --output replay.json
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import tempfile
+from typing import List
+
+from telegram import Update
+
+from benchmarks.load_test import Harness, print_result
+from recorder import UpdateRecorder, read_capture
+
+
+def capture_paths(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, UpdateRecorder.PATTERN))))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='файлы записи или каталоги с ними')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='ускорение относительно записи, 0 - без пауз')
+    parser.add_argument('--limit', type=int, help='воспроизвести только первые N обновлений')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--redmine-latency', type=float, default=0.0)
+    parser.add_argument('--redmine-failure-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-latency', type=float, default=0.0)
+    parser.add_argument('--redmine-async', action='store_true')
+    parser.add_argument('--sync-concurrency', type=int)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='куда сохранить результат в JSON')
+    parser.add_argument('--compare', help='JSON предыдущего запуска для сравнения')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    files = capture_paths(args.paths)
+    if not files:
+        parser.error('no capture files found')
+
+    def records():
+        for i, record in enumerate(read_capture(files)):
+            if args.limit is not None and i >= args.limit:
+                return
+            yield record
+
+    # Все, кто писал боту, регистрируются, чтобы обработчики шли по полному пути
+    users = set()
+    for _, data in records():
+        for field in ('message', 'edited_message', 'callback_query', 'inline_query'):
+            sender = (data.get(field) or {}).get('from')
+            if sender:
+                users.add(sender['id'])
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        harness = Harness(tmp, args.workers, args.redmine_latency, args.redmine_failure_rate,
+                          args.telegram_latency, redmine_async=args.redmine_async,
+                          sync_concurrency=args.sync_concurrency)
+        try:
+            harness.add_users(users)
+
+            def updates():
+                first = None
+                for t, data in records():
+                    first = t if first is None else first
+                    at = (t - first) / args.speed if args.speed > 0 else None
+                    yield at, Update.de_json(data, harness.bot)
+
+            harness.dispatch(updates())
+            harness.sync()
+            result = harness.result(dict(vars(args), files=files, users=len(users)))
+        finally:
+            harness.close()
+
+    print_result(result, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Проверка приема обновлений через WebhookServer без telegram: сервер
+поднимается на localhost, обновление отправляется POST запросом и должно
+дойти до обработчика диспетчера, а запросы не по пути вебхука и с
+неразборчивым телом - получить 404 и 400.
+
+Запуск из корня репозитория: python -m benchmarks.webhook_check
+"""
+import json
+import logging
+import threading
+import urllib.error
+import urllib.request
+from queue import Empty, Queue
+
+import telegram.ext as tg
+from telegram import Update
+
+from benchmarks.fakes import FakeBot
+from webhook import WebhookServer
+
+URL_PATH = '/hook'
+UPDATE = {
+    'update_id': 42,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'text': '/help',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}],
+        'chat': {'id': 5, 'type': 'private'},
+        'from': {'id': 5, 'is_bot': False, 'first_name': 'User'},
+    },
+}
+
+
+def post(port: int, path: str, body: bytes) -> int:
+    request = urllib.request.Request('http://127.0.0.1:{}{}'.format(port, path), data=body,
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger('webhook_check')
+
+    bot = FakeBot()
+    dispatcher = tg.Dispatcher(bot, Queue(), workers=0)
+    received = Queue()
+    dispatcher.add_handler(tg.TypeHandler(Update, lambda bot, update: received.put(update)))
+    thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    thread.start()
+
+    # Порт 0 - свободный порт, который выберет система
+    server = WebhookServer(bot, dispatcher.update_queue, '127.0.0.1', 0, URL_PATH, logger)
+    server.start()
+    port = server.server_address[1]
+    try:
+        status = post(port, URL_PATH, json.dumps(UPDATE).encode('utf-8'))
+        assert status == 200, status
+        try:
+            update = received.get(timeout=5)
+        except Empty:
+            raise AssertionError('update did not reach the dispatcher')
+        assert update.update_id == UPDATE['update_id'], update.update_id
+        assert update.effective_user.id == 5 and update.message.text == '/help', update
+
+        for path, body, expected in (
+                ('/wrong', json.dumps(UPDATE).encode('utf-8'), 404),
+                (URL_PATH, b'{not json', 400),
+                (URL_PATH, b'\xff\xfe', 400),
+                (URL_PATH, b'[]', 400),
+                (URL_PATH, b'{"message": {}}', 400)):
+            status = post(port, path, body)
+            assert status == expected, (path, body, status)
+
+        # Отклоненные запросы не попадают в очередь диспетчера
+        try:
+            update = received.get(timeout=0.5)
+            raise AssertionError('unexpected update {}'.format(update))
+        except Empty:
+            pass
+    finally:
+        server.stop()
+        dispatcher.stop()
+        thread.join()
+
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+
+from metrics import CIRCUIT_STATE, CIRCUIT_TRANSITIONS
+
+# Состояния размыкателя, значения - как в метрике bot_circuit_state
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+STATE_NAMES = {CLOSED: 'closed', HALF_OPEN: 'half_open', OPEN: 'open'}
+
+
+class CircuitBreaker:
+    """
+    Размыкатель цепи для внешнего сервиса. После failure_threshold ошибок подряд
+    цепь размыкается, и запросы сразу отклоняются reset_timeout секунд. Затем
+    пропускается один пробный запрос (half-open): успех замыкает цепь, ошибка
+    снова размыкает ее
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float,
+                 logger: logging.Logger) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logger
+
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set(name, value=CLOSED)
+
+    @property
+    def state(self) -> int:
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def available(self) -> bool:
+        """Можно ли сейчас обращаться к сервису (в том числе пробным запросом)"""
+        return self.state != OPEN
+
+    def allow(self) -> bool:
+        """Разрешает запрос. В half-open одновременно выполняется только один пробный запрос"""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._transition(HALF_OPEN)
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self._probing = False
+            if self._state != CLOSED:
+                self._transition(CLOSED)
+            self._failures = 0
+
+    def release(self) -> None:
+        """Запрос не дошел до сервиса: состояние не меняется, но пробный запрос освобождается"""
+        with self._lock:
+            self._probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._state == HALF_OPEN or \
+                    (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {'state': STATE_NAMES[self._state], 'failures': self._failures}
+
+    def _transition(self, state: int) -> None:
+        log = self.logger.info if state == CLOSED else self.logger.warning
+        log('Circuit %s: %s -> %s after %s failures', self.name, STATE_NAMES[self._state],
+            STATE_NAMES[state], self._failures)
+        self._state = state
+        CIRCUIT_STATE.set(self.name, value=state)
+        CIRCUIT_TRANSITIONS.inc(self.name, STATE_NAMES[state])
@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import db
+from db import CachedUser
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU кэш с ограничением по размеру и временем жизни записей.
+    Устаревшие записи не удаляются при чтении, чтобы их можно было отдать,
+    пока идет обновление в фоне. Если ttl не задан, записи не устаревают.
+    Каждый сброс меняет версию кэша: значение, загруженное до сброса, можно
+    не записывать, передав в set версию, взятую перед загрузкой
+    """
+
+    def __init__(self, ttl: Optional[float], maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # type: OrderedDict
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[Optional[Any], bool]:
+        """Возвращает пару (значение, свежесть). Для отсутствующего ключа - (None, False)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None, False
+            self.hits += 1
+            self._data.move_to_end(key)
+            value, expires_at = item
+            return value, expires_at is None or expires_at > time.monotonic()
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None) -> None:
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._version += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._version += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class IssueCache:
+    """
+    Кэш списка задач redmine по ключу пользователя.
+    Свежие данные отдаются сразу, устаревшие тоже отдаются сразу, но в фоне
+    запускается обновление (stale-while-revalidate). Загрузка синхронная только
+    при первом обращении по ключу. Если задан async_loader (возвращает Future),
+    фоновое обновление идет через него, а не в отдельном потоке
+    """
+
+    def __init__(self, loader: Callable[[str], Dict[int, str]], ttl: float,
+                 maxsize: int, logger: logging.Logger,
+                 async_loader: Optional[Callable[[str], Future]] = None) -> None:
+        self.loader = loader
+        self.async_loader = async_loader
+        self.logger = logger
+        self._cache = TTLCache(ttl, maxsize)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Dict[int, str]:
+        issues, fresh = self._cache.get(key)
+        if issues is None:
+            return self._load(key)
+
+        if not fresh:
+            self._refresh_in_background(key)
+        return issues
+
+    def invalidate(self, key: str) -> None:
+        self._cache.invalidate(key)
+
+    def _load(self, key: str) -> Dict[int, str]:
+        issues = self.loader(key)
+        self._cache.set(key, issues)
+        return issues
+
+    def _refresh_in_background(self, key: str) -> None:
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        if self.async_loader is None:
+            threading.Thread(target=self._refresh, args=(key,), daemon=True).start()
+            return
+
+        try:
+            future = self.async_loader(key)
+        except Exception:
+            self.logger.exception('Failed to refresh redmine issues')
+            self._refreshed(key)
+            return
+        future.add_done_callback(lambda f: self._refreshed(key, f))
+
+    def _refresh(self, key: str) -> None:
+        try:
+            self._load(key)
+        except Exception:
+            self.logger.exception('Failed to refresh redmine issues')
+        finally:
+            self._refreshed(key)
+
+    def _refreshed(self, key: str, future: Optional[Future] = None) -> None:
+        if future is not None:
+            try:
+                self._cache.set(key, future.result())
+            except Exception:
+                self.logger.exception('Failed to refresh redmine issues')
+        with self._lock:
+            self._refreshing.discard(key)
+
+
+class UserCache:
+    """
+    Read-through кэш пользователей по telegram id. Хранит только то, что нужно
+    обработчикам на каждом обновлении (id пользователя и ключ redmine), и
+    сбрасывается при изменении пользователя
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._cache = TTLCache(None, maxsize)
+
+    def get(self, session: Session, telegram_id: int) -> Optional[CachedUser]:
+        user, _ = self._cache.get(telegram_id)
+        if user is not None:
+            return user
+
+        # Пока строка читается, пользователя могут изменить и сбросить кэш. Тогда
+        # прочитанное значение не кэшируется, иначе старый ключ остался бы навсегда
+        version = self._cache.version()
+        user = db.find_cached_user(session, telegram_id)
+        if user is not None:
+            self._cache.set(telegram_id, user, version)
+        return user
+
+    def invalidate(self, telegram_id: int) -> None:
+        self._cache.invalidate(telegram_id)
+
+    def metrics(self) -> dict:
+        return {'size': len(self._cache), 'hits': self._cache.hits, 'misses': self._cache.misses}
@@ -0,0 +1,94 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from telegram import Bot, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+MessageKey = Tuple[int, int]
+
+
+class _MessageState:
+
+    def __init__(self) -> None:
+        self.pending = None  # type: Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]
+        self.last = None  # type: Optional[Tuple[str, Optional[InlineKeyboardMarkup]]]
+        self.sent_at = 0.0
+        self.timer = None  # type: Optional[threading.Timer]
+        self.send_lock = threading.Lock()
+
+
+class EditCoalescer:
+    """
+    Склеивает частые правки одного сообщения. Состояние обработчик меняет сразу,
+    а в telegram уходит не больше одной правки за окно window, всегда с
+    последним текстом. Правки без изменений не отправляются.
+    Клавиатуры сравниваются по ссылке, поэтому их нужно создавать один раз
+    """
+
+    def __init__(self, bot: Bot, window: float, logger: logging.Logger) -> None:
+        self.bot = bot
+        self.window = window
+        self.logger = logger
+        self._states = {}  # type: Dict[MessageKey, _MessageState]
+        self._lock = threading.Lock()
+
+    def edit(self, chat_id: int, message_id: int, text: str,
+             reply_markup: Optional[InlineKeyboardMarkup] = None, flush: bool = False) -> None:
+        """Ставит правку в очередь. С flush=True отправляет ее сразу, отменяя отложенную"""
+        key = (chat_id, message_id)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = _MessageState()
+            state.pending = (text, reply_markup)
+
+            delay = 0 if flush else state.sent_at + self.window - time.monotonic()
+            if delay > 0:
+                if state.timer is None:
+                    state.timer = threading.Timer(delay, self._send, args=(key, state))
+                    state.timer.daemon = True
+                    state.timer.start()
+                return
+
+            if state.timer is not None:
+                state.timer.cancel()
+                state.timer = None
+
+        self._send(key, state)
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        """Сбрасывает отложенные правки, когда сообщение больше не нужно"""
+        with self._lock:
+            state = self._states.pop((chat_id, message_id), None)
+            if state is not None and state.timer is not None:
+                state.timer.cancel()
+
+    def _send(self, key: MessageKey, state: _MessageState) -> None:
+        # Правки одного сообщения уходят строго по очереди
+        with state.send_lock:
+            with self._lock:
+                pending, state.pending = state.pending, None
+                state.timer = None
+                if self._states.get(key) is not state:
+                    return
+            if pending is None or self._same(pending, state.last):
+                return
+
+            text, reply_markup = pending
+            try:
+                self.bot.edit_message_text(text, chat_id=key[0], message_id=key[1],
+                                           reply_markup=reply_markup)
+            except BadRequest as e:
+                if 'not modified' not in str(e).lower():
+                    self.logger.warning('Failed to edit message %s: %s', key, e)
+            except Exception:
+                self.logger.exception('Failed to edit message %s', key)
+
+            state.last = pending
+            state.sent_at = time.monotonic()
+
+    @staticmethod
+    def _same(a, b) -> bool:
+        return b is not None and a[0] == b[0] and a[1] is b[1]
@@ -2,15 +2,158 @@ class Config:
 
     def __init__(self):
         self.token = 'TOKEN'
+        # Число потоков обработки обновлений и размер очереди обновлений одного пользователя.
+        # Обновления сверх очереди отбрасываются, на нажатие кнопки бот отвечает, что занят
+        self.workers = 8
+        self.max_user_queue_size = 20
+        # Число процессов-обработчиков. Если больше 1, главный процесс только принимает обновления
+        # и раздает их обработчикам по id пользователя. SIGHUP перезапускает обработчики по одному
+        self.worker_processes = 1
+        # Сколько обновлений может ждать в очереди обработчика и сколько (сек.) ждать его остановки
+        self.worker_queue_size = 1000
+        self.worker_drain_timeout = 60
+        # Сколько пользователей держать в кэше, чтобы не искать их в БД на каждом обновлении
+        self.user_cache_size = 10000
 
         self.redmine_host = 'https://task.org'
         self.redmine_general_issue = {
             1: 'Education',
             24: 'Task',
         }
+        # Время жизни (сек.) и размер кэша задач пользователей из redmine
+        self.redmine_issue_cache_ttl = 300
+        self.redmine_issue_cache_size = 1000
+        # Размер пула keep-alive соединений к redmine и таймауты (сек.)
+        self.redmine_pool_size = 10
+        self.redmine_connect_timeout = 5
+        self.redmine_read_timeout = 30
+        # Таймаут ответа (сек.) для запросов, которые ждет пользователь: проверка ключа и список задач
+        self.redmine_interactive_timeout = 5
+        # После redmine_breaker_failures ошибок подряд запросы к redmine не выполняются
+        # redmine_breaker_reset_timeout сек., потом делается пробный запрос. В это время бот
+        # показывает только общие задачи и redmine_degraded_issues последних задач пользователя,
+        # а ключи сохраняет без проверки и проверяет в фоне раз в redmine_key_check_interval сек.
+        self.redmine_breaker_failures = 5
+        self.redmine_breaker_reset_timeout = 30
+        self.redmine_degraded_issues = 10
+        self.redmine_key_check_interval = 60
+        self.redmine_key_check_batch_size = 50
+        # Фоновая отправка времени в redmine: параллельность, размер пачки,
+        # интервал опроса и начальная задержка повтора (сек.)
+        self.redmine_sync_concurrency = 4
+        self.redmine_sync_batch_size = 50
+        self.redmine_sync_interval = 5
+        self.redmine_sync_backoff = 10
+        # Запросы к redmine через asyncio и aiohttp (async_redmine.py): отправка времени, проверка ключей
+        # и загрузка задач ждут ответа в одном потоке цикла событий, поэтому
+        # redmine_sync_concurrency можно поднять до redmine_pool_size без новых потоков.
+        # Работа с БД и уведомления при этом идут в redmine_async_offload_workers потоках
+        self.redmine_async = False
+        self.redmine_async_offload_workers = 4
+        # Ключ redmine, которым синхронизируется локальный каталог задач для поиска
+        # через inline режим. Если не задан, синхронизация выключена
+        self.redmine_sync_key = None
+        self.issue_sync_interval = 600
+        self.issue_sync_page_size = 100
+        # Загрузка записей времени пользователей из redmine (в том числе сделанных не через бота)
+        # раз в time_entry_backfill_interval сек., None - выключена. Записи за последние
+        # time_entry_backfill_overlap_days дней перечитываются, чтобы найти затреканные задним числом
+        self.time_entry_backfill_interval = None  # 3600
+        self.time_entry_backfill_page_size = 100
+        self.time_entry_backfill_overlap_days = 7
+        self.time_entry_backfill_batch_size = 100
+        # /export читает записи из БД пачками по export_batch_size строк и держит файл
+        # в памяти до export_spool_size байт, дальше - во временном файле на диске
+        self.export_batch_size = 1000
+        self.export_spool_size = 1024 * 1024
+        self.inline_results_limit = 20
+
+        # Через сколько секунд бездействия брошенный /track сбрасывается
+        self.track_draft_timeout = 30 * 60
+        # Как часто и какими пачками удалять неподтвержденные записи из БД
+        self.draft_sweep_interval = 60 * 60
+        self.draft_sweep_batch_size = 1000
+        # Не чаще одной правки сообщения с часами за это окно (сек.)
+        self.edit_coalesce_window = 1.0
+        # Как часто (сек.) записывать user_data и состояния диалогов в БД
+        self.persistence_flush_interval = 10
+
+        # Лимиты исходящих сообщений telegram (сообщений в секунду): общий, на личный чат и на группу.
+        # telegram_chat_burst - сколько сообщений в чат можно отправить подряд без ожидания
+        self.telegram_global_rate = 30
+        self.telegram_chat_rate = 1
+        self.telegram_chat_burst = 3
+        self.telegram_group_rate = 20 / 60
+        # Сколько уведомлений может ждать отправки, лишние отбрасываются
+        self.telegram_bulk_queue_size = 1000
+        # Сколько раз повторять отправку после ответа 429
+        self.telegram_max_retries = 3
+
+        # Напоминание затрекать время в рабочие дни, если за день затрекано меньше reminder_min_hours.
+        # Время локальное для часового пояса reminder_utc_offset, None - напоминания выключены
+        self.reminder_time = None  # '18:00'
+        self.reminder_utc_offset = 3
+        self.reminder_min_hours = 8
+        # Напоминания рассылаются в отдельном потоке пачками по reminder_batch_size раз
+        # в reminder_batch_interval сек., между сообщениями - случайная пауза до reminder_jitter сек.
+        self.reminder_batch_size = 50
+        self.reminder_batch_interval = 5
+        self.reminder_jitter = 0.2
+
+        # Метрики prometheus на http://metrics_listen:metrics_port/metrics, None - выключены.
+        # При нескольких процессах у обработчика с номером N порт metrics_port + N
+        self.metrics_port = None  # 9100
+        self.metrics_listen = '127.0.0.1'
+
+        # Записи лога складываются в очередь из log_queue_size записей и пишутся отдельным потоком
+        # в log_file (None - stderr). log_format: 'json' - одна строка JSON с контекстом
+        # обновления на запись, 'text' - обычный текст. Лишние записи при переполнении отбрасываются
+        self.log_level = 'INFO'
+        self.log_format = 'json'
+        self.log_file = None
+        self.log_queue_size = 10000
+        # Уровни отдельных логгеров
+        self.log_levels = {
+            'telegram': 'INFO',
+            'urllib3': 'WARNING',
+            'sqlalchemy.engine': 'WARNING',
+        }
+        # Не больше стольких записей в секунду ниже WARNING от этих логгеров и их потомков
+        self.log_rate_limits = {
+            'sqlalchemy.engine': 20,
+            'telegram': 20,
+            'urllib3': 20,
+        }
+
+        # Запись входящих обновлений в сжатые JSONL файлы для воспроизведения нагрузки.
+        # Идентификаторы пользователей заменяются хэшем с солью, None - запись выключена
+        self.record_updates_dir = None  # 'captures'
+        self.record_updates_salt = None
+        self.record_updates_max_bytes = 64 * 1024 * 1024
+        self.record_updates_backup_count = 10
 
         self.proxy_url = 'socks5://proxy_url:port'
         self.proxy_username = 'proxy_username'
         self.proxy_password = 'proxy_password'
 
-        self.dsn_db = 'sqlite:///sqlite.db'
\ No newline at end of file
+        # Прием обновлений через вебхук. Если webhook_url не задан, бот опрашивает telegram.
+        # Сертификат и ключ нужны, когда https обслуживает сам бот, а не прокси перед ним
+        self.webhook_url = None  # 'https://bot.task.org:8443/TOKEN'
+        self.webhook_listen = '0.0.0.0'
+        self.webhook_port = 8443
+        self.webhook_cert = None
+        self.webhook_key = None
+        self.webhook_max_connections = 40
+
+        self.dsn_db = 'sqlite:///sqlite.db'
+        # Запросы SQL в лог (уровень INFO для sqlalchemy.engine, с учетом log_rate_limits)
+        self.db_echo = False
+        self.db_pool_size = 10
+        self.db_max_overflow = 10
+        self.db_pool_pre_ping = True
+        # Применяются к каждому соединению, если база sqlite
+        self.db_sqlite_pragmas = {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+        }
\ No newline at end of file
@@ -1,12 +1,22 @@
-from typing import List
+import datetime as dt
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 
-from sqlalchemy import Column, Integer, String, Date, Float, ForeignKey, Text, Boolean
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, ForeignKey, Text, Boolean, \
+    Index, LargeBinary, and_, create_engine, event, func, or_
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker, Session
+from sqlalchemy.orm import relationship, sessionmaker, Session, contains_eager, joinedload
+from sqlalchemy.pool import QueuePool
+
+from utility import round_hours
 
 Base = declarative_base()
 
+# Статусы отправки затреканного времени в redmine
+SYNC_PENDING = 'pending'
+SYNC_DONE = 'synced'
+SYNC_FAILED = 'failed'
+
 
 class User(Base):
     __tablename__ = 'user'
@@ -44,6 +54,8 @@ class RedmineUser(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(30), nullable=False, default='')
     key = Column(String(30), nullable=False, default='')
+    # Ключ, сохраненный без проверки, пока redmine был недоступен
+    key_verified = Column(Boolean, nullable=False, default=True)
 
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', back_populates='redmine_user')
@@ -61,12 +73,25 @@ class RedmineUser(Base):
 
 class TimeEntry(Base):
     __tablename__ = 'time_entry'
+    __table_args__ = (
+        Index('ix_time_entry_user_spent_on', 'user_id', 'spent_on'),
+        Index('ix_time_entry_user_saved', 'user_id', 'saved'),
+        Index('ix_time_entry_redmine_id', 'redmine_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     spent_on = Column(Date)
     hours = Column(Float, nullable=False, default=0)
     comments = Column(Text)
     saved = Column(Boolean, nullable=False, default=False)
 
+    sync_status = Column(String(10), nullable=False, default=SYNC_PENDING)
+    sync_attempts = Column(Integer, nullable=False, default=0)
+    sync_after = Column(DateTime)
+    redmine_id = Column(Integer)
+    # Сообщение с подтверждением, которое обновляется после отправки в redmine
+    chat_id = Column(Integer)
+    message_id = Column(Integer)
+
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User')
 
@@ -80,6 +105,12 @@ class Issue(Base):
     __tablename__ = 'issue'
     id = Column(Integer, primary_key=True)
     name = Column(Text, nullable=False)
+    # Заполняются синхронизацией с redmine
+    project = Column(String(255))
+    status = Column(String(60))
+    assignee_id = Column(Integer)
+    assignee = Column(String(255))
+    updated_on = Column(DateTime)
 
     def __repr__(self) -> str:
         return 'Issue<id=%s,name=%s>' % (self.id, self.name)
@@ -88,37 +119,336 @@ class Issue(Base):
         self.name = name
 
 
-def initialize_table(engine: Engine):
-    create_tables = False
-    for model in [TelegramUser, RedmineUser, User, Issue, TimeEntry]:
-        if not engine.dialect.has_table(engine, model.__table__.name):
-            model.__table__.create(bind=engine)
-            create_tables = True
+class Watermark(Base):
+    """Отметка, до которой уже выполнена фоновая задача (например синхронизация)"""
+    __tablename__ = 'watermark'
+    name = Column(String(60), primary_key=True)
+    value = Column(DateTime, nullable=False)
 
-    if create_tables:
-        session = create_session(engine)
-        task1 = Issue('Task 1')
-        task2 = Issue('Task 2')
+    def __repr__(self) -> str:
+        return 'Watermark<name=%s,value=%s>' % (self.name, self.value)
 
-        session.add_all((task1, task2))
-        session.commit()
-        session.close()
+
+class UserReminder(Base):
+    """День, за который пользователю уже напомнили затрекать время"""
+    __tablename__ = 'user_reminder'
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    sent_on = Column(Date, nullable=False)
+
+    def __repr__(self) -> str:
+        return 'UserReminder<user_id=%s,sent_on=%s>' % (self.user_id, self.sent_on)
+
+
+class SchemaVersion(Base):
+    """Версия схемы БД, единственная строка с id = 1. См. migrations.py"""
+    __tablename__ = 'schema_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return 'SchemaVersion<version=%s>' % (self.version)
+
+
+class UserData(Base):
+    """Сохраненный user_data диспетчера telegram"""
+    __tablename__ = 'user_data'
+    user_id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self) -> str:
+        return 'UserData<user_id=%s>' % (self.user_id)
+
+
+class ConversationState(Base):
+    """Текущее состояние ConversationHandler для пользователя"""
+    __tablename__ = 'conversation_state'
+    name = Column(String(30), primary_key=True)
+    key = Column(String(60), primary_key=True)
+    state = Column(Integer, nullable=False)
+    updated_at = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return 'ConversationState<name=%s,key=%s,state=%s>' % (self.name, self.key, self.state)
+
+
+def create_engine_from_config(config) -> Engine:
+    options = dict(pool_pre_ping=config.db_pool_pre_ping)
+
+    if config.dsn_db.startswith('sqlite'):
+        # По умолчанию sqlite открывает соединение на каждую сессию и запрещает
+        # передавать его между потоками обработчиков
+        options['connect_args'] = {'check_same_thread': False}
+        if ':memory:' not in config.dsn_db and config.dsn_db.rstrip('/') != 'sqlite:':
+            options.update(poolclass=QueuePool, pool_size=config.db_pool_size,
+                           max_overflow=config.db_max_overflow)
+    else:
+        options.update(pool_size=config.db_pool_size, max_overflow=config.db_max_overflow)
+
+    engine = create_engine(config.dsn_db, **options)
+
+    if engine.dialect.name == 'sqlite' and config.db_sqlite_pragmas:
+        pragmas = config.db_sqlite_pragmas
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+            cursor.close()
+
+    return engine
+
+
+_session_factories = {}  # type: Dict[Engine, sessionmaker]
 
 
 def create_session(engine: Engine) -> Session:
-    Session = sessionmaker()
-    Session.configure(bind=engine)
-    return Session()
+    factory = _session_factories.get(engine)
+    if factory is None:
+        factory = _session_factories.setdefault(engine, sessionmaker(bind=engine))
+    return factory()
+
+
+class CachedUser(NamedTuple):
+    id: int
+    redmine_key: str
+    empty: bool
 
 
 def find_user(session: Session, telegram_id: int):
-    return session.query(User).join(TelegramUser).filter(TelegramUser.id == telegram_id).one_or_none()
+    return session.query(User).join(TelegramUser) \
+        .options(contains_eager(User.telegram_user), joinedload(User.redmine_user)) \
+        .filter(TelegramUser.id == telegram_id).one_or_none()
+
+
+def find_cached_user(session: Session, telegram_id: int) -> Optional[CachedUser]:
+    user = find_user(session, telegram_id)
+    if user is None:
+        return None
+    return CachedUser(id=user.id, redmine_key=user.redmine_user.key,
+                      empty=user.redmine_user.empty())
 
 
 def get_all_task(session: Session) -> List[Issue]:
     return session.query(Issue).all()
 
 
+def find_recent_issues(session: Session, user_id: int, limit: int) -> Dict[int, str]:
+    """Задачи, в которые пользователь трекал время, начиная с последней"""
+    rows = session.query(TimeEntry.issue_id, Issue.name) \
+        .outerjoin(Issue, Issue.id == TimeEntry.issue_id) \
+        .filter(TimeEntry.user_id == user_id, TimeEntry.saved.is_(True)) \
+        .group_by(TimeEntry.issue_id, Issue.name) \
+        .order_by(func.max(TimeEntry.id).desc()) \
+        .limit(limit)
+    return {id: name or '#{}'.format(id) for id, name in rows}
+
+
+def find_unverified_keys(session: Session, limit: int,
+                         shard: Optional[Tuple[int, int]] = None) -> List[Tuple[RedmineUser, int]]:
+    """Ключи, сохраненные без проверки, и telegram id их владельцев. shard - как в find_pending_track_ids"""
+    rows = session.query(RedmineUser, TelegramUser.id) \
+        .join(TelegramUser, TelegramUser.user_id == RedmineUser.user_id) \
+        .filter(RedmineUser.key_verified.is_(False), RedmineUser.key != '')
+    if shard is not None:
+        index, count = shard
+        rows = rows.filter(TelegramUser.id % count == index)
+    return rows.order_by(RedmineUser.id).limit(limit).all()
+
+
+def find_issue_ids(session: Session, ids: Set[int]) -> Set[int]:
+    if not ids:
+        return set()
+    return {id for id, in session.query(Issue.id).filter(Issue.id.in_(list(ids)))}
+
+
+def find_linked_redmine_ids(session: Session, ids: List[int]) -> Set[int]:
+    """Какие из записей redmine уже связаны с записями бота"""
+    if not ids:
+        return set()
+    return {id for id, in session.query(TimeEntry.redmine_id).filter(TimeEntry.redmine_id.in_(ids))}
+
+
+def add_tracks(session: Session, tracks: List[TimeEntry]) -> None:
+    session.add_all(tracks)
+    session.commit()
+
+
+def report_hours(session: Session, user_id: int, date_from: dt.date,
+                 date_to: dt.date) -> List[Tuple[dt.date, int, float]]:
+    """Сумма часов пользователя по дням и задачам, одним групповым запросом"""
+    return session.query(TimeEntry.spent_on, TimeEntry.issue_id, func.sum(TimeEntry.hours)) \
+        .filter(TimeEntry.user_id == user_id,
+                TimeEntry.saved.is_(True),
+                TimeEntry.spent_on.between(date_from, date_to)) \
+        .group_by(TimeEntry.spent_on, TimeEntry.issue_id) \
+        .order_by(TimeEntry.spent_on, TimeEntry.issue_id) \
+        .all()
+
+
+def find_undertracked_users(session: Session, day: dt.date, min_hours: float,
+                            limit: int) -> List[Tuple[int, int, float]]:
+    """
+    Пользователи с ключом redmine, которые затрекали за день меньше min_hours и
+    которым за этот день еще не напоминали: (id, telegram id, часы). Одним групповым запросом
+    """
+    hours = func.coalesce(func.sum(TimeEntry.hours), 0)
+    return session.query(User.id, TelegramUser.id, hours) \
+        .join(TelegramUser, TelegramUser.user_id == User.id) \
+        .join(RedmineUser, RedmineUser.user_id == User.id) \
+        .outerjoin(TimeEntry, and_(TimeEntry.user_id == User.id,
+                                   TimeEntry.saved.is_(True),
+                                   TimeEntry.spent_on == day)) \
+        .outerjoin(UserReminder, UserReminder.user_id == User.id) \
+        .filter(RedmineUser.key != '',
+                or_(UserReminder.sent_on.is_(None), UserReminder.sent_on < day)) \
+        .group_by(User.id, TelegramUser.id) \
+        .having(hours < min_hours) \
+        .order_by(User.id) \
+        .limit(limit) \
+        .all()
+
+
+def set_reminded(session: Session, user_ids: List[int], day: dt.date) -> None:
+    if not user_ids:
+        return
+
+    existing = {id for id, in session.query(UserReminder.user_id)
+                .filter(UserReminder.user_id.in_(user_ids))}
+    session.bulk_update_mappings(UserReminder, [{'user_id': id, 'sent_on': day}
+                                                for id in user_ids if id in existing])
+    session.bulk_insert_mappings(UserReminder, [{'user_id': id, 'sent_on': day}
+                                                for id in user_ids if id not in existing])
+
+
+def get_watermark(session: Session, name: str) -> Optional[dt.datetime]:
+    return session.query(Watermark.value).filter(Watermark.name == name).scalar()
+
+
+def set_watermark(session: Session, name: str, value: dt.datetime) -> None:
+    session.merge(Watermark(name=name, value=value))
+
+
+def upsert_issues(session: Session, issues: List[dict]) -> None:
+    """Добавляет или обновляет задачи пачкой: один запрос на поиск и по одному bulk на вставку и обновление"""
+    if not issues:
+        return
+
+    existing = {id for id, in session.query(Issue.id).filter(Issue.id.in_([issue['id'] for issue in issues]))}
+    session.bulk_update_mappings(Issue, [issue for issue in issues if issue['id'] in existing])
+    session.bulk_insert_mappings(Issue, [issue for issue in issues if issue['id'] not in existing])
+
+
+def find_backfill_users(session: Session, after_id: int, limit: int,
+                        shard: Optional[Tuple[int, int]] = None) -> List[Tuple[int, str]]:
+    """Пользователи с проверенным ключом redmine по возрастанию id: (id, ключ). shard - как в find_pending_track_ids"""
+    rows = session.query(RedmineUser.user_id, RedmineUser.key) \
+        .filter(RedmineUser.key != '',
+                RedmineUser.key_verified.is_(True),
+                RedmineUser.user_id > after_id)
+    if shard is not None:
+        index, count = shard
+        rows = rows.join(TelegramUser, TelegramUser.user_id == RedmineUser.user_id) \
+            .filter(TelegramUser.id % count == index)
+    return rows.order_by(RedmineUser.user_id).limit(limit).all()
+
+
+def upsert_time_entries(session: Session, user_id: int, entries: List[dict]) -> int:
+    """
+    Добавляет или обновляет записи пользователя из redmine по redmine_id, возвращает число новых.
+    Записи, совпадающие с еще не отправленными записями бота, пропускаются: им redmine_id
+    проставит отправка, иначе одна запись redmine попала бы в таблицу дважды
+    """
+    if not entries:
+        return 0
+
+    existing = dict(session.query(TimeEntry.redmine_id, TimeEntry.id)
+                    .filter(TimeEntry.redmine_id.in_([entry['redmine_id'] for entry in entries])))
+    new = [entry for entry in entries if entry['redmine_id'] not in existing]
+    if new:
+        # Часы сравниваются с точностью redmine: у записи бота они могли остаться неокругленными
+        pending = {(issue_id, spent_on, round_hours(hours), comments or '')
+                   for issue_id, spent_on, hours, comments
+                   in session.query(TimeEntry.issue_id, TimeEntry.spent_on, TimeEntry.hours,
+                                    TimeEntry.comments)
+                   .filter(TimeEntry.user_id == user_id,
+                           TimeEntry.saved.is_(True),
+                           TimeEntry.sync_status == SYNC_PENDING,
+                           TimeEntry.spent_on.in_({entry['spent_on'] for entry in new}))}
+        new = [entry for entry in new if (entry['issue_id'], entry['spent_on'],
+                                          round_hours(entry['hours']),
+                                          entry['comments'] or '') not in pending]
+
+    session.bulk_update_mappings(TimeEntry, [
+        {'id': existing[entry['redmine_id']], 'issue_id': entry['issue_id'],
+         'spent_on': entry['spent_on'], 'hours': entry['hours'], 'comments': entry['comments']}
+        for entry in entries if entry['redmine_id'] in existing])
+    session.bulk_insert_mappings(TimeEntry, [
+        dict(entry, user_id=user_id, saved=True, sync_status=SYNC_DONE, sync_attempts=0)
+        for entry in new])
+    return len(new)
+
+
+def iter_time_entries(session: Session, user_id: int, date_from: dt.date, date_to: dt.date,
+                      batch_size: int) -> Iterator[Tuple[dt.date, int, Optional[str], float, str,
+                                                         Optional[int], str]]:
+    """
+    Записи пользователя за период: (дата, задача, тема, часы, комментарий, id в redmine, статус).
+    Строки читаются из курсора пачками по batch_size (на postgres - курсором на стороне сервера),
+    поэтому память не зависит от их числа
+    """
+    return session.query(TimeEntry.spent_on, TimeEntry.issue_id, Issue.name, TimeEntry.hours,
+                         TimeEntry.comments, TimeEntry.redmine_id, TimeEntry.sync_status) \
+        .outerjoin(Issue, Issue.id == TimeEntry.issue_id) \
+        .filter(TimeEntry.user_id == user_id,
+                TimeEntry.saved.is_(True),
+                TimeEntry.spent_on.between(date_from, date_to)) \
+        .order_by(TimeEntry.spent_on, TimeEntry.id) \
+        .yield_per(batch_size)
+
+
+def get_issue_index_rows(session: Session) -> List[Tuple[int, str, str, str]]:
+    return session.query(Issue.id, Issue.name, Issue.project, Issue.status).all()
+
+
+def find_issue_names(session: Session, ids: Set[int]) -> Dict[int, str]:
+    if not ids:
+        return {}
+    return dict(session.query(Issue.id, Issue.name).filter(Issue.id.in_(list(ids))))
+
+
 def find_track(session: Session, id: int) -> TimeEntry:
     return session.query(TimeEntry).filter(TimeEntry.id == id).one()
 
+
+def delete_unsaved_tracks(session: Session, batch_size: int) -> int:
+    deleted = 0
+    while True:
+        ids = [id for id, in session.query(TimeEntry.id)
+               .filter(TimeEntry.saved.is_(False))
+               .limit(batch_size)]
+        if not ids:
+            return deleted
+
+        session.query(TimeEntry).filter(TimeEntry.id.in_(ids)).delete(synchronize_session=False)
+        session.commit()
+        deleted += len(ids)
+
+
+def find_pending_track_ids(session: Session, now: dt.datetime, limit: int,
+                           shard: Optional[Tuple[int, int]] = None) -> List[int]:
+    """
+    Записи, которые пора отправить в redmine. shard = (номер, число обработчиков)
+    оставляет только записи пользователей этого обработчика (см. sharding.shard_of)
+    """
+    rows = session.query(TimeEntry.id) \
+        .filter(TimeEntry.saved.is_(True),
+                TimeEntry.sync_status == SYNC_PENDING,
+                (TimeEntry.sync_after.is_(None)) | (TimeEntry.sync_after <= now))
+    if shard is not None:
+        index, count = shard
+        rows = rows.join(TelegramUser, TelegramUser.user_id == TimeEntry.user_id) \
+            .filter(TelegramUser.id % count == index)
+    rows = rows.order_by(TimeEntry.id).limit(limit)
+    return [id for id, in rows]
+
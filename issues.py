@@ -0,0 +1,187 @@
+import bisect
+import datetime as dt
+import logging
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.engine import Engine
+
+import db
+from redmine_pool import RedmineClients
+
+TOKEN_RE = re.compile(r'\w+')
+
+# (id, тема, проект, статус)
+IssueRow = Tuple[int, str, Optional[str], Optional[str]]
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+class IssueIndex:
+    """
+    Поисковый индекс задач по словам темы в памяти. Каждое слово запроса
+    ищется как префикс, результаты по словам пересекаются
+    """
+
+    def __init__(self) -> None:
+        self._issues = {}  # type: Dict[int, IssueRow]
+        self._postings = {}  # type: Dict[str, Set[int]]
+        self._tokens = []  # type: List[str]
+        self._lock = threading.Lock()
+
+    def add(self, rows: Iterable[IssueRow]) -> None:
+        with self._lock:
+            for row in rows:
+                old = self._issues.get(row[0])
+                if old is not None:
+                    for token in tokenize(old[1]):
+                        self._postings[token].discard(old[0])
+
+                self._issues[row[0]] = row
+                for token in tokenize(row[1]):
+                    ids = self._postings.get(token)
+                    if ids is None:
+                        ids = self._postings[token] = set()
+                        bisect.insort(self._tokens, token)
+                    ids.add(row[0])
+
+    def search(self, query: str, limit: int) -> List[IssueRow]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            found = None
+            for token in tokens:
+                ids = self._prefix(token)
+                if token.isdigit() and int(token) in self._issues:
+                    ids.add(int(token))
+                found = ids if found is None else found & ids
+                if not found:
+                    return []
+
+            # Сначала более новые задачи
+            return [self._issues[id] for id in sorted(found, reverse=True)[:limit]]
+
+    def __len__(self) -> int:
+        return len(self._issues)
+
+    def _prefix(self, prefix: str) -> Set[int]:
+        ids = set()
+        for i in range(bisect.bisect_left(self._tokens, prefix), len(self._tokens)):
+            token = self._tokens[i]
+            if not token.startswith(prefix):
+                break
+            ids |= self._postings[token]
+        return ids
+
+
+class IssueSync:
+    """
+    Фоновая инкрементальная синхронизация задач redmine в таблицу issue.
+    Задачи забираются страницами по возрастанию updated_on начиная с сохраненной
+    отметки, поэтому прерванная синхронизация продолжается с того же места
+    """
+
+    WATERMARK = 'issue_sync'
+
+    def __init__(self, engine: Engine, redmine_clients: RedmineClients,
+                 redmine_host: str, key: str, index: IssueIndex,
+                 logger: logging.Logger, interval: float = 600,
+                 page_size: int = 100) -> None:
+        self.engine = engine
+        self.redmine_clients = redmine_clients
+        self.redmine_host = redmine_host
+        self.key = key
+        self.index = index
+        self.logger = logger
+        self.interval = interval
+        self.page_size = page_size
+
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='issue_sync', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def load_index(self) -> None:
+        session = db.create_session(self.engine)
+        try:
+            self.index.add(db.get_issue_index_rows(session))
+        finally:
+            session.close()
+
+    def sync(self) -> int:
+        redmine = self.redmine_clients.get(self.redmine_host, self.key)
+        session = db.create_session(self.engine)
+        try:
+            watermark = db.get_watermark(session, self.WATERMARK) or dt.datetime(1970, 1, 1)
+            # Сколько задач с updated_on == watermark уже забрано на предыдущих страницах
+            offset = 0
+            synced = 0
+
+            while not self._stop.is_set():
+                page = list(redmine.issue.filter(
+                    status_id='*',
+                    updated_on='>={}'.format(watermark.strftime('%Y-%m-%dT%H:%M:%SZ')),
+                    sort='updated_on,id',
+                    limit=self.page_size,
+                    offset=offset))
+
+                rows = [self._issue_to_row(issue) for issue in page]
+                db.upsert_issues(session, rows)
+                if rows:
+                    last = rows[-1]['updated_on']
+                    offset = offset + len(rows) if last == watermark else \
+                        sum(1 for row in rows if row['updated_on'] == last)
+                    watermark = last
+                    db.set_watermark(session, self.WATERMARK, watermark)
+                session.commit()
+
+                self.index.add((row['id'], row['name'], row['project'], row['status'])
+                               for row in rows)
+                synced += len(rows)
+                if len(rows) < self.page_size:
+                    break
+
+            return synced
+        finally:
+            session.close()
+
+    @staticmethod
+    def _issue_to_row(issue) -> dict:
+        project = getattr(issue, 'project', None)
+        status = getattr(issue, 'status', None)
+        assignee = getattr(issue, 'assigned_to', None)
+        updated_on = issue.updated_on
+        if updated_on.tzinfo is not None:
+            updated_on = updated_on.astimezone(dt.timezone.utc).replace(tzinfo=None)
+
+        return {
+            'id': issue.id,
+            'name': issue.subject,
+            'project': getattr(project, 'name', None),
+            'status': getattr(status, 'name', None),
+            'assignee_id': getattr(assignee, 'id', None),
+            'assignee': getattr(assignee, 'name', None),
+            'updated_on': updated_on,
+        }
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                synced = self.sync()
+                if synced:
+                    self.logger.info('Synced %s issues from redmine', synced)
+            except Exception:
+                self.logger.exception('Failed to sync issues from redmine')
+            self._stop.wait(self.interval)
@@ -0,0 +1,204 @@
+import contextlib
+import contextvars
+import copy
+import datetime as dt
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from telegram import Update
+
+from ratelimit import TokenBucket
+
+_context = contextvars.ContextVar('log_context', default={})
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Поля, которые добавляются ко всем записям, сделанным внутри блока"""
+    token = _context.set(dict(_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def update_context(update: Update) -> dict:
+    fields = {'update_id': update.update_id}
+    if update.effective_user is not None:
+        fields['user_id'] = update.effective_user.id
+    if update.effective_chat is not None:
+        fields['chat_id'] = update.effective_chat.id
+    return fields
+
+
+def handler_context(callback: Callable) -> Callable:
+    """Обертка для instrument_dispatcher: записи обработчика помечаются его именем"""
+    name = getattr(callback, '__qualname__', repr(callback))
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        with log_context(handler=name):
+            return callback(*args, **kwargs)
+
+    return wrapper
+
+
+class ContextFilter(logging.Filter):
+    """Копирует в запись контекст потока, в котором она создана"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.context = _context.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Ограничивает частые записи ниже WARNING: для логгеров с префиксом из limits
+    проходит не больше limits[prefix] записей в секунду, остальные отбрасываются
+    до форматирования. Число отброшенных добавляется к следующей прошедшей записи
+    """
+
+    def __init__(self, limits: Dict[str, float]) -> None:
+        super().__init__()
+        self.limits = limits
+        self.dropped = 0
+        self._buckets = {prefix: TokenBucket(rate, max(rate, 1)) for prefix, rate in limits.items()}
+        self._pending = Counter()
+        self._prefixes = {}  # type: Dict[str, Optional[str]]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        prefix = self._prefix(record.name)
+        if prefix is None:
+            return True
+
+        bucket = self._buckets[prefix]
+        with self._lock:
+            if bucket.wait_time(time.monotonic()) > 0:
+                self._pending[prefix] += 1
+                self.dropped += 1
+                return False
+            bucket.take()
+            dropped = self._pending.pop(prefix, 0)
+        if dropped:
+            record.dropped = dropped
+        return True
+
+    def _prefix(self, name: str) -> Optional[str]:
+        if name not in self._prefixes:
+            # Побеждает самый длинный подходящий префикс: sqlalchemy.engine, а не sqlalchemy
+            matches = [prefix for prefix in self.limits
+                       if name == prefix or name.startswith(prefix + '.')]
+            self._prefixes[name] = max(matches, key=len, default=None)
+        return self._prefixes[name]
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, логгер, поток, текст и контекст"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': dt.datetime.fromtimestamp(record.created, dt.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        data.update(getattr(record, 'context', {}))
+        if getattr(record, 'dropped', 0):
+            data['dropped'] = record.dropped
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Не ждет места в очереди: при переполнении запись отбрасывается"""
+
+    def __init__(self, records: queue.Queue) -> None:
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляются сразу: к моменту записи объекты могут измениться.
+        # Трассировка хранится отдельно от текста, чтобы попасть в свое поле JSON
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg, record.args = message, None
+        record.exc_info, record.exc_text = None, exc_text
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """
+    Настройка логирования из Config. Потоки бота только кладут записи в
+    ограниченную очередь, а форматирует и пишет их отдельный поток.
+    Уровни задаются по модулям, частые отладочные записи (SQL, HTTP) ограничиваются
+    """
+
+    def __init__(self, config) -> None:
+        self.config = config
+        self.records = queue.Queue(config.log_queue_size)
+        self.rate_limit = RateLimitFilter(config.log_rate_limits)
+
+        self.handler = _QueueHandler(self.records)
+        self.handler.addFilter(ContextFilter())
+        self.handler.addFilter(self.rate_limit)
+
+        if config.log_file:
+            output = logging.handlers.WatchedFileHandler(config.log_file, encoding='utf-8')
+        else:
+            output = logging.StreamHandler(sys.stderr)
+        if config.log_format == 'json':
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        self.listener = logging.handlers.QueueListener(self.records, output)
+
+    def start(self) -> None:
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.config.log_level)
+
+        levels = dict(self.config.log_levels)
+        # SQL пишется через этот же конвейер, а не через echo движка
+        if self.config.db_echo:
+            levels['sqlalchemy.engine'] = 'INFO'
+        for name, level in levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        self.listener.start()
+
+    def stop(self) -> None:
+        """Дописывает записи, оставшиеся в очереди"""
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+
+    def metrics(self) -> dict:
+        return {
+            'queued': self.records.qsize(),
+            'dropped': self.handler.dropped,
+            'rate_limited': self.rate_limit.dropped,
+        }
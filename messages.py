@@ -1,10 +1,17 @@
 WELCOME_MESSAGES = 'Для помощи обратитесь к команде /help, чтобы затрекать время выберите команду /track'
-HELP_MESSAGE = 'Команда /start позволит зарегестрироватся или сменить ключ от редмайна, а с помощью команды /track можно затрекать время, выполнив пошаговые инструкции'
+HELP_MESSAGE = 'Команда /start позволит зарегестрироватся или сменить ключ от редмайна, а с помощью команды /track можно затрекать время, выполнив пошаговые инструкции.\n' \
+               'Можно и одним сообщением, по строке на запись: /track 2.5h #1234 вчера комментарий.\n' \
+               'Команда /report [week|month|YYYY-MM-DD [YYYY-MM-DD]] покажет, сколько времени затрекано,\n' \
+               'а /export с тем же периодом пришлет записи файлом CSV'
 
 START_REDMINE_SETTINGS = 'Привет! Чтобы можно было воспользоватся ботом нужно его настроить'
 SET_REDMINE_KEY = 'Пожалуйста введите ключ от redmine, который можно получить в профиле'
 DONE_REDMINE_SETTINGS = 'Настройки подключения к redmine успешно сохранены'
 INVALID_REDMINE_KEY = 'Меня не обмануть, введи правильный ключ. Для повторного ввода используй команду /start'
+DEFERRED_REDMINE_KEY = 'Redmine сейчас недоступен, поэтому ключ сохранен без проверки. Если он окажется неверным, бот сообщит'
+REJECTED_REDMINE_KEY = 'Redmine не принял сохраненный ключ. Введи правильный ключ с помощью команды /start'
+
+BUSY = 'Слишком много запросов, подожди, пока бот обработает предыдущие'
 
 NOT_FOUND_USER = 'К сожалению вы не зарегестрированы, пожалуйста перейдите на команду /start'
 
@@ -12,7 +19,20 @@ WELCOME_ENTRY_TIME = 'Бот выручит тебя, только укажи к
 SET_ISSUE = 'Сейчас я знаю:\n{}\nТеперь нужно указать в какую задачу нужно затрекать время. Но ты можешь отказатся от помощи, щелкнув на /cancel'
 SET_SPENT_ON = 'Сейчас я знаю:\n{}\nТеперь нужно указать смещение на какой день нужно затрекать время. Но ты можешь отказатся от помощи, щелкнув на /cancel'
 SET_HOURS = 'Сейчас я знаю:\n{}\nТеперь нужно добавить время, сколько хочется затрекать время. Но ты можешь отказатся от помощи, щелкнув на /cancel'
+REDMINE_UNAVAILABLE_ISSUES = '\n\nRedmine сейчас недоступен, поэтому в списке только общие задачи и те, в которые ты уже трекал время'
+UNKNOWN_ISSUE = 'Задача #{} не найдена, выбери ее кнопкой или поиском через @бота'
 SET_COMMENTS = 'Сейчас я знаю:\n{}\nТеперь нужно написать комментарий или ты можешь отказатся от помощи, щелкнув на /cancel'
 FINISH_ENTRY_TIME = 'Сейчас я знаю:\n{}\nОсталось подтвердить изменения или изменить комментарий. А также можешь отказатся от помощи, щелкнув на /cancel'
 SAVE_ENTRY_TIME = 'Бот выручит прямо сейчас:\n{}'
+SAVE_ENTRIES_TIME = 'Бот выручит прямо сейчас:\n{}\nЕсли redmine не примет какую-то запись, бот сообщит'
+TRACK_TEXT_ERROR = 'Ничего не затрекано, не получилось разобрать:\n{}\nФормат строки: 2.5h #1234 вчера комментарий'
+SYNCED_ENTRY_TIME = 'Бот выручил, время затрекано в redmine:\n{}'
+SYNC_FAILED_ENTRY_TIME = 'Redmine не принял время, попробуй затрекать его заново:\n{}'
+REPORT = 'Затреканное время с {} по {}:\n{}\nВсего часов - {:g}'
+REPORT_EMPTY = 'С {} по {} ничего не затрекано'
+REPORT_USAGE = 'Укажи период: /report week, /report month или /report 2019-01-01 2019-01-31'
+EXPORT = 'Записи с {} по {}: {}'
+EXPORT_USAGE = 'Укажи период: /export week, /export month или /export 2019-01-01 2019-01-31'
+REMIND_TRACK = 'Сегодня затрекано {:g} ч. из {:g}. Не забудь затрекать время: /track'
 ENTRY_TIME_CANCEL = 'Бот пытался помочь, но не смог. Попробуй в следующий раз'
+ENTRY_TIME_TIMEOUT = 'Бот так и не дождался ответа. Чтобы затрекать время, начни заново с /track'
@@ -0,0 +1,287 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import telegram.ext as tg
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # type: Dict[Tuple, object]
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key: Tuple, value) -> List[str]:
+        return ['{}{} {}'.format(self.name, _labels(self.labels, key), value)]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                # Счетчики по корзинам (последняя - +Inf), сумма
+                data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][i] += 1
+            data[1] += value
+
+    def _render_value(self, key: Tuple, value) -> List[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _labels(self.labels, key, 'le="{}"'.format(bound)), cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, key), total))
+        lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, key), cumulative))
+        return lines
+
+
+class _CallbackGauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, label: str,
+                 callback: Callable[[], Dict[str, float]]) -> None:
+        super().__init__(name, help, (label,))
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        with self._lock:
+            self._values = {(key,): value for key, value in self.callback().items()}
+        return super().render()
+
+
+class Registry:
+    """Набор метрик, который отдается в текстовом формате prometheus"""
+
+    def __init__(self) -> None:
+        self._metrics = []  # type: List[_Metric]
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def gauge_callback(self, name: str, help: str, label: str,
+                       callback: Callable[[], Dict[str, float]]) -> None:
+        """Метрика, значения которой при каждом запросе берутся из callback"""
+        self._add(_CallbackGauge(name, help, label, callback))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram('bot_handler_seconds', 'Время работы обработчика', ['name'])
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', 'Ошибки обработчиков', ['name', 'type'])
+HANDLER_IN_FLIGHT = REGISTRY.gauge('bot_handler_in_flight', 'Выполняющиеся обработчики', ['name'])
+TELEGRAM_SECONDS = REGISTRY.histogram('bot_telegram_request_seconds',
+                                      'Время запроса к telegram с учетом ожидания лимитов', ['name'])
+TELEGRAM_ERRORS = REGISTRY.counter('bot_telegram_errors_total', 'Ошибки запросов к telegram',
+                                   ['name', 'type'])
+TELEGRAM_IN_FLIGHT = REGISTRY.gauge('bot_telegram_in_flight', 'Выполняющиеся запросы к telegram', ['name'])
+REDMINE_SECONDS = REGISTRY.histogram('bot_redmine_request_seconds', 'Время запроса к redmine', ['name'])
+REDMINE_ERRORS = REGISTRY.counter('bot_redmine_errors_total', 'Ошибки запросов к redmine', ['name', 'type'])
+REDMINE_IN_FLIGHT = REGISTRY.gauge('bot_redmine_in_flight', 'Выполняющиеся запросы к redmine', ['name'])
+DB_QUERY_SECONDS = REGISTRY.histogram('bot_db_query_seconds', 'Время SQL запроса', ['statement'])
+DB_ERRORS = REGISTRY.counter('bot_db_errors_total', 'Ошибки SQL запросов', ['type'])
+DB_IN_FLIGHT = REGISTRY.gauge('bot_db_queries_in_flight', 'Выполняющиеся SQL запросы')
+TRACK_FUNNEL = REGISTRY.counter('bot_track_funnel_total', 'Сколько диалогов /track дошли до шага', ['step'])
+CIRCUIT_STATE = REGISTRY.gauge('bot_circuit_state', 'Состояние размыкателя: 0 - замкнут, 1 - проба, 2 - разомкнут',
+                               ['name'])
+CIRCUIT_TRANSITIONS = REGISTRY.counter('bot_circuit_transitions_total', 'Переключения размыкателя',
+                                       ['name', 'state'])
+
+
+@contextmanager
+def measure(seconds: Histogram, errors: Counter, in_flight: Gauge, name: str):
+    """Замеряет время, ошибки по типам и число одновременных вызовов"""
+    in_flight.inc(name)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        seconds.observe(time.perf_counter() - started, name)
+        in_flight.dec(name)
+
+
+def _instrument_callback(callback: Callable) -> Callable:
+    name = getattr(callback, '__qualname__', repr(callback))
+
+    @functools.wraps(callback)
+    def wrapper(*args, **kwargs):
+        with measure(HANDLER_SECONDS, HANDLER_ERRORS, HANDLER_IN_FLIGHT, name):
+            return callback(*args, **kwargs)
+
+    return wrapper
+
+
+def _instrument_handler(handler: tg.Handler, wrap: Callable[[Callable], Callable]) -> None:
+    if isinstance(handler, tg.ConversationHandler):
+        for child in handler.entry_points + handler.fallbacks:
+            _instrument_handler(child, wrap)
+        for children in handler.states.values():
+            for child in children:
+                _instrument_handler(child, wrap)
+        return
+
+    callback = getattr(handler, 'callback', None)
+    if callback is not None:
+        handler.callback = wrap(callback)
+
+
+def instrument_dispatcher(dispatcher: tg.Dispatcher,
+                          wrap: Callable[[Callable], Callable] = _instrument_callback) -> None:
+    """Оборачивает обработчики диспетчера, включая вложенные в ConversationHandler"""
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler, wrap)
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Замеряет время и ошибки всех SQL запросов движка"""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_IN_FLIGHT.inc()
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        DB_IN_FLIGHT.dec()
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started,
+                                 statement.lstrip().split(None, 1)[0].upper())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('query_started') if context.connection else None
+        if started:
+            started.pop()
+            DB_IN_FLIGHT.dec()
+        DB_ERRORS.inc(type(context.original_exception).__name__)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    server = None  # type: MetricsServer
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Отдает метрики в формате prometheus по адресу /metrics"""
+
+    daemon_threads = True
+
+    def __init__(self, listen: str, port: int, registry: Registry = REGISTRY) -> None:
+        super().__init__((listen, port), _MetricsRequestHandler)
+        self.registry = registry
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='metrics',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,156 @@
+import logging
+from typing import Callable, List, Optional
+
+from sqlalchemy import Boolean, Column, DateTime, Integer, String, Table, exists, inspect, select, \
+    true
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn
+
+import db
+from db import SchemaVersion
+
+
+def add_column(conn: Connection, table: Table, column: Column) -> None:
+    """Добавляет колонку, если ее еще нет (БД могла быть создана уже с ней)"""
+    if column.name in {c['name'] for c in inspect(conn).get_columns(table.name)}:
+        return
+    conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+        conn.dialect.identifier_preparer.format_table(table),
+        CreateColumn(column).compile(dialect=conn.dialect)))
+
+
+def create_index(conn: Connection, table: Table, name: str) -> None:
+    if name in {index['name'] for index in inspect(conn).get_indexes(table.name)}:
+        return
+    next(index for index in table.indexes if index.name == name).create(conn)
+
+
+def create_tables(conn: Connection, *tables: Table) -> None:
+    for table in tables:
+        table.create(conn, checkfirst=True)
+
+
+def baseline(conn: Connection) -> None:
+    """Таблицы первой версии бота"""
+    create_tables(conn, db.User.__table__, db.TelegramUser.__table__, db.RedmineUser.__table__,
+                  db.Issue.__table__, db.TimeEntry.__table__)
+
+
+def time_entry_sync(conn: Connection) -> None:
+    """Очередь отправки time_entry в redmine"""
+    table = db.TimeEntry.__table__
+    # Раньше записи отправлялись в redmine сразу при сохранении
+    add_column(conn, table, Column('sync_status', String(10), nullable=False,
+                                   server_default=db.SYNC_DONE))
+    add_column(conn, table, Column('sync_attempts', Integer, nullable=False, server_default='0'))
+    add_column(conn, table, Column('sync_after', DateTime))
+    add_column(conn, table, Column('redmine_id', Integer))
+    add_column(conn, table, Column('chat_id', Integer))
+    add_column(conn, table, Column('message_id', Integer))
+    create_index(conn, table, 'ix_time_entry_redmine_id')
+
+
+def bot_state(conn: Connection) -> None:
+    """user_data и состояния диалогов"""
+    create_tables(conn, db.UserData.__table__, db.ConversationState.__table__)
+
+
+def time_entry_indexes(conn: Connection) -> None:
+    """Индексы time_entry для отчетов и очистки черновиков"""
+    create_index(conn, db.TimeEntry.__table__, 'ix_time_entry_user_spent_on')
+    create_index(conn, db.TimeEntry.__table__, 'ix_time_entry_user_saved')
+
+
+def issue_sync(conn: Connection) -> None:
+    """Поля задач из redmine и отметка синхронизации"""
+    table = db.Issue.__table__
+    add_column(conn, table, Column('project', String(255)))
+    add_column(conn, table, Column('status', String(60)))
+    add_column(conn, table, Column('assignee_id', Integer))
+    add_column(conn, table, Column('assignee', String(255)))
+    add_column(conn, table, Column('updated_on', DateTime))
+    create_tables(conn, db.Watermark.__table__)
+
+
+def reminders(conn: Connection) -> None:
+    """Отметки отправленных напоминаний"""
+    create_tables(conn, db.UserReminder.__table__)
+
+
+def deferred_key_check(conn: Connection) -> None:
+    """Ключи redmine, сохраненные без проверки"""
+    add_column(conn, db.RedmineUser.__table__, Column('key_verified', Boolean, nullable=False,
+                                                      server_default=true()))
+
+
+def conversation_state_time(conn: Connection) -> None:
+    """Время изменения состояния диалога, чтобы не восстанавливать брошенные"""
+    add_column(conn, db.ConversationState.__table__, Column('updated_at', DateTime))
+
+
+def drop_placeholder_issues(conn: Connection) -> None:
+    """Задачи-заглушки, которые создавала первая версия бота"""
+    # id задач совпадают с redmine: заглушки выдавали бы себя за задачи 1 и 2, пока их
+    # не перезапишет синхронизация. Задачи, в которые уже трекали время, остаются
+    issue, time_entry = db.Issue.__table__, db.TimeEntry.__table__
+    conn.execute(issue.delete()
+                 .where(issue.c.name.in_(['Task 1', 'Task 2']))
+                 .where(issue.c.updated_on.is_(None))
+                 .where(~exists().where(time_entry.c.issue_id == issue.c.id)))
+
+
+# Порядок менять нельзя: номер миграции - ее позиция в списке
+MIGRATIONS = [
+    baseline,
+    time_entry_sync,
+    bot_state,
+    time_entry_indexes,
+    issue_sync,
+    reminders,
+    deferred_key_check,
+    conversation_state_time,
+    drop_placeholder_issues,
+]  # type: List[Callable[[Connection], None]]
+
+
+def schema_version(engine: Engine) -> Optional[int]:
+    """Версия схемы или None, если БД еще не под управлением миграций"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select([SchemaVersion.version])
+                                .where(SchemaVersion.id == 1)).scalar()
+    except DBAPIError:
+        return None
+
+
+def migrate(engine: Engine, logger: logging.Logger) -> int:
+    """
+    Доводит схему до последней версии. Если схема актуальна, это один запрос.
+    Каждая миграция выполняется в своей транзакции вместе с обновлением версии.
+    Миграции повторно применимы к БД, созданным до их появления
+    """
+    version = schema_version(engine)
+    if version == len(MIGRATIONS):
+        return version
+
+    if version is None:
+        with engine.begin() as conn:
+            create_tables(conn, SchemaVersion.__table__)
+            if conn.execute(select([SchemaVersion.version])).scalar() is None:
+                conn.execute(SchemaVersion.__table__.insert().values(id=1, version=0))
+        version = 0
+
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        with engine.begin() as conn:
+            migration(conn)
+            # Защита от одновременного запуска миграций несколькими процессами
+            updated = conn.execute(SchemaVersion.__table__.update()
+                                   .where(SchemaVersion.id == 1)
+                                   .where(SchemaVersion.version == number - 1)
+                                   .values(version=number)).rowcount
+            if updated != 1:
+                raise RuntimeError('Schema version changed during migration {}'.format(number))
+        logger.info('Applied migration %s: %s', number, migration.__doc__)
+
+    return len(MIGRATIONS)
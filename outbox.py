@@ -0,0 +1,294 @@
+import asyncio
+import datetime as dt
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import db
+from aio import EventLoopThread
+from async_redmine import AsyncRedmine
+from db import TimeEntry
+from redmine_pool import RedmineClients
+from utility import round_hours
+
+if TYPE_CHECKING:
+    from redminelib import Redmine
+
+
+def permanent_errors() -> tuple:
+    """Ошибки redmine, при которых повторная отправка не поможет"""
+    from redminelib.exceptions import AuthError, ForbiddenError, ResourceNotFoundError, \
+        ValidationError
+    return AuthError, ForbiddenError, ResourceNotFoundError, ValidationError
+
+
+class TimeEntrySubmitter:
+    """
+    Фоновая отправка затреканного времени в redmine (write-behind outbox).
+    Обработчик сохраняет TimeEntry со статусом SYNC_PENDING и сразу отвечает
+    пользователю, а этот класс пачками вычитывает такие записи и отправляет их
+    с ограниченной параллельностью и экспоненциальной задержкой между попытками
+    """
+
+    def __init__(self, engine: Engine, redmine_clients: RedmineClients,
+                 redmine_host: str, logger: logging.Logger,
+                 on_complete: Callable[[TimeEntry], None],
+                 concurrency: int = 4, batch_size: int = 50,
+                 interval: float = 5, backoff: float = 10,
+                 max_backoff: float = 3600,
+                 shard: Optional[Tuple[int, int]] = None) -> None:
+        self.engine = engine
+        self.redmine_clients = redmine_clients
+        self.redmine_host = redmine_host
+        self.logger = logger
+        self.on_complete = on_complete
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # При нескольких процессах каждый отправляет только записи своих пользователей
+        self.shard = shard
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='time_entry_submitter',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    # Будит отправку, не дожидаясь следующего интервала
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def drain(self) -> int:
+        # Пока цепь к redmine разомкнута, попытки не тратятся и задержка повтора не растет
+        if not self.redmine_clients.available(self.redmine_host):
+            return 0
+
+        ids = self._pending_ids()
+        list(self._executor.map(self.submit, ids))
+        return len(ids)
+
+    def _pending_ids(self) -> List[int]:
+        session = db.create_session(self.engine)
+        try:
+            return db.find_pending_track_ids(session, dt.datetime.utcnow(), self.batch_size,
+                                             shard=self.shard)
+        finally:
+            session.close()
+
+    def submit(self, entry_id: int) -> None:
+        session = db.create_session(self.engine)
+        try:
+            entry = self._load(session, entry_id)
+            if entry is None:
+                return
+
+            redmine = self.redmine_clients.get(self.redmine_host,
+                                               entry.user.redmine_user.key)
+            try:
+                # Предыдущая попытка могла дойти до redmine, но не успеть сохранить ответ
+                redmine_id = self._find_submitted(session, redmine, entry) \
+                    if entry.sync_attempts else None
+
+                self._count_attempt(session, entry)
+
+                if redmine_id is None:
+                    redmine_id = redmine.time_entry.create(issue_id=entry.issue_id,
+                                                           hours=entry.hours,
+                                                           spent_on=entry.spent_on,
+                                                           comments=entry.comments).id
+            except permanent_errors() as e:
+                self._reject(session, entry, e)
+                return
+            except Exception as e:
+                self._postpone(session, entry, e)
+                return
+
+            self._finish(session, entry, redmine_id)
+        finally:
+            session.close()
+
+    def _find_submitted(self, session: Session, redmine: 'Redmine',
+                        entry: TimeEntry) -> Optional[int]:
+        return self._first_unlinked(session, [
+            time_entry.id
+            for time_entry in redmine.time_entry.filter(user_id='me', issue_id=entry.issue_id,
+                                                        from_date=entry.spent_on,
+                                                        to_date=entry.spent_on)
+            if round_hours(time_entry.hours) == round_hours(entry.hours) and
+            getattr(time_entry, 'comments', '') == entry.comments])
+
+    @staticmethod
+    def _first_unlinked(session: Session, candidates: List[int]) -> Optional[int]:
+        """
+        Первая подходящая запись redmine, которую еще не забрала другая запись бота:
+        одинаковое время за один день могли затрекать несколько раз
+        """
+        linked = db.find_linked_redmine_ids(session, candidates)
+        # Соединение с БД не держится до следующего запроса к redmine
+        session.commit()
+        return next((id for id in candidates if id not in linked), None)
+
+    @staticmethod
+    def _load(session: Session, entry_id: int) -> Optional[TimeEntry]:
+        entry = db.find_track(session, entry_id)
+        if entry.sync_status != db.SYNC_PENDING:
+            return None
+        return entry
+
+    @staticmethod
+    def _count_attempt(session: Session, entry: TimeEntry) -> None:
+        entry.sync_attempts += 1
+        session.commit()
+
+    def _reject(self, session: Session, entry: TimeEntry, error: Exception) -> None:
+        self.logger.warning('Time entry %s rejected by redmine: %s', entry.id, error)
+        entry.sync_status = db.SYNC_FAILED
+        session.commit()
+        self._complete(entry)
+
+    def _postpone(self, session: Session, entry: TimeEntry, error: Exception) -> None:
+        delay = min(self.backoff * 2 ** (entry.sync_attempts - 1), self.max_backoff)
+        self.logger.warning('Time entry %s not submitted, retry in %ss: %s',
+                            entry.id, delay, error)
+        entry.sync_after = dt.datetime.utcnow() + dt.timedelta(seconds=delay)
+        session.commit()
+
+    def _finish(self, session: Session, entry: TimeEntry, redmine_id: int) -> None:
+        entry.redmine_id = redmine_id
+        entry.sync_status = db.SYNC_DONE
+        try:
+            session.commit()
+        except Exception as e:
+            # Например, ту же запись redmine успела связать с собой другая запись бота.
+            # Следующая попытка ее уже не выберет
+            session.rollback()
+            self._postpone(session, entry, e)
+            return
+        self._complete(entry)
+
+    def _complete(self, entry: TimeEntry) -> None:
+        try:
+            self.on_complete(entry)
+        except Exception:
+            self.logger.exception('Failed to notify about time entry %s', entry.id)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                submitted = self.drain()
+            except Exception:
+                self.logger.exception('Failed to drain pending time entries')
+                submitted = 0
+
+            if submitted < self.batch_size:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+
+
+class AsyncTimeEntrySubmitter(TimeEntrySubmitter):
+    """
+    Отправка через неблокирующий клиент redmine: записи пачки отправляются
+    одновременно сопрограммами в цикле событий (не больше concurrency сразу),
+    поэтому параллельность не стоит потоков. В пул потоков цикла выносится только
+    работа с БД и уведомления. Порядок шагов и обработка ошибок те же, что в submit
+    """
+
+    def __init__(self, *args, redmine: AsyncRedmine, runtime: EventLoopThread, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.redmine = redmine
+        self.runtime = runtime
+
+    def drain(self) -> int:
+        if not self.redmine_clients.available(self.redmine_host):
+            return 0
+
+        ids = self._pending_ids()
+        self.runtime.call(self.submit_all(ids))
+        return len(ids)
+
+    async def submit_all(self, ids: List[int]) -> None:
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def submit(entry_id: int) -> None:
+            async with slots:
+                await self.submit_async(entry_id)
+
+        await asyncio.gather(*(submit(entry_id) for entry_id in ids))
+
+    async def submit_async(self, entry_id: int) -> None:
+        offload = self.runtime.offload
+        session = db.create_session(self.engine)
+        # Последний шаг с БД и закрытие сессии выполняются одним вызовом, а до него
+        # каждый шаг заканчивается commit: пока идет запрос к redmine, соединение с БД
+        # не занято, иначе одновременных отправок было бы не больше размера пула
+        step, args = None, ()
+        try:
+            loaded = await offload(self._load_fields, session, entry_id)
+            if loaded is None:
+                return
+
+            entry, key, attempts, fields = loaded
+            try:
+                redmine_id = await self._find_submitted_async(session, key, fields) \
+                    if attempts else None
+
+                await offload(self._count_attempt, session, entry)
+
+                if redmine_id is None:
+                    redmine_id = (await self.redmine.create_time_entry(key, **fields))['id']
+            except permanent_errors() as e:
+                step, args = self._reject, (entry, e)
+            except Exception as e:
+                step, args = self._postpone, (entry, e)
+            else:
+                step, args = self._finish, (entry, redmine_id)
+        finally:
+            await offload(self._closing, session, step, *args)
+
+    async def _find_submitted_async(self, session: Session, key: str,
+                                    fields: dict) -> Optional[int]:
+        candidates = [
+            time_entry['id']
+            for time_entry in await self.redmine.time_entries(key, {
+                'user_id': 'me', 'issue_id': fields['issue_id'],
+                'from': fields['spent_on'], 'to': fields['spent_on']})
+            if round_hours(time_entry['hours']) == round_hours(fields['hours']) and
+            time_entry.get('comments', '') == fields['comments']]
+        return await self.runtime.offload(self._first_unlinked, session, candidates)
+
+    def _load_fields(self, session: Session,
+                     entry_id: int) -> Optional[Tuple[TimeEntry, str, int, dict]]:
+        entry = self._load(session, entry_id)
+        if entry is None:
+            return None
+
+        loaded = entry, entry.user.redmine_user.key, entry.sync_attempts, dict(
+            issue_id=entry.issue_id, hours=entry.hours,
+            spent_on=entry.spent_on, comments=entry.comments)
+        session.commit()
+        return loaded
+
+    @staticmethod
+    def _closing(session: Session, step: Optional[Callable], *args) -> None:
+        try:
+            if step is not None:
+                step(session, *args)
+        finally:
+            session.close()
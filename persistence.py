@@ -0,0 +1,160 @@
+import datetime as dt
+import json
+import logging
+import pickle
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+from sqlalchemy import or_
+from sqlalchemy.engine import Engine
+from telegram.ext import BasePersistence
+
+import db
+from db import ConversationState, UserData
+
+EMPTY_USER_DATA = pickle.dumps({})
+
+
+class LazyUserData(defaultdict):
+    """user_data, который загружает данные пользователя из БД при первом обращении"""
+
+    def __init__(self, loader: Callable[[int], dict]) -> None:
+        super().__init__(dict)
+        self.loader = loader
+
+    def __missing__(self, user_id):
+        data = self[user_id] = self.loader(user_id)
+        return data
+
+
+class SQLAlchemyPersistence(BasePersistence):
+    """
+    Хранит user_data и состояния ConversationHandler в БД бота.
+    Изменения только помечаются как грязные и записываются пачкой в flush,
+    который вызывается по интервалу из очереди задач и при остановке бота.
+    Задачи таймаута диалогов не переживают перезапуск, поэтому состояния диалогов
+    из conversation_timeouts старше их таймаута не восстанавливаются
+    """
+
+    def __init__(self, engine: Engine, logger: logging.Logger,
+                 conversation_timeouts: Optional[Dict[str, float]] = None) -> None:
+        super().__init__(store_user_data=True, store_chat_data=False,
+                         store_bot_data=False)
+        self.engine = engine
+        self.logger = logger
+        self.conversation_timeouts = conversation_timeouts or {}
+
+        self._saved_user_data = {}  # type: Dict[int, bytes]
+        self._dirty_user_data = {}  # type: Dict[int, bytes]
+        # Новое состояние и время изменения
+        self._dirty_conversations = {}  # type: Dict[Tuple[str, str], Tuple[Optional[int], dt.datetime]]
+        self._lock = threading.Lock()
+
+    def get_user_data(self) -> LazyUserData:
+        return LazyUserData(self._load_user_data)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name: str) -> Dict[Tuple, int]:
+        session = db.create_session(self.engine)
+        try:
+            timeout = self.conversation_timeouts.get(name)
+            if timeout is not None:
+                expired = session.query(ConversationState) \
+                    .filter(ConversationState.name == name,
+                            or_(ConversationState.updated_at.is_(None),
+                                ConversationState.updated_at <
+                                dt.datetime.utcnow() - dt.timedelta(seconds=timeout))) \
+                    .delete(synchronize_session=False)
+                session.commit()
+                if expired:
+                    self.logger.info('Dropped %s expired %s conversations', expired, name)
+
+            rows = session.query(ConversationState.key, ConversationState.state) \
+                .filter(ConversationState.name == name)
+            return {tuple(json.loads(key)): state for key, state in rows}
+        finally:
+            session.close()
+
+    def update_conversation(self, name: str, key: Tuple[Hashable, ...],
+                            new_state: Optional[int]) -> None:
+        with self._lock:
+            self._dirty_conversations[(name, json.dumps(key))] = new_state, dt.datetime.utcnow()
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        # Снимок делается сразу, т.к. обработчик может продолжить менять словарь
+        dump = pickle.dumps(data)
+        with self._lock:
+            if self._saved_user_data.get(user_id) != dump:
+                self._dirty_user_data[user_id] = dump
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def flush(self) -> None:
+        with self._lock:
+            user_data, self._dirty_user_data = self._dirty_user_data, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+
+        if not user_data and not conversations:
+            return
+
+        session = db.create_session(self.engine)
+        try:
+            if user_data:
+                session.query(UserData) \
+                    .filter(UserData.user_id.in_(list(user_data))) \
+                    .delete(synchronize_session=False)
+                session.bulk_insert_mappings(UserData, [
+                    {'user_id': user_id, 'data': dump}
+                    for user_id, dump in user_data.items() if dump != EMPTY_USER_DATA])
+
+            by_name = defaultdict(dict)
+            for (name, key), change in conversations.items():
+                by_name[name][key] = change
+            for name, states in by_name.items():
+                session.query(ConversationState) \
+                    .filter(ConversationState.name == name,
+                            ConversationState.key.in_(list(states))) \
+                    .delete(synchronize_session=False)
+                session.bulk_insert_mappings(ConversationState, [
+                    {'name': name, 'key': key, 'state': state, 'updated_at': updated_at}
+                    for key, (state, updated_at) in states.items() if state is not None])
+
+            session.commit()
+        except Exception:
+            session.rollback()
+            # Не записанные изменения вернутся в очередь, если их не перезаписали новые
+            with self._lock:
+                for user_id, dump in user_data.items():
+                    self._dirty_user_data.setdefault(user_id, dump)
+                for key, change in conversations.items():
+                    self._dirty_conversations.setdefault(key, change)
+            raise
+        finally:
+            session.close()
+
+        with self._lock:
+            self._saved_user_data.update(user_data)
+        self.logger.debug('Flushed %s user_data and %s conversation states',
+                          len(user_data), len(conversations))
+
+    def _load_user_data(self, user_id: int) -> dict:
+        session = db.create_session(self.engine)
+        try:
+            row = session.query(UserData.data).filter(UserData.user_id == user_id).one_or_none()
+        finally:
+            session.close()
+
+        dump = EMPTY_USER_DATA if row is None else row.data
+        with self._lock:
+            self._saved_user_data[user_id] = dump
+        return pickle.loads(dump)
@@ -0,0 +1,220 @@
+import bisect
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Hashable, List, Optional
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.utils.request import Request
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_IN_FLIGHT, TELEGRAM_SECONDS, measure
+
+# Приоритеты отправки: меньше - раньше
+INTERACTIVE = 0
+BULK = 1
+
+
+class SendDropped(TelegramError):
+    pass
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до следующего токена. 0 - токен есть"""
+        self.refill(now)
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class _Waiter:
+
+    def __init__(self, priority: int, seq: int, chat_id: Hashable) -> None:
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.granted = False
+
+    def __lt__(self, other: '_Waiter') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendLimiter:
+    """
+    Ограничивает исходящие запросы к telegram общим лимитом и лимитом на чат
+    (token bucket). Ожидающие отправки получают разрешение в порядке приоритета,
+    а чат, упершийся в свой лимит, не задерживает остальные чаты.
+    Отправки с приоритетом BULK отбрасываются, если их очередь переполнена
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float,
+                 group_rate: float, max_queue_size: int, max_retries: int,
+                 logger: logging.Logger) -> None:
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_queue_size = max_queue_size
+        self.max_retries = max_retries
+        self.logger = logger
+
+        self.queued = 0
+        self.delayed = 0
+        self.dropped = 0
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # type: Dict[Hashable, TokenBucket]
+        self._waiters = []  # type: List[_Waiter]
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    @contextmanager
+    def priority(self, priority: int):
+        """Задает приоритет отправок в текущем потоке"""
+        previous = self.current_priority()
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def current_priority(self) -> int:
+        return getattr(self._local, 'priority', INTERACTIVE)
+
+    def acquire(self, chat_id: Hashable) -> None:
+        priority = self.current_priority()
+        with self._cond:
+            now = time.monotonic()
+            if not self._waiters and self._try_take(chat_id, now):
+                return
+
+            if priority != INTERACTIVE and \
+                    sum(1 for w in self._waiters if w.priority != INTERACTIVE) >= self.max_queue_size:
+                self.dropped += 1
+                raise SendDropped('Send queue is full')
+
+            self.queued += 1
+            waiter = _Waiter(priority, next(self._seq), chat_id)
+            bisect.insort(self._waiters, waiter)
+            while not waiter.granted:
+                delay = self._grant(time.monotonic())
+                if not waiter.granted:
+                    self._cond.wait(delay)
+
+    def retry_after(self, chat_id: Hashable, retry_after: float) -> None:
+        """Telegram ответил 429: чат ставится на паузу на указанное время"""
+        with self._cond:
+            self.delayed += 1
+            self._chat_bucket(chat_id).paused_until = time.monotonic() + retry_after
+        self.logger.warning('Flood control for chat %s, retry in %s s', chat_id, retry_after)
+
+    def drop(self) -> None:
+        with self._cond:
+            self.dropped += 1
+
+    def metrics(self) -> dict:
+        with self._cond:
+            waiting = len(self._waiters)
+        return {'waiting': waiting, 'queued': self.queued,
+                'delayed': self.delayed, 'dropped': self.dropped}
+
+    def _grant(self, now: float) -> Optional[float]:
+        """Выдает разрешения ожидающим по приоритету, возвращает время до следующей попытки"""
+        delay = None
+        granted = False
+        for waiter in list(self._waiters):
+            global_wait = self._global.wait_time(now)
+            if global_wait:
+                delay = global_wait if delay is None else min(delay, global_wait)
+                break
+
+            chat_wait = self._chat_bucket(waiter.chat_id).wait_time(now)
+            if chat_wait:
+                delay = chat_wait if delay is None else min(delay, chat_wait)
+                continue
+
+            self._take(waiter.chat_id)
+            waiter.granted = granted = True
+            self._waiters.remove(waiter)
+
+        if granted:
+            self._cond.notify_all()
+        return delay
+
+    def _try_take(self, chat_id: Hashable, now: float) -> bool:
+        if self._global.wait_time(now) or self._chat_bucket(chat_id).wait_time(now):
+            return False
+        self._take(chat_id)
+        return True
+
+    def _take(self, chat_id: Hashable) -> None:
+        self._global.take()
+        self._chats[chat_id].take()
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._prune(time.monotonic())
+            # В группах telegram разрешает меньше сообщений, чем в личных чатах
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        waiting = {waiter.chat_id for waiter in self._waiters}
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if chat_id not in waiting and bucket.tokens >= bucket.capacity \
+                    and bucket.paused_until <= now:
+                del self._chats[chat_id]
+
+
+class ThrottledRequest(Request):
+    """
+    Request, который пропускает запросы к чатам (с chat_id) через SendLimiter
+    и повторяет их после ответа 429. Остальные запросы (getUpdates, getMe,
+    answerCallbackQuery) идут без ограничений
+    """
+
+    def __init__(self, limiter: SendLimiter, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.limiter = limiter
+
+    def post(self, url, data, timeout=None):
+        with measure(TELEGRAM_SECONDS, TELEGRAM_ERRORS, TELEGRAM_IN_FLIGHT, url.rsplit('/', 1)[-1]):
+            return self._throttled_post(url, data, timeout)
+
+    def _throttled_post(self, url, data, timeout):
+        chat_id = data.get('chat_id') if isinstance(data, dict) else None
+        if chat_id is None:
+            return super().post(url, data, timeout=timeout)
+
+        for attempt in itertools.count():
+            self.limiter.acquire(chat_id)
+            try:
+                return super().post(url, data, timeout=timeout)
+            except RetryAfter as e:
+                if attempt >= self.limiter.max_retries:
+                    self.limiter.drop()
+                    raise
+                self.limiter.retry_after(chat_id, e.retry_after)
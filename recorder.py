@@ -0,0 +1,135 @@
+import datetime as dt
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import IO, Iterator, List, Optional, Tuple
+
+from telegram import Update
+
+# Поля обновления, в которых лежат пользователи и чаты
+PERSON_FIELDS = ('from', 'chat', 'user', 'forward_from', 'forward_from_chat', 'sender_chat',
+                 'via_bot', 'left_chat_member', 'new_chat_members')
+NAME_FIELDS = ('first_name', 'last_name', 'username', 'title')
+# Ключ API redmine, который пользователь присылает в /start
+REDMINE_KEY_RE = re.compile(r'\b[0-9a-fA-F]{40}\b')
+
+
+class UpdateRecorder:
+    """
+    Записывает входящие обновления в сжатые JSONL файлы для последующего
+    воспроизведения. Идентификаторы пользователей и чатов заменяются стабильным
+    хэшем с солью, имена и ключи redmine вырезаются. Файл меняется после
+    max_bytes записанных данных, хранится не больше backup_count файлов
+    """
+
+    PATTERN = 'updates-*.jsonl.gz'
+
+    def __init__(self, directory: str, logger: logging.Logger, salt: Optional[str] = None,
+                 max_bytes: int = 64 * 1024 * 1024, backup_count: int = 10) -> None:
+        self.directory = directory
+        self.logger = logger
+        self.salt = salt.encode('utf-8') if salt else os.urandom(16)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._file = None  # type: Optional[IO]
+        self._written = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, update: Update) -> None:
+        try:
+            line = json.dumps({'t': time.time(), 'update': self.anonymize(update.to_dict())},
+                              ensure_ascii=False) + '\n'
+        except Exception:
+            self.logger.exception('Failed to serialize update for recording')
+            return
+
+        data = line.encode('utf-8')
+        with self._lock:
+            if self._file is None or self._written >= self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._written += len(data)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def anonymize(self, data):
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            if key in PERSON_FIELDS:
+                value = self._anonymize_person(value)
+            elif key in ('text', 'query') and isinstance(value, str):
+                value = REDMINE_KEY_RE.sub('0' * 40, value)
+            result[key] = self.anonymize(value)
+        return result
+
+    def _anonymize_person(self, person):
+        if isinstance(person, list):
+            return [self._anonymize_person(item) for item in person]
+        if not isinstance(person, dict):
+            return person
+
+        person = dict(person)
+        if isinstance(person.get('id'), int):
+            person['id'] = self._anonymize_id(person['id'])
+        for field in NAME_FIELDS:
+            if field in person:
+                person[field] = 'user{}'.format(abs(person['id'])) if field != 'title' else 'chat'
+        return person
+
+    def _anonymize_id(self, id: int) -> int:
+        # Знак сохраняется: по нему отличаются группы от личных чатов
+        digest = hmac.new(self.salt, str(abs(id)).encode('ascii'), hashlib.sha256).digest()
+        anonymized = int.from_bytes(digest[:4], 'big') % 10 ** 9 + 1
+        return -anonymized if id < 0 else anonymized
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+        # Имена файлов сортируются в порядке записи
+        path = os.path.join(self.directory,
+                            dt.datetime.now().strftime('updates-%Y%m%d-%H%M%S-%f.jsonl.gz'))
+        self._file = gzip.open(path, 'wb')
+        self._written = 0
+
+        for old in sorted(glob.glob(os.path.join(self.directory, self.PATTERN)))[:-self.backup_count]:
+            os.remove(old)
+
+
+def read_capture(paths: List[str]) -> Iterator[Tuple[float, dict]]:
+    """Записанные обновления по порядку: (время получения, обновление)"""
+    for path in paths:
+        # Если бот остановился аварийно, файл может быть оборван на середине строки
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    yield record['t'], record['update']
+            except EOFError:
+                pass
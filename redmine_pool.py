@@ -0,0 +1,196 @@
+import functools
+import logging
+import re
+import threading
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from breaker import CircuitBreaker
+from metrics import REDMINE_ERRORS, REDMINE_IN_FLIGHT, REDMINE_SECONDS, measure
+
+if TYPE_CHECKING:
+    import requests
+    from redminelib import Redmine
+
+# requests и redminelib загружаются при первом обращении к redmine, а не при старте бота
+ID_RE = re.compile(r'/\d+')
+
+
+class RedmineUnavailable(Exception):
+    """Redmine не ответил, ответил ошибкой сервера или цепь к нему разомкнута"""
+
+
+class RedmineRequestError(Exception):
+    """Запрос не удалось отправить по вине бота или пользователя, например ключ с переводом строки"""
+
+
+@functools.lru_cache(maxsize=None)
+def network_errors() -> tuple:
+    """Ошибки requests, которые значат, что redmine не ответил"""
+    from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+    return ConnectionError, Timeout, ChunkedEncodingError
+
+
+class RedmineCall:
+    """
+    Обертка запроса к redmine, общая для синхронного и асинхронного клиентов:
+    размыкатель цепи и метрики. Сетевая ошибка или таймаут внутри блока (network_errors
+    клиента) становится RedmineUnavailable, остальные ошибки - RedmineRequestError,
+    статус ответа после блока разбирает check
+    """
+
+    def __init__(self, breaker: CircuitBreaker, method: str, path: str,
+                 network_errors: tuple) -> None:
+        self.breaker = breaker
+        self.network_errors = network_errors
+        # Идентификаторы в пути заменяются, чтобы не плодить метрики на каждую запись
+        self.name = '{} {}'.format(method.upper(), ID_RE.sub('/:id', path))
+        self._measure = None
+
+    def __enter__(self) -> 'RedmineCall':
+        if not self.breaker.allow():
+            REDMINE_ERRORS.inc(self.name, 'CircuitOpen')
+            raise RedmineUnavailable('Circuit {} is open'.format(self.breaker.name))
+        self._measure = measure(REDMINE_SECONDS, REDMINE_ERRORS, REDMINE_IN_FLIGHT, self.name)
+        self._measure.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._measure.__exit__(exc_type, exc, tb)
+        if exc is None:
+            return False
+        if isinstance(exc, Exception) and not isinstance(exc, self.network_errors):
+            # Запрос не ушел в redmine, поэтому цепь к нему не размыкается: иначе
+            # несколько неверно вставленных ключей отключили бы redmine для всех
+            self.breaker.release()
+            raise RedmineRequestError(str(exc) or '{} {}'.format(self.name, exc_type.__name__)) \
+                from exc
+        # Отмена сопрограммы тоже считается ошибкой, иначе пробный запрос
+        # в half-open навсегда занял бы размыкатель
+        self.breaker.failure()
+        if isinstance(exc, Exception):
+            raise RedmineUnavailable(str(exc) or '{} {}'.format(self.name, exc_type.__name__)) \
+                from exc
+        return False
+
+    def check(self, status: int) -> None:
+        if status >= 400:
+            REDMINE_ERRORS.inc(self.name, 'HTTP{}'.format(status))
+        if status >= 500:
+            self.breaker.failure()
+            raise RedmineUnavailable('{} returned HTTP {}'.format(self.name, status))
+        # Ошибки клиента (неверный ключ, валидация) значат, что redmine работает
+        self.breaker.success()
+
+
+class _KeySession:
+    """
+    Легковесное представление общей requests.Session для одного ключа redmine.
+    Заголовки ключа подставляются в каждый запрос, поэтому сама сессия и ее пул
+    соединений разделяются между всеми пользователями хоста
+    """
+
+    def __init__(self, session: 'requests.Session', headers: Dict[str, str],
+                 params: dict, timeout: Tuple[float, float], breaker: CircuitBreaker) -> None:
+        self.session = session
+        self.headers = headers
+        self.params = params
+        self.timeout = timeout
+        self.breaker = breaker
+
+    def request(self, method, url, headers=None, params=None, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with RedmineCall(self.breaker, method, urlparse(url).path, network_errors()) as call:
+            response = self.session.request(method, url,
+                                            headers=dict(self.headers, **(headers or {})),
+                                            params=dict(self.params, **(params or {})),
+                                            **kwargs)
+        call.check(response.status_code)
+        return response
+
+
+@functools.lru_cache(maxsize=None)
+def pooled_engine() -> type:
+    """Движок python-redmine, который работает через общий пул соединений"""
+    from redminelib.engines import SyncEngine
+
+    class PooledEngine(SyncEngine):
+
+        def __init__(self, **options):
+            self.shared_session = options.pop('shared_session', None)
+            self.timeout = options.pop('timeout', None)
+            self.breaker = options.pop('breaker', None)
+            super().__init__(**options)
+
+        def create_session(self, **params):
+            if self.shared_session is None:
+                return SyncEngine.create_session(**params)
+
+            return _KeySession(self.shared_session, params.get('headers', {}),
+                               params.get('params', {}), self.timeout, self.breaker)
+
+    return PooledEngine
+
+
+class RedmineClients:
+    """
+    Реестр клиентов redmine. Для каждого хоста держит одну requests.Session с
+    keep-alive пулом соединений и размыкатель цепи, а клиентов для конкретного
+    ключа выдает поверх них. read_timeout в get задает таймаут для отдельной операции
+    """
+
+    def __init__(self, pool_size: int, connect_timeout: float,
+                 read_timeout: float, logger: logging.Logger,
+                 failure_threshold: int = 5, reset_timeout: float = 30) -> None:
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.logger = logger
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._sessions = {}  # type: Dict[str, 'requests.Session']
+        self._breakers = {}  # type: Dict[str, CircuitBreaker]
+        self._lock = threading.Lock()
+
+    def get(self, url: str, key: str, read_timeout: Optional[float] = None) -> 'Redmine':
+        from redminelib import Redmine
+
+        return Redmine(url=url, key=key, engine=pooled_engine(),
+                       shared_session=self._session(url), breaker=self.breaker(url),
+                       timeout=(self.connect_timeout, read_timeout or self.read_timeout))
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(url)
+            if breaker is None:
+                breaker = self._breakers[url] = CircuitBreaker(
+                    'redmine:{}'.format(urlparse(url).netloc), self.failure_threshold,
+                    self.reset_timeout, self.logger)
+            return breaker
+
+    def available(self, url: str) -> bool:
+        return self.breaker(url).available()
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+
+        for session in sessions:
+            session.close()
+
+    def _session(self, url: str) -> 'requests.Session':
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        with self._lock:
+            session = self._sessions.get(url)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size,
+                                      pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[url] = session
+            return session
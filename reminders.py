@@ -0,0 +1,105 @@
+import datetime as dt
+import logging
+import random
+import threading
+from typing import Optional
+
+from sqlalchemy.engine import Engine
+from telegram import Bot
+from telegram.error import TelegramError
+
+import db
+import messages as m
+from ratelimit import BULK, SendDropped, SendLimiter
+from utility import is_weekend
+
+
+class ReminderScheduler:
+    """
+    Напоминает затрекать время тем, у кого за рабочий день меньше min_hours.
+    Рассылка идет в своем потоке, чтобы паузы и ожидание лимитов отправки не
+    задерживали очередь задач бота: каждые interval секунд после времени
+    напоминания отправляется одна пачка. Кому уже напомнили, отмечается в БД
+    после каждой пачки, а завершенный день - отметкой reminders, поэтому
+    перезапуск не приводит ни к повторным, ни к пропущенным напоминаниям
+    """
+
+    WATERMARK = 'reminders'
+
+    def __init__(self, engine: Engine, bot: Bot, send_limiter: SendLimiter,
+                 logger: logging.Logger, remind_at: dt.time, utc_offset: float, min_hours: float,
+                 interval: float = 5, batch_size: int = 50, jitter: float = 0.2) -> None:
+        self.engine = engine
+        self.bot = bot
+        self.send_limiter = send_limiter
+        self.logger = logger
+        self.remind_at = remind_at
+        self.tz = dt.timezone(dt.timedelta(hours=utc_offset))
+        self.min_hours = min_hours
+        self.interval = interval
+        self.batch_size = batch_size
+        self.jitter = jitter
+        self._done_on = None  # type: Optional[dt.date]
+
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def remind(self) -> None:
+        now = dt.datetime.now(self.tz)
+        today = now.date()
+        if today == self._done_on or is_weekend(today) or now.time() < self.remind_at:
+            return
+
+        session = db.create_session(self.engine)
+        try:
+            watermark = db.get_watermark(session, self.WATERMARK)
+            if watermark is not None and watermark.date() >= today:
+                self._done_on = today
+                return
+
+            users = db.find_undertracked_users(session, today, self.min_hours, self.batch_size)
+            reminded = []
+            for user_id, telegram_id, hours in users:
+                try:
+                    with self.send_limiter.priority(BULK):
+                        self.bot.send_message(telegram_id, m.REMIND_TRACK.format(hours, self.min_hours))
+                except SendDropped:
+                    # Очередь отправки занята, остальным напомним на следующем срабатывании
+                    break
+                except TelegramError as e:
+                    # Например, пользователь заблокировал бота - повторять бесполезно
+                    self.logger.warning('Failed to remind user %s: %s', user_id, e)
+                reminded.append(user_id)
+                if self._stop.wait(random.uniform(0, self.jitter)):
+                    break
+
+            db.set_reminded(session, reminded, today)
+            if len(users) < self.batch_size and len(reminded) == len(users):
+                db.set_watermark(session, self.WATERMARK,
+                                 dt.datetime.combine(today, dt.time()))
+                self._done_on = today
+            session.commit()
+
+            if reminded:
+                self.logger.info('Reminded %s users to track time for %s', len(reminded), today)
+        finally:
+            session.close()
+
+    def _run(self) -> None:
+        # Случайный сдвиг, чтобы несколько экземпляров бота не рассылали одновременно
+        self._stop.wait(random.uniform(0, self.interval))
+        while not self._stop.is_set():
+            try:
+                self.remind()
+            except Exception:
+                self.logger.exception('Failed to send reminders')
+            self._stop.wait(self.interval)
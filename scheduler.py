@@ -0,0 +1,194 @@
+import logging
+import threading
+from collections import deque
+from queue import Queue
+from typing import Callable, Dict, Hashable
+
+import telegram.ext as tg
+from telegram import Update
+from telegram.error import TelegramError
+
+import messages as m
+from logs import log_context, update_context
+
+
+class KeyedScheduler:
+    """
+    Пул потоков, который выполняет задачи разных ключей параллельно,
+    а задачи одного ключа - строго по очереди в порядке поступления.
+    Очередь каждого ключа ограничена: при переполнении submit не ждет, а отклоняет
+    задачу, чтобы один пользователь не задерживал прием обновлений остальных
+    """
+
+    def __init__(self, workers: int, max_queue_size: int,
+                 logger: logging.Logger) -> None:
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.logger = logger
+
+        self._queues = {}  # type: Dict[Hashable, deque]
+        self._ready = Queue()  # type: Queue
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+        self._max_depth = 0
+        self._rejected = 0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name='scheduler_{}'.format(i),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        # Дожидаемся выполнения уже принятых задач
+        with self._not_full:
+            while self._queues and self._threads:
+                self._not_full.wait()
+
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> bool:
+        """Ставит задачу в очередь ключа. False - очередь ключа переполнена, задача отброшена"""
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None and len(queue) >= self.max_queue_size:
+                self._rejected += 1
+                return False
+
+            if queue is None:
+                # Ключ становится в очередь готовых только если его задачи сейчас не выполняются
+                queue = self._queues[key] = deque()
+                self._ready.put(key)
+            queue.append((fn, args))
+            self._max_depth = max(self._max_depth, len(queue))
+            return True
+
+    def metrics(self) -> dict:
+        with self._lock:
+            depths = [len(queue) for queue in self._queues.values()]
+        return {
+            'keys': len(depths),
+            'queued': sum(depths),
+            'max_depth': max(depths, default=0),
+            'max_depth_seen': self._max_depth,
+            'ready': self._ready.qsize(),
+            'rejected': self._rejected,
+        }
+
+    def _run(self) -> None:
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+
+            with self._lock:
+                fn, args = self._queues[key][0]
+
+            try:
+                fn(*args)
+            except Exception:
+                self.logger.exception('Scheduled task failed')
+
+            with self._not_full:
+                queue = self._queues[key]
+                queue.popleft()
+                if queue:
+                    # Следующая задача ключа встает в конец, чтобы не задерживать остальных
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+                self._not_full.notify_all()
+
+
+class OrderedDispatcher(tg.Dispatcher):
+    """
+    Диспетчер, который обрабатывает обновления разных пользователей параллельно,
+    а обновления одного пользователя (или чата) - последовательно. Это защищает
+    состояние ConversationHandler и user_data от гонок без run_async
+    """
+
+    def __init__(self, *args, scheduler: KeyedScheduler, recorder=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        self.recorder = recorder
+
+    def start(self, ready=None):
+        self.scheduler.start()
+        super().start(ready)
+
+    def stop(self):
+        super().stop()
+        self.scheduler.stop()
+
+    def process_update(self, update):
+        # Обновления записываются в момент получения, чтобы сохранить реальные всплески
+        if self.recorder is not None and isinstance(update, Update):
+            self.recorder.record(update)
+
+        key = self.update_key(update)
+        if key is None:
+            self._process(update)
+            return
+
+        if not self.scheduler.submit(key, self._process, update):
+            self._reject(key, update)
+
+    def _reject(self, key, update):
+        self.logger.warning('Update queue of %s %s is full, update %s dropped',
+                            key[0], key[1], update.update_id)
+        # Кнопка без ответа крутит индикатор загрузки. Ответ отправляется из пула потоков
+        # под отдельным ключом: поток диспетчера не ждет telegram, а при новой переполненной
+        # очереди ответ просто не отправится
+        if update.callback_query is not None:
+            self.scheduler.submit(('busy',) + key, self._answer_busy, update.callback_query)
+
+    def _answer_busy(self, query):
+        try:
+            query.answer(m.BUSY)
+        except TelegramError as e:
+            self.logger.warning('Failed to answer callback query: %s', e)
+
+    def _process(self, update):
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+
+        # Записи лога обработчиков получают идентификаторы обновления и пользователя
+        with log_context(**update_context(update)):
+            super().process_update(update)
+
+    def update_persistence(self, update=None):
+        # JobQueue после каждой задачи и Updater при остановке вызывают это без обновления,
+        # и PTB обходит user_data всех пользователей из чужого потока, пока обработчики
+        # меняют черновики. Поэтому такие вызовы пропускаются: снимок после каждого
+        # обновления делает сам диспетчер, а задача, которая меняет user_data (таймаут
+        # диалога), сохраняет его сама
+        if not isinstance(update, Update):
+            return
+        super().update_persistence(update)
+
+    @staticmethod
+    def update_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return 'user', update.effective_user.id
+        if update.effective_chat is not None:
+            return 'chat', update.effective_chat.id
+        return None
+
+
+def start_dispatcher(updater: tg.Updater) -> None:
+    """
+    Запускает диспетчер и очередь задач так же, как Updater.start_webhook,
+    когда обновления поступают не через Updater
+    """
+    updater.running = True
+    updater.job_queue.start()
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher').start()
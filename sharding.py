@@ -0,0 +1,247 @@
+import copy
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from typing import Any, Callable, List, NamedTuple, Optional
+
+import telegram.ext as tg
+from telegram import Bot, Update
+from telegram.utils.request import Request
+
+from recorder import UpdateRecorder
+from scheduler import OrderedDispatcher
+from webhook import start_webhook
+
+
+class Shard(NamedTuple):
+    """Процесс-обработчик: номер, число обработчиков и очередь его обновлений"""
+    index: int
+    count: int
+    updates: Any  # multiprocessing.Queue
+    parent_pid: int
+
+    @property
+    def primary(self) -> bool:
+        # Фоновые задачи, которые нельзя выполнять параллельно, идут только в первом обработчике
+        return self.index == 0
+
+
+def shard_of(update: Update, count: int) -> int:
+    """Обновления одного пользователя (или чата) всегда попадают в один обработчик"""
+    key = OrderedDispatcher.update_key(update)
+    return 0 if key is None else key[1] % count
+
+
+def shard_config(config, index: int):
+    """Настройки обработчика: общие лимиты делятся между процессами, порты не пересекаются"""
+    config = copy.copy(config)
+    config.telegram_global_rate = config.telegram_global_rate / config.worker_processes
+    config.telegram_bulk_queue_size = max(1, config.telegram_bulk_queue_size // config.worker_processes)
+    if config.metrics_port:
+        config.metrics_port += index
+    # Обновления записывает и принимает супервизор
+    config.record_updates_dir = None
+    config.webhook_url = None
+    return config
+
+
+def _run_worker(target: Callable, config, shard: Shard) -> None:
+    # Остановкой обработчиков управляет супервизор, иначе Ctrl+C в терминале
+    # остановил бы их раньше, чем им будут переданы все принятые обновления
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    target(config, shard)
+
+
+class _RoutingDispatcher(tg.Dispatcher):
+    """Диспетчер супервизора: не обрабатывает обновления, а передает их обработчикам"""
+
+    def __init__(self, *args, supervisor: 'ShardSupervisor', **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.supervisor = supervisor
+
+    def process_update(self, update):
+        if isinstance(update, Update):
+            self.supervisor.route(update)
+        else:
+            super().process_update(update)
+
+
+class ShardSupervisor:
+    """
+    Запускает worker_processes процессов-обработчиков и раздает им обновления
+    по id пользователя, поэтому состояние диалога живет в одном процессе.
+    Обработчик можно плавно перезапустить: он дорабатывает уже переданные ему
+    обновления, а новые тем временем копятся в очереди для следующего процесса.
+    SIGHUP перезапускает обработчики по одному, упавший обработчик перезапускается сам
+    """
+
+    def __init__(self, config, target: Callable, logger: logging.Logger) -> None:
+        self.config = config
+        self.target = target
+        self.logger = logger
+        self.count = config.worker_processes
+
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = []  # type: List[Any]
+        self._processes = []  # type: List[Any]
+        self._restarts = 0
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None  # type: Optional[threading.Thread]
+
+        self.recorder = None
+        if config.record_updates_dir:
+            self.recorder = UpdateRecorder(config.record_updates_dir, logger,
+                                           salt=config.record_updates_salt,
+                                           max_bytes=config.record_updates_max_bytes,
+                                           backup_count=config.record_updates_backup_count)
+
+        bot = Bot(config.token, request=Request(
+            con_pool_size=4,
+            proxy_url=config.proxy_url,
+            urllib3_proxy_kwargs={
+                'username': config.proxy_username,
+                'password': config.proxy_password,
+            }))
+        job_queue = tg.JobQueue()
+        dispatcher = _RoutingDispatcher(bot, queue.Queue(), workers=0, job_queue=job_queue,
+                                        supervisor=self)
+        job_queue.set_dispatcher(dispatcher)
+        self.updater = tg.Updater(dispatcher=dispatcher, workers=None)
+        job_queue.run_repeating(self.log_metrics, interval=60)
+
+    def route(self, update: Update) -> None:
+        if self.recorder is not None:
+            self.recorder.record(update)
+
+        index = shard_of(update, self.count)
+        data = update.to_dict()
+        # Очередь ограничена: если обработчик не успевает, прием обновлений притормаживает.
+        # Блокировка держится на время записи, чтобы обновление не попало в очередь,
+        # которую перезапуск уже заменил
+        while True:
+            with self._lock:
+                try:
+                    self._queues[index].put(data, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+    def start(self) -> None:
+        for index in range(self.count):
+            self._queues.append(self._context.Queue(self.config.worker_queue_size))
+            self._processes.append(None)
+            self._start_worker(index)
+
+        self._monitor = threading.Thread(target=self._watch, name='shard_monitor', daemon=True)
+        self._monitor.start()
+
+    def restart(self, index: int) -> None:
+        with self._restart_lock:
+            if not self._stop.is_set():
+                self._restart(index)
+
+    def restart_all(self) -> None:
+        for index in range(self.count):
+            self.logger.info('Restarting worker %s', index)
+            self.restart(index)
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+
+        with self._restart_lock:
+            for index, process in enumerate(self._processes):
+                self._send_stop(process, self._queues[index])
+            for index, process in enumerate(self._processes):
+                self._join(index, process)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            queued = [updates.qsize() for updates in self._queues]
+        return {
+            'workers': sum(1 for process in self._processes if process.is_alive()),
+            'queued': sum(queued),
+            'max_queued': max(queued, default=0),
+            'restarts': self._restarts,
+        }
+
+    def log_metrics(self, bot: Bot, job: tg.Job):
+        self.logger.info('Workers: %s', self.metrics())
+
+    def run(self) -> None:
+        self.start()
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=self.restart_all, name='shard_restart').start())
+
+        webhook = None
+        if self.config.webhook_url:
+            webhook = start_webhook(self.updater, self.config, self.logger)
+        else:
+            self.updater.start_polling()
+        # После сигнала остановки диспетчер успевает передать обработчикам все принятые обновления
+        self.updater.idle()
+
+        if webhook is not None:
+            webhook.stop()
+        self.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _restart(self, index: int) -> None:
+        updates = self._context.Queue(self.config.worker_queue_size)
+        with self._lock:
+            old, self._queues[index] = self._queues[index], updates
+        # Новый процесс запускается только после старого, чтобы не нарушить порядок обновлений
+        self._drain(index, old)
+        self._start_worker(index)
+        self._restarts += 1
+
+    def _start_worker(self, index: int) -> None:
+        shard = Shard(index, self.count, self._queues[index], os.getpid())
+        process = self._context.Process(target=_run_worker, name='worker_{}'.format(index),
+                                        args=(self.target, shard_config(self.config, index), shard))
+        process.start()
+        self._processes[index] = process
+        self.logger.info('Started worker %s (pid %s)', index, process.pid)
+
+    def _drain(self, index: int, updates) -> None:
+        process = self._processes[index]
+        self._send_stop(process, updates)
+        self._join(index, process)
+        # Если процесс упал, не прочитанные им обновления уже не нужны
+        updates.cancel_join_thread()
+
+    def _send_stop(self, process, updates) -> None:
+        if not process.is_alive():
+            return
+        try:
+            updates.put(None, timeout=self.config.worker_drain_timeout)
+        except queue.Full:
+            pass
+
+    def _join(self, index: int, process) -> None:
+        process.join(self.config.worker_drain_timeout)
+        if process.is_alive():
+            self.logger.warning('Worker %s did not stop in %ss, terminating',
+                                index, self.config.worker_drain_timeout)
+            process.kill()
+            process.join()
+        self.logger.info('Worker %s stopped with code %s', index, process.exitcode)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(1):
+            for index in range(self.count):
+                with self._restart_lock:
+                    process = self._processes[index]
+                    if process.is_alive() or self._stop.is_set():
+                        continue
+                    self.logger.warning('Worker %s exited with code %s, restarting',
+                                        index, process.exitcode)
+                    self._restart(index)
@@ -1,25 +1,45 @@
 import datetime as dt
 import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import Future
 from functools import wraps
-from typing import Dict, List
+from queue import Empty, Queue
+from typing import Callable, Dict, List, Optional, Tuple
 
 import telegram.ext as tg
-from redminelib import Redmine
-from redminelib.exceptions import AuthError
-from sqlalchemy.engine import Engine, create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import run_async, Filters
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, \
+    InputTextMessageContent
+from telegram.ext import Filters
 
 import db
+from aio import EventLoopThread
+from async_redmine import AsyncRedmine
+from backfill import TimeEntryBackfill
+from cache import IssueCache, UserCache
+from coalescer import EditCoalescer
 from config import Config
 import messages as m
-from db import initialize_table, User, find_user, TimeEntry
-from utility import build_menu, russian_date, date_from_today
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG)
+from db import User, find_user, TimeEntry
+from issues import IssueIndex, IssueSync
+from logs import LogPipeline, handler_context
+from migrations import migrate
+from metrics import REGISTRY, TRACK_FUNNEL, MetricsServer, instrument_dispatcher, instrument_engine
+from outbox import AsyncTimeEntrySubmitter, TimeEntrySubmitter
+from persistence import SQLAlchemyPersistence
+from ratelimit import BULK, SendLimiter, ThrottledRequest
+from recorder import UpdateRecorder
+from redmine_pool import RedmineClients, RedmineRequestError, RedmineUnavailable
+from reminders import ReminderScheduler
+from scheduler import KeyedScheduler, OrderedDispatcher, start_dispatcher
+from sharding import Shard, ShardSupervisor
+from track_parser import TrackParseError, parse_track_text
+from webhook import start_webhook
+from utility import build_menu, russian_date, date_from_today, period_from_args, round_hours, \
+    write_csv
 
 STAGE_SET_KEY, SET_ISSUE, SET_SPENT_ON, SET_HOURS, SAVE_ENTRY_TIME, SET_COMMENTS = range(
     6)
@@ -33,10 +53,10 @@ def create_session(f):
         session = db.create_session(self.engine)
 
         kwds['session'] = session
-        result = f(*args, **kwds)
-
-        session.close()
-        return result
+        try:
+            return f(*args, **kwds)
+        finally:
+            session.close()
 
     return wrapper
 
@@ -51,8 +71,8 @@ def inline_restriction_rm_user(f):
         self, bot, update = args
         session = kwds['session']
 
-        user = find_user(session, update.callback_query.from_user.id)
-        if user is None or user.redmine_user.empty():
+        user = self.user_cache.get(session, update.callback_query.from_user.id)
+        if user is None or user.empty:
             update.message.reply_text(m.WELCOME_MESSAGES)
             return
 
@@ -67,12 +87,22 @@ class RedmineSettingHandler:
     """
 
     def __init__(self, engine: Engine, config: Config,
-                 logger: logging.Logger) -> None:
+                 logger: logging.Logger, issue_cache: IssueCache,
+                 redmine_clients: RedmineClients, user_cache: UserCache,
+                 check_key: Callable[[str, Optional[float]], None],
+                 shard: Optional[Tuple[int, int]] = None) -> None:
         self.engine = engine
         self.logger = logger
         self.config = config
+        self.issue_cache = issue_cache
+        self.redmine_clients = redmine_clients
+        self.user_cache = user_cache
+        self.shard = shard
+        self.check_key = check_key
+
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
 
-    @run_async
     @create_session
     def start(self, bot: Bot, update: Update, session: Session):
         tg_user = update.message.from_user
@@ -84,13 +114,13 @@ class RedmineSettingHandler:
 
         session.add(user)
         session.commit()
+        self.user_cache.invalidate(tg_user.id)
 
         update.message.reply_text(m.START_REDMINE_SETTINGS)
         update.message.reply_text(m.SET_REDMINE_KEY)
 
         return STAGE_SET_KEY
 
-    @run_async
     @create_session
     def set_key(self, bot: Bot, update: Update, session: Session):
         tg_user = update.message.from_user
@@ -100,61 +130,147 @@ class RedmineSettingHandler:
             update.message.reply_text(m.NOT_FOUND_USER)
             return tg.ConversationHandler.END
 
+        from redminelib.exceptions import AuthError
+
         try:
-            redmine = Redmine(url=self.config.redmine_host,
-                              key=update.message.text)
-            redmine.auth()
-        except AuthError:
+            self.check_key(update.message.text, self.config.redmine_interactive_timeout)
+        except RedmineUnavailable as e:
+            # Ключ проверится в фоне, когда redmine снова станет доступен
+            self.logger.warning('Redmine unavailable, key of user %s saved unverified: %s',
+                                tg_user.id, e)
+            self.save_key(session, user, update.message.text, verified=False)
+            update.message.reply_text(m.DEFERRED_REDMINE_KEY)
+            update.message.reply_text(m.WELCOME_MESSAGES)
+            return tg.ConversationHandler.END
+        except (AuthError, RedmineRequestError):
+            # Ключ, который нельзя даже отправить (например с переводом строки), тоже неверный
             update.message.reply_text(m.INVALID_REDMINE_KEY)
 
+            self.issue_cache.invalidate(user.redmine_user.key)
             user.redmine_user.key = ''
 
             session.add(user.redmine_user)
             session.commit()
+            self.user_cache.invalidate(tg_user.id)
             return tg.ConversationHandler.END
 
-        user.redmine_user.key = update.message.text
-
-        session.add(user.redmine_user)
-        session.commit()
+        self.save_key(session, user, update.message.text, verified=True)
 
         update.message.reply_text(m.DONE_REDMINE_SETTINGS)
         update.message.reply_text(m.WELCOME_MESSAGES)
 
         return tg.ConversationHandler.END
 
+    def save_key(self, session: Session, user: User, key: str, verified: bool):
+        self.issue_cache.invalidate(user.redmine_user.key)
+        user.redmine_user.key = key
+        user.redmine_user.key_verified = verified
+
+        session.add(user.redmine_user)
+        session.commit()
+        self.user_cache.invalidate(user.telegram_user.id)
+
+    # Фоновая проверка отложенных ключей идет в своем потоке: запросы к redmine
+    # не должны задерживать очередь задач бота
+    def start(self, bot: Bot) -> None:
+        self._thread = threading.Thread(target=self._run, args=(bot,), name='key_verifier',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, bot: Bot) -> None:
+        while not self._stop.wait(self.config.redmine_key_check_interval):
+            try:
+                self.verify_deferred_keys(bot)
+            except Exception:
+                self.logger.exception('Failed to verify deferred redmine keys')
+
+    # Проверяет ключи, сохраненные без проверки, пока redmine был недоступен
+    @create_session
+    def verify_deferred_keys(self, bot: Bot, session: Session):
+        from redminelib.exceptions import AuthError
+
+        if not self.redmine_clients.available(self.config.redmine_host):
+            return
+
+        users = db.find_unverified_keys(session, self.config.redmine_key_check_batch_size,
+                                        shard=self.shard)
+        for redmine_user, telegram_id in users:
+            if self._stop.is_set():
+                return
+
+            rejected = False
+            try:
+                self.check_key(redmine_user.key, self.config.redmine_interactive_timeout)
+            except RedmineUnavailable:
+                return
+            except (AuthError, RedmineRequestError):
+                rejected = True
+                self.logger.info('Deferred redmine key of user %s rejected', telegram_id)
+                self.issue_cache.invalidate(redmine_user.key)
+                redmine_user.key = ''
+
+            redmine_user.key_verified = True
+            session.commit()
+            self.user_cache.invalidate(telegram_id)
+            if rejected:
+                bot.send_message(telegram_id, m.REJECTED_REDMINE_KEY)
+
     def create_tg_conversation_handler(self) -> tg.ConversationHandler:
         return tg.ConversationHandler(
             entry_points=[tg.CommandHandler('start', self.start)],
             states={
                 STAGE_SET_KEY: [tg.MessageHandler(Filters.text, self.set_key)]
             },
-            fallbacks=[]
+            fallbacks=[],
+            name='redmine_settings',
+            persistent=True,
         )
 
 
 class RedmineTrackHandler:
 
-    def __init__(self, engine, config, logger) -> None:
+    def __init__(self, engine, config, logger, issue_cache,
+                 redmine_clients, submitter, user_cache, coalescer, persistence) -> None:
         self.engine = engine
         self.config = config
         self.logger = logger
+        self.issue_cache = issue_cache
+        self.redmine_clients = redmine_clients
+        self.submitter = submitter
+        self.user_cache = user_cache
+        self.coalescer = coalescer
+        self.persistence = persistence
+
+        # Клавиатуры часов не меняются, поэтому строятся один раз
+        self.hours_markup = InlineKeyboardMarkup(build_menu(self.timedelta_buttons(), n_cols=4))
+        self.hours_done_markup = InlineKeyboardMarkup(build_menu(
+            self.timedelta_buttons(), n_cols=4,
+            footer_buttons=[InlineKeyboardButton('Готово', callback_data='Done')]))
 
-    @run_async
     @create_session
     def start(self, bot, update, user_data, session):
-        user = find_user(session, update.message.from_user.id)
-        if user is None or user.redmine_user.empty():
+        user = self.user_cache.get(session, update.message.from_user.id)
+        if user is None or user.empty:
             update.message.reply_text(m.NOT_FOUND_USER)
             return tg.ConversationHandler.END
 
+        # /track с текстом сразу создает записи, минуя пошаговые кнопки
+        command = update.message.text.split(None, 1)
+        if len(command) > 1:
+            self.track_text(update, user, command[1], session)
+            return tg.ConversationHandler.END
+
+        TRACK_FUNNEL.inc('start')
         update.message.reply_text(m.WELCOME_ENTRY_TIME)
 
-        track_task = TimeEntry()
-        track_task.user = user
-        session.add(track_task)
-        session.commit()
-        user_data['track_task_id'] = track_task.id
+        # Черновик живет только в user_data, в БД запись попадает при подтверждении
+        user_data.clear()
+        user_data['user_id'] = user.id
 
         buttons = [InlineKeyboardButton(russian_date(d), callback_data=str(d))
                    for d in date_from_today(range(0, -8, -1))]
@@ -166,7 +282,6 @@ class RedmineTrackHandler:
 
         return SET_SPENT_ON
 
-    @run_async
     @create_session
     def spent_on(self, bot, update, user_data, session):
         tg_message = update.callback_query.message
@@ -174,44 +289,74 @@ class RedmineTrackHandler:
         user_data['spent_on'] = dt.datetime.strptime(update.callback_query.data,
                                                      '%Y-%m-%d').date()
 
-        user = find_user(session, update.effective_user.id)
-        if user is None or user.redmine_user.empty():
+        user = self.user_cache.get(session, update.effective_user.id)
+        if user is None or user.empty:
             tg_message.reply_text(m.NOT_FOUND_USER)
             return tg.ConversationHandler.END
 
-        redmine = Redmine(url=self.config.redmine_host,
-                          key=user.redmine_user.key)
-
-        issues = self.config.redmine_general_issue
-        for issue in redmine.auth().issues:
-            issues[issue.id] = issue.subject
+        issues, degraded = self.user_issues(session, user)
         user_data['issues'] = issues
 
         buttons = [InlineKeyboardButton(name, callback_data=str(id)) for
                    id, name in issues.items()]
         reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=1))
         bot.edit_message_text(
-            m.SET_ISSUE.format(self.track_task_to_str(user_data)),
+            m.SET_ISSUE.format(self.track_task_to_str(user_data)) +
+            (m.REDMINE_UNAVAILABLE_ISSUES if degraded else ''),
             chat_id=tg_message.chat.id,
             message_id=tg_message.message_id,
             reply_markup=reply_markup)
+        TRACK_FUNNEL.inc('spent_on')
         return SET_ISSUE
 
-    @run_async
+    def user_issues(self, session: Session, user: db.CachedUser) -> Tuple[Dict[int, str], bool]:
+        """
+        Общие задачи и задачи пользователя из redmine. Если redmine недоступен -
+        общие задачи и те, в которые пользователь уже трекал время (второй элемент - True)
+        """
+        issues = dict(self.config.redmine_general_issue)
+        try:
+            issues.update(self.issue_cache.get(user.redmine_key))
+            return issues, False
+        except RedmineUnavailable as e:
+            self.logger.warning('Redmine unavailable, showing local issues: %s', e)
+            issues.update(db.find_recent_issues(session, user.id, self.config.redmine_degraded_issues))
+            return issues, True
+
     def issue(self, bot, update, user_data):
         tg_message = update.callback_query.message
 
-        issues = user_data.pop('issues')
-        user_data['issue_id'] = int(update.callback_query.data)
-        user_data['issue_name'] = issues[user_data['issue_id']]
+        issue_id = int(update.callback_query.data)
+        return self.select_issue(bot, tg_message.chat.id, tg_message.message_id, user_data,
+                                 issue_id, user_data['issues'][issue_id])
+
+    # Задача, выбранная через inline поиск: результат поиска присылает сообщение "#1234 тема"
+    @create_session
+    def issue_text(self, bot, update, user_data, session):
+        issue_id = int(update.message.text.split(None, 1)[0][1:])
+
+        name = user_data['issues'].get(issue_id) or \
+            db.find_issue_names(session, {issue_id}).get(issue_id)
+        if name is None:
+            update.message.reply_text(m.UNKNOWN_ISSUE.format(issue_id))
+            return SET_ISSUE
+
+        return self.select_issue(bot, update.message.chat.id, user_data['message_id'], user_data,
+                                 issue_id, name)
+
+    def select_issue(self, bot, chat_id: int, message_id: int, user_data: dict,
+                     issue_id: int, name: str):
+        user_data.pop('issues')
+        user_data['issue_id'] = issue_id
+        user_data['issue_name'] = name
 
         bot.edit_message_text(
             m.SET_COMMENTS.format(self.track_task_to_str(user_data)),
-            chat_id=tg_message.chat.id,
-            message_id=tg_message.message_id)
+            chat_id=chat_id,
+            message_id=message_id)
+        TRACK_FUNNEL.inc('issue')
         return SET_COMMENTS
 
-    @run_async
     def comment(self, bot, update, user_data):
         tg_message = update.message
 
@@ -220,12 +365,12 @@ class RedmineTrackHandler:
         bot.delete_message(chat_id=update.message.chat.id,
                            message_id=user_data['message_id'])
 
-        buttons = build_menu(self.timedelta_buttons(), n_cols=4)
         message = update.message.reply_text(
             m.SET_HOURS.format(self.track_task_to_str(user_data)),
-            reply_markup=InlineKeyboardMarkup(buttons))
+            reply_markup=self.hours_markup)
         user_data['message_id'] = message.message_id
 
+        TRACK_FUNNEL.inc('comment')
         return SET_HOURS
 
     def timedelta_buttons(self) -> List[InlineKeyboardButton]:
@@ -234,91 +379,157 @@ class RedmineTrackHandler:
         buttons.append(InlineKeyboardButton('Сброс', callback_data='Reset'))
         return buttons
 
-    @run_async
     def add_hours(self, bot, update, user_data):
         tg_message = update.callback_query.message
 
-        user_data.setdefault('hours', 0.0)
-        user_data['hours'] += float(update.callback_query.data)
+        # Сумма нажатий 0.1 накапливает ошибку float, а redmine вернет часы округленными
+        user_data['hours'] = round_hours(user_data.get('hours', 0.0) +
+                                         float(update.callback_query.data))
 
-        buttons = build_menu(self.timedelta_buttons(), n_cols=4,
-                             footer_buttons=[InlineKeyboardButton('Готово',
-                                                                  callback_data='Done')])
-        bot.edit_message_text(
-            m.SET_HOURS.format(self.track_task_to_str(user_data)),
-            chat_id=tg_message.chat.id,
-            message_id=tg_message.message_id,
-            reply_markup=InlineKeyboardMarkup(buttons))
+        # Быстрые нажатия склеиваются в одну правку сообщения
+        self.coalescer.edit(tg_message.chat.id, tg_message.message_id,
+                            m.SET_HOURS.format(self.track_task_to_str(user_data)),
+                            self.hours_done_markup)
         return SET_HOURS
 
-    @run_async
     def reset_hours(self, bot, update, user_data):
         tg_message = update.callback_query.message
 
         user_data['hours'] = 0
 
-        buttons = build_menu(self.timedelta_buttons(), n_cols=4)
-        bot.edit_message_text(
-            m.SET_HOURS.format(self.track_task_to_str(user_data)),
-            chat_id=tg_message.chat.id,
-            message_id=tg_message.message_id,
-            reply_markup=InlineKeyboardMarkup(buttons))
+        self.coalescer.edit(tg_message.chat.id, tg_message.message_id,
+                            m.SET_HOURS.format(self.track_task_to_str(user_data)),
+                            self.hours_markup)
         return SET_HOURS
 
-    @run_async
     @create_session
     def done(self, bot, update, user_data, session):
 
-        if 'track_task_id' not in user_data:
-            return tg.ConversationHandler.END
-
-        entry_time = db.find_track(session, user_data['track_task_id'])
-        if entry_time.saved is True:
+        if 'user_id' not in user_data or 'issue_id' not in user_data:
             return tg.ConversationHandler.END
 
         tg_message = update.callback_query.message
 
-        track_task = entry_time
+        track_task = TimeEntry()
+        track_task.user_id = user_data['user_id']
         track_task.issue_id = user_data['issue_id']
         track_task.spent_on = user_data['spent_on']
-        track_task.hours = user_data['hours']
+        track_task.hours = round_hours(user_data['hours'])
         track_task.comments = user_data.get('comment', 'Default bot comments')
         track_task.saved = True
+        # В redmine время отправится в фоне, после чего сообщение будет обновлено
+        track_task.sync_status = db.SYNC_PENDING
+        track_task.chat_id = tg_message.chat.id
+        track_task.message_id = tg_message.message_id
+
+        db.add_tracks(session, [track_task])
+
+        # Отложенная правка часов не должна перезаписать подтверждение
+        self.coalescer.edit(tg_message.chat.id, tg_message.message_id,
+                            m.SAVE_ENTRY_TIME.format(self.track_task_to_str(user_data)),
+                            flush=True)
+        self.coalescer.forget(tg_message.chat.id, tg_message.message_id)
+        user_data.clear()
 
-        redmine = Redmine(url=self.config.redmine_host,
-                          key=track_task.user.redmine_user.key)
-        redmine.time_entry.create(issue_id=track_task.issue_id,
-                                  hours=track_task.hours,
-                                  spent_on=track_task.spent_on,
-                                  comments=track_task.comments)
+        TRACK_FUNNEL.inc('done')
+        self.submitter.notify()
+        return tg.ConversationHandler.END
 
-        session.add(track_task)
-        session.commit()
+    def track_text(self, update: Update, user: db.CachedUser, text: str,
+                   session: Session):
+        try:
+            lines = parse_track_text(text)
+        except TrackParseError as e:
+            update.message.reply_text(m.TRACK_TEXT_ERROR.format(e))
+            return
 
-        bot.edit_message_text(
-            m.SAVE_ENTRY_TIME.format(self.track_task_to_str(user_data)),
-            chat_id=tg_message.chat.id,
-            message_id=tg_message.message_id)
-        user_data.clear()
-        return tg.ConversationHandler.END
+        issues, _ = self.user_issues(session, user)
+        unknown = {line.issue_id for line in lines} - set(issues)
+        unknown -= db.find_issue_ids(session, unknown)
+        if unknown:
+            update.message.reply_text(m.TRACK_TEXT_ERROR.format('\n'.join(
+                '{}: неизвестная задача #{}'.format(line.line, line.issue_id)
+                for line in lines if line.issue_id in unknown)))
+            return
 
-    @run_async
-    @create_session
-    def cancel(self, bot, update, user_data, session):
+        entries = []
+        for line in lines:
+            track_task = TimeEntry()
+            track_task.user_id = user.id
+            track_task.issue_id = line.issue_id
+            track_task.spent_on = line.spent_on
+            track_task.hours = line.hours
+            track_task.comments = line.comments or 'Default bot comments'
+            track_task.saved = True
+            track_task.sync_status = db.SYNC_PENDING
+            # Об ошибке отправки по такой записи бот напишет отдельным сообщением
+            track_task.chat_id = update.message.chat.id
+            entries.append(track_task)
+        db.add_tracks(session, entries)
+
+        update.message.reply_text(m.SAVE_ENTRIES_TIME.format(''.join(
+            self.track_task_to_str({
+                'issue_name': issues.get(line.issue_id, '#{}'.format(line.issue_id)),
+                'spent_on': line.spent_on,
+                'hours': line.hours,
+                'comment': line.comments or 'Default bot comments',
+            }) for line in lines)))
+
+        TRACK_FUNNEL.inc('text')
+        self.submitter.notify()
+
+    # Обновляет сообщение с подтверждением, когда время отправлено в redmine
+    def time_entry_synced(self, bot: Bot, entry: TimeEntry):
+        if entry.message_id is None:
+            if entry.chat_id is not None and entry.sync_status == db.SYNC_FAILED:
+                bot.send_message(entry.chat_id, m.SYNC_FAILED_ENTRY_TIME.format(
+                    self.track_task_to_str(self.entry_to_track(entry))))
+            return
 
-        if 'track_task_id' in user_data:
-            track_task = db.find_track(session, user_data['track_task_id'])
-            session.delete(track_task)
-            session.commit()
+        text = m.SYNCED_ENTRY_TIME if entry.sync_status == db.SYNC_DONE else m.SYNC_FAILED_ENTRY_TIME
+        bot.edit_message_text(text.format(self.track_task_to_str(self.entry_to_track(entry))),
+                              chat_id=entry.chat_id,
+                              message_id=entry.message_id)
+
+    @staticmethod
+    def entry_to_track(entry: TimeEntry) -> dict:
+        return {
+            'issue_name': '#{}'.format(entry.issue_id),
+            'spent_on': entry.spent_on,
+            'hours': entry.hours,
+            'comment': entry.comments,
+        }
+
+    def cancel(self, bot, update, user_data):
 
         if 'message_id' in user_data:
+            self.coalescer.forget(update.message.chat.id, user_data['message_id'])
             bot.delete_message(chat_id=update.message.chat.id,
                                message_id=user_data['message_id'])
-            user_data.clear()
+        user_data.clear()
 
         update.message.reply_text(m.ENTRY_TIME_CANCEL)
+        TRACK_FUNNEL.inc('cancel')
         return tg.ConversationHandler.END
 
+    # Вызывается, когда пользователь бросил /track и истек conversation_timeout
+    def timeout(self, bot, update, user_data):
+        if 'message_id' in user_data:
+            self.coalescer.edit(update.effective_chat.id, user_data['message_id'],
+                                m.ENTRY_TIME_TIMEOUT, flush=True)
+            self.coalescer.forget(update.effective_chat.id, user_data['message_id'])
+        user_data.clear()
+        # Таймаут срабатывает в очереди задач, после которой диспетчер user_data не сохраняет
+        self.persistence.update_user_data(update.effective_user.id, user_data)
+        TRACK_FUNNEL.inc('timeout')
+
+    # Удаляет неподтвержденные записи, которые раньше оставались от брошенных /track
+    @create_session
+    def sweep_drafts(self, bot, job, session):
+        deleted = db.delete_unsaved_tracks(session, self.config.draft_sweep_batch_size)
+        if deleted:
+            self.logger.info('Deleted %s abandoned time entries', deleted)
+
     def track_task_to_str(self, user_data):
         track = list()
 
@@ -346,63 +557,481 @@ class RedmineTrackHandler:
                 tg.CommandHandler('track', self.start, pass_user_data=True)],
             states={
                 SET_SPENT_ON: [tg.CallbackQueryHandler(self.spent_on, pattern='^\d{4}-\d{2}-\d{2}$', pass_user_data=True)],
-                SET_ISSUE: [tg.CallbackQueryHandler(self.issue, pattern='^\d+$', pass_user_data=True)],
+                SET_ISSUE: [tg.CallbackQueryHandler(self.issue, pattern='^\d+$', pass_user_data=True),
+                            tg.MessageHandler(Filters.regex(r'^#\d+(\s|$)'), self.issue_text,
+                                              pass_user_data=True)],
                 SET_COMMENTS: [tg.MessageHandler(Filters.text, self.comment, pass_user_data=True)],
                 SET_HOURS: [
                     tg.CallbackQueryHandler(self.add_hours, pattern='^[\\d.]+$', pass_user_data=True),
                     tg.CallbackQueryHandler(self.reset_hours, pattern='^Reset$', pass_user_data=True)],
+                tg.ConversationHandler.TIMEOUT: [
+                    tg.MessageHandler(Filters.all, self.timeout, pass_user_data=True),
+                    tg.CallbackQueryHandler(self.timeout, pass_user_data=True)],
             },
             fallbacks=[tg.CallbackQueryHandler(self.done, pattern='^Done$', pass_user_data=True),
                        tg.CommandHandler('cancel', self.cancel, pass_user_data=True)],
+            conversation_timeout=self.config.track_draft_timeout,
+            name='track',
+            persistent=True,
         )
 
 
-class BotTracking:
+class ReportHandler:
 
-    def __init__(self, config: Config, engine: Engine):
-        self.updater = tg.Updater(config.token, workers=1, request_kwargs={
-            'proxy_url': config.proxy_url,
-            'urllib3_proxy_kwargs': {
-                'username': config.proxy_username,
-                'password': config.proxy_password,
-            },
-        })
+    def __init__(self, engine, config, logger, user_cache) -> None:
+        self.engine = engine
+        self.config = config
+        self.logger = logger
+        self.user_cache = user_cache
+
+    @create_session
+    def report(self, bot, update, args, session):
+        user = self.user_cache.get(session, update.message.from_user.id)
+        if user is None:
+            update.message.reply_text(m.NOT_FOUND_USER)
+            return
 
+        period = period_from_args(args)
+        if period is None:
+            update.message.reply_text(m.REPORT_USAGE)
+            return
+
+        rows = db.report_hours(session, user.id, *period)
+        if not rows:
+            update.message.reply_text(m.REPORT_EMPTY.format(*period))
+            return
+
+        names = dict(self.config.redmine_general_issue)
+        names.update(db.find_issue_names(session, {issue_id for _, issue_id, _ in rows} - set(names)))
+
+        lines = []
+        last_date = None
+        for spent_on, issue_id, hours in rows:
+            if spent_on != last_date:
+                lines.append('{}:'.format(russian_date(spent_on)))
+                last_date = spent_on
+            lines.append('    {} - {:g}'.format(names.get(issue_id, '#{}'.format(issue_id)), hours))
+
+        update.message.reply_text(m.REPORT.format(period[0], period[1], '\n'.join(lines),
+                                                  sum(hours for _, _, hours in rows)))
+
+    def create_tg_handler(self) -> tg.CommandHandler:
+        return tg.CommandHandler('report', self.report, pass_args=True)
+
+
+class ExportHandler:
+    HEADER = ('spent_on', 'issue_id', 'issue', 'hours', 'comments', 'redmine_id', 'sync_status')
+
+    def __init__(self, engine, config, logger, user_cache) -> None:
+        self.engine = engine
+        self.config = config
+        self.logger = logger
+        self.user_cache = user_cache
+
+    # Записи за период файлом CSV. Строки идут из курсора БД в файл, который
+    # выше export_spool_size уходит на диск, поэтому все записи в памяти не собираются
+    @create_session
+    def export(self, bot, update, args, session):
+        user = self.user_cache.get(session, update.message.from_user.id)
+        if user is None:
+            update.message.reply_text(m.NOT_FOUND_USER)
+            return
+
+        period = period_from_args(args)
+        if period is None:
+            update.message.reply_text(m.EXPORT_USAGE)
+            return
+
+        names = dict(self.config.redmine_general_issue)
+        rows = ((spent_on, issue_id, names.get(issue_id) or name or '', hours, comments or '',
+                 redmine_id or '', sync_status)
+                for spent_on, issue_id, name, hours, comments, redmine_id, sync_status
+                in db.iter_time_entries(session, user.id, *period, self.config.export_batch_size))
+
+        with tempfile.SpooledTemporaryFile(max_size=self.config.export_spool_size) as file:
+            count = write_csv(file, self.HEADER, rows)
+            # Соединение с БД не нужно на время загрузки файла в telegram
+            session.close()
+            if not count:
+                update.message.reply_text(m.REPORT_EMPTY.format(*period))
+                return
+
+            file.seek(0)
+            update.message.reply_document(file, filename='time_entries_{}_{}.csv'.format(*period),
+                                          caption=m.EXPORT.format(period[0], period[1], count))
+
+    def create_tg_handler(self) -> tg.CommandHandler:
+        return tg.CommandHandler('export', self.export, pass_args=True)
+
+
+class IssueSearchHandler:
+
+    def __init__(self, engine, config, logger, user_cache, issue_index) -> None:
+        self.engine = engine
+        self.config = config
+        self.logger = logger
+        self.user_cache = user_cache
+        self.issue_index = issue_index
+
+    # Поиск задач из локального каталога через inline режим: @bot login bug.
+    # Выбранная задача приходит сообщением "#1234 тема" и подставляется в пошаговый /track
+    # на шаге выбора задачи. Это не команда, поэтому само по себе время не трекается
+    @create_session
+    def inline_query(self, bot, update, session):
+        query = update.inline_query
+
+        # Каталог синхронизируется общим ключом, поэтому показываем его только своим
+        user = self.user_cache.get(session, query.from_user.id)
+        if user is None or user.empty:
+            query.answer([], cache_time=0, is_personal=True)
+            return
+
+        results = [
+            InlineQueryResultArticle(
+                id=str(id),
+                title='#{} {}'.format(id, name),
+                description=' / '.join(filter(None, (project, status))),
+                input_message_content=InputTextMessageContent('#{} {}'.format(id, name)))
+            for id, name, project, status in
+            self.issue_index.search(query.query, self.config.inline_results_limit)]
+        query.answer(results, cache_time=0, is_personal=True)
+
+    def create_tg_handler(self) -> tg.InlineQueryHandler:
+        return tg.InlineQueryHandler(self.inline_query)
+
+
+class BotTracking:
+
+    def __init__(self, config: Config, engine: Engine, bot: Optional[Bot] = None,
+                 shard: Optional[Shard] = None):
         self.config = config
         self.engine = engine
         self.logger = logging.getLogger(__name__)
+        # Процесс-обработчик под управлением супервизора или весь бот в одном процессе
+        self.shard = shard
+        primary = shard is None or shard.primary
+
+        # Обновления разных пользователей обрабатываются параллельно, одного - по порядку
+        self.scheduler = KeyedScheduler(workers=config.workers,
+                                        max_queue_size=config.max_user_queue_size,
+                                        logger=self.logger)
+        # Исходящие сообщения укладываются в лимиты telegram, ответы пользователю - в первую очередь
+        self.send_limiter = SendLimiter(global_rate=config.telegram_global_rate,
+                                        chat_rate=config.telegram_chat_rate,
+                                        chat_burst=config.telegram_chat_burst,
+                                        group_rate=config.telegram_group_rate,
+                                        max_queue_size=config.telegram_bulk_queue_size,
+                                        max_retries=config.telegram_max_retries,
+                                        logger=self.logger)
+        if bot is None:
+            bot = Bot(config.token, request=ThrottledRequest(
+                self.send_limiter,
+                con_pool_size=config.workers + 4,
+                proxy_url=config.proxy_url,
+                urllib3_proxy_kwargs={
+                    'username': config.proxy_username,
+                    'password': config.proxy_password,
+                }))
+        # user_data и состояния диалогов переживают перезапуск бота
+        self.persistence = SQLAlchemyPersistence(
+            engine, self.logger, conversation_timeouts={'track': config.track_draft_timeout})
+        # Запись входящих обновлений для воспроизведения нагрузки (benchmarks.replay)
+        self.recorder = None
+        if config.record_updates_dir:
+            self.recorder = UpdateRecorder(config.record_updates_dir, self.logger,
+                                           salt=config.record_updates_salt,
+                                           max_bytes=config.record_updates_max_bytes,
+                                           backup_count=config.record_updates_backup_count)
+        job_queue = tg.JobQueue()
+        dispatcher = OrderedDispatcher(bot, Queue(),
+                                       workers=0, job_queue=job_queue,
+                                       persistence=self.persistence,
+                                       scheduler=self.scheduler,
+                                       recorder=self.recorder)
+        job_queue.set_dispatcher(dispatcher)
+        self.updater = tg.Updater(dispatcher=dispatcher, workers=None)
+        job_queue.run_repeating(self.log_metrics, interval=60)
+        job_queue.run_repeating(self.flush_persistence,
+                                interval=config.persistence_flush_interval)
+
+        self.redmine_clients = RedmineClients(
+            pool_size=config.redmine_pool_size,
+            connect_timeout=config.redmine_connect_timeout,
+            read_timeout=config.redmine_read_timeout,
+            logger=self.logger,
+            failure_threshold=config.redmine_breaker_failures,
+            reset_timeout=config.redmine_breaker_reset_timeout)
+        # Запросы к redmine через asyncio: ожидание ответов не занимает потоки
+        self.runtime = None
+        self.async_redmine = None
+        if config.redmine_async:
+            self.runtime = EventLoopThread('redmine_loop', config.redmine_async_offload_workers,
+                                           self.logger)
+            self.async_redmine = AsyncRedmine(config.redmine_host,
+                                              pool_size=config.redmine_pool_size,
+                                              connect_timeout=config.redmine_connect_timeout,
+                                              read_timeout=config.redmine_read_timeout,
+                                              breaker=self.redmine_clients.breaker(config.redmine_host))
+        self.user_cache = UserCache(maxsize=config.user_cache_size)
+        self.issue_cache = IssueCache(self.load_issues,
+                                      ttl=config.redmine_issue_cache_ttl,
+                                      maxsize=config.redmine_issue_cache_size,
+                                      logger=self.logger,
+                                      async_loader=self.load_issues_async if self.runtime else None)
 
         dp = self.updater.dispatcher
 
-        rm_setting_handler = RedmineSettingHandler(engine, self.config,
-                                                   self.logger).create_tg_conversation_handler()
-        dp.add_handler(rm_setting_handler)
-
-        rm_task_handler = RedmineTrackHandler(engine, self.config,
-                                              self.logger).create_tg_conversation_handler()
+        setting_handler = RedmineSettingHandler(engine, self.config,
+                                                self.logger,
+                                                self.issue_cache,
+                                                self.redmine_clients,
+                                                self.user_cache,
+                                                self.check_key,
+                                                shard=(shard.index, shard.count) if shard else None)
+        dp.add_handler(setting_handler.create_tg_conversation_handler())
+        # Каждый обработчик проверяет ключи своих пользователей: кэш пользователей у него свой
+        self.setting_handler = setting_handler
+
+        submitter_class, options = TimeEntrySubmitter, {}
+        if self.runtime is not None:
+            submitter_class = AsyncTimeEntrySubmitter
+            options = dict(redmine=self.async_redmine, runtime=self.runtime)
+        self.submitter = submitter_class(engine, self.redmine_clients,
+                                         config.redmine_host, self.logger,
+                                         on_complete=self.time_entry_synced,
+                                         concurrency=config.redmine_sync_concurrency,
+                                         batch_size=config.redmine_sync_batch_size,
+                                         interval=config.redmine_sync_interval,
+                                         backoff=config.redmine_sync_backoff,
+                                         shard=(shard.index, shard.count) if shard else None,
+                                         **options)
+
+        self.track_handler = RedmineTrackHandler(engine, self.config,
+                                                 self.logger,
+                                                 self.issue_cache,
+                                                 self.redmine_clients,
+                                                 self.submitter,
+                                                 self.user_cache,
+                                                 EditCoalescer(self.updater.bot,
+                                                               config.edit_coalesce_window,
+                                                               self.logger),
+                                                 self.persistence)
+        rm_task_handler = self.track_handler.create_tg_conversation_handler()
         dp.add_handler(rm_task_handler)
+        if primary:
+            job_queue.run_repeating(self.track_handler.sweep_drafts,
+                                    interval=config.draft_sweep_interval, first=0)
+
+        dp.add_handler(ReportHandler(engine, self.config, self.logger,
+                                     self.user_cache).create_tg_handler())
+        dp.add_handler(ExportHandler(engine, self.config, self.logger,
+                                     self.user_cache).create_tg_handler())
+        # Каждый обработчик загружает записи своих пользователей
+        self.backfill = None
+        if config.time_entry_backfill_interval:
+            self.backfill = TimeEntryBackfill(engine, self.redmine_clients, config.redmine_host,
+                                              self.logger,
+                                              interval=config.time_entry_backfill_interval,
+                                              page_size=config.time_entry_backfill_page_size,
+                                              overlap_days=config.time_entry_backfill_overlap_days,
+                                              batch_size=config.time_entry_backfill_batch_size,
+                                              shard=(shard.index, shard.count) if shard else None)
+
+        self.issue_index = IssueIndex()
+        self.issue_sync = None
+        if config.redmine_sync_key:
+            self.issue_sync = IssueSync(engine, self.redmine_clients, config.redmine_host,
+                                        config.redmine_sync_key, self.issue_index, self.logger,
+                                        interval=config.issue_sync_interval,
+                                        page_size=config.issue_sync_page_size)
+        dp.add_handler(IssueSearchHandler(engine, self.config, self.logger, self.user_cache,
+                                          self.issue_index).create_tg_handler())
+
+        self.reminders = None
+        if config.reminder_time and primary:
+            self.reminders = ReminderScheduler(
+                engine, self.updater.bot, self.send_limiter, self.logger,
+                remind_at=dt.datetime.strptime(config.reminder_time, '%H:%M').time(),
+                utc_offset=config.reminder_utc_offset,
+                min_hours=config.reminder_min_hours,
+                interval=config.reminder_batch_interval,
+                batch_size=config.reminder_batch_size,
+                jitter=config.reminder_jitter)
 
         dp.add_handler(tg.CommandHandler('help', self.help))
         dp.add_error_handler(self.error)
+        # Записи лога помечаются обработчиком, в котором сделаны
+        instrument_dispatcher(dp, handler_context)
+
+        # Метрики в формате prometheus, если в настройках указан порт
+        self.metrics_server = None
+        if config.metrics_port:
+            instrument_dispatcher(dp)
+            instrument_engine(engine)
+            REGISTRY.gauge_callback('bot_update_queue', 'Очереди обновлений пользователей',
+                                    'metric', self.scheduler.metrics)
+            REGISTRY.gauge_callback('bot_telegram_sends', 'Ограничение исходящих сообщений',
+                                    'metric', self.send_limiter.metrics)
+            REGISTRY.gauge_callback('bot_user_cache', 'Кэш пользователей',
+                                    'metric', self.user_cache.metrics)
+            self.metrics_server = MetricsServer(config.metrics_listen, config.metrics_port)
 
     def error(self, bot: Bot, update: Update, error):
         """Log Errors caused by Updates."""
-        self.logger.warning('Update "%s" caused error "%s"', update, error)
+        # Обновление целиком не форматируется: контекст записи уже содержит его id и пользователя
+        self.logger.warning('Update %s caused error: %s', getattr(update, 'update_id', None), error,
+                            exc_info=error)
+
+    # Загружает назначенные пользователю задачи из redmine
+    def load_issues(self, key: str) -> Dict[int, str]:
+        if self.runtime is not None:
+            return self.load_issues_async(key).result()
+
+        redmine = self.redmine_clients.get(self.config.redmine_host, key,
+                                           read_timeout=self.config.redmine_interactive_timeout)
+        return {issue.id: issue.subject for issue in redmine.auth().issues}
+
+    def load_issues_async(self, key: str) -> Future:
+        return self.runtime.submit(self.async_redmine.assigned_issues(
+            key, timeout=self.config.redmine_interactive_timeout))
+
+    # Проверяет ключ в redmine: AuthError или RedmineRequestError - ключ неверный,
+    # RedmineUnavailable - redmine недоступен
+    def check_key(self, key: str, timeout: Optional[float] = None) -> None:
+        if self.runtime is not None:
+            self.runtime.call(self.async_redmine.auth(key, timeout=timeout))
+        else:
+            self.redmine_clients.get(self.config.redmine_host, key, read_timeout=timeout).auth()
+
+    def close_redmine(self):
+        if self.runtime is not None:
+            self.runtime.call(self.async_redmine.close())
+            self.runtime.stop()
+        self.redmine_clients.close()
+
+    def time_entry_synced(self, entry: TimeEntry):
+        # Уведомления о синхронизации не должны задерживать ответы пользователям
+        with self.send_limiter.priority(BULK):
+            self.track_handler.time_entry_synced(self.updater.bot, entry)
+
+    def flush_persistence(self, bot: Bot, job: tg.Job):
+        self.persistence.flush()
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def reload_issue_index(self, bot: Bot, job: tg.Job):
+        self.issue_sync.load_index()
+
+    def log_metrics(self, bot: Bot, job: tg.Job):
+        self.logger.info('Update queues: %s', self.scheduler.metrics())
+        self.logger.info('User cache: %s', self.user_cache.metrics())
+        self.logger.info('Telegram sends: %s', self.send_limiter.metrics())
+        self.logger.info('Redmine: %s', self.redmine_clients.breaker(self.config.redmine_host).metrics())
 
     def help(self, bot: Bot, update: Update):
         update.message.reply_text(m.HELP_MESSAGE)
 
+    # Передает в диспетчер обновления, которые раздает супервизор (см. sharding.py)
+    def feed_shard(self):
+        while True:
+            try:
+                data = self.shard.updates.get(timeout=1)
+            except Empty:
+                if os.getppid() != self.shard.parent_pid:
+                    self.logger.warning('Supervisor exited, stopping worker %s', self.shard.index)
+                    break
+                continue
+            if data is None:
+                break
+            self.updater.update_queue.put(Update.de_json(data, self.updater.bot))
+
+        # Диспетчер дорабатывает уже переданные обновления и останавливается
+        self.updater.stop()
+
     # Запускает бот
     def run(self):
-        self.updater.start_polling()
-        self.updater.idle()
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        self.submitter.start()
+        if self.issue_sync is not None:
+            self.issue_sync.load_index()
+            if self.shard is None or self.shard.primary:
+                self.issue_sync.start()
+            else:
+                # Задачи из redmine забирает первый обработчик, остальные перечитывают их из БД
+                self.updater.job_queue.run_repeating(self.reload_issue_index,
+                                                     interval=self.config.issue_sync_interval,
+                                                     first=self.config.issue_sync_interval)
+        if self.backfill is not None:
+            self.backfill.start()
+        if self.reminders is not None:
+            self.reminders.start()
+        self.setting_handler.start(self.updater.bot)
+
+        webhook = None
+        if self.shard is not None:
+            start_dispatcher(self.updater)
+            # Обработчик останавливает супервизор, а не сигналы
+            self.feed_shard()
+        else:
+            if self.config.webhook_url:
+                webhook = start_webhook(self.updater, self.config, self.logger)
+            else:
+                self.updater.start_polling()
+            self.updater.idle()
+
+        if webhook is not None:
+            webhook.stop()
+        # Диспетчер уже остановлен, поэтому сохраняются все обработанные обновления
+        self.persistence.flush()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.issue_sync is not None:
+            self.issue_sync.stop()
+        if self.backfill is not None:
+            self.backfill.stop()
+        if self.reminders is not None:
+            self.reminders.stop()
+        self.setting_handler.stop()
+        self.submitter.stop()
+        self.close_redmine()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+
+def start_logging(config: Config) -> LogPipeline:
+    log_pipeline = LogPipeline(config)
+    log_pipeline.start()
+    if config.metrics_port:
+        REGISTRY.gauge_callback('bot_logging', 'Очередь записей лога',
+                                'metric', log_pipeline.metrics)
+    return log_pipeline
+
+
+def run_shard(config: Config, shard: Shard) -> None:
+    # Обработчик запускается в новом процессе, где логирование еще не настроено
+    log_pipeline = start_logging(config)
+    try:
+        engine = db.create_engine_from_config(config)
+        BotTracking(config, engine, shard=shard).run()
+    finally:
+        log_pipeline.stop()
 
 
 if __name__ == '__main__':
     config = Config()
-
-    engine = create_engine(config.dsn_db, echo=True)
-    initialize_table(engine)
-
-    bot = BotTracking(config, engine)
-    bot.run()
+    log_pipeline = start_logging(config)
+
+    try:
+        engine = db.create_engine_from_config(config)
+        migrate(engine, logging.getLogger(__name__))
+
+        if config.worker_processes > 1:
+            # Каждый обработчик создает свои соединения с БД
+            engine.dispose()
+            ShardSupervisor(config, run_shard, logging.getLogger(__name__)).run()
+        else:
+            bot = BotTracking(config, engine)
+            bot.run()
+    finally:
+        log_pipeline.stop()
@@ -0,0 +1,112 @@
+import re
+from datetime import date
+from typing import List, NamedTuple, Optional
+
+from utility import date_from_today, round_hours
+
+HOURS_RE = re.compile(r'^(\d+(?:[.,]\d+)?)(?:h|ч)$', re.IGNORECASE)
+ISSUE_RE = re.compile(r'^#(\d+)$')
+OFFSET_RE = re.compile(r'^-(\d+)$')
+ISO_DATE_RE = re.compile(r'^\d{4}-\d{1,2}-\d{1,2}$')
+DATE_WORDS = {
+    'today': 0,
+    'сегодня': 0,
+    'yesterday': -1,
+    'вчера': -1,
+    'позавчера': -2,
+}
+# Похожи на дату, но трекать в будущее нельзя
+FUTURE_WORDS = {'tomorrow', 'завтра', 'послезавтра'}
+
+# Те же дни, что предлагаются кнопками в пошаговом /track
+TRACK_DAYS = range(0, -8, -1)
+MAX_HOURS = 24
+
+
+class TrackLine(NamedTuple):
+    line: int
+    spent_on: date
+    issue_id: int
+    hours: float
+    comments: Optional[str]
+
+
+class TrackParseError(ValueError):
+
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+
+def is_date(token: str) -> bool:
+    """Похоже ли слово на дату, даже если она недоступна для трекинга"""
+    token = token.lower()
+    return token in DATE_WORDS or token in FUTURE_WORDS or \
+        bool(OFFSET_RE.match(token) or ISO_DATE_RE.match(token))
+
+
+def parse_date(token: str) -> Optional[date]:
+    """Разбирает дату из строки, если она попадает в дни, доступные для трекинга"""
+    allowed = date_from_today(TRACK_DAYS)
+    token = token.lower()
+
+    if token in DATE_WORDS:
+        offset = DATE_WORDS[token]
+    elif OFFSET_RE.match(token):
+        offset = -int(token[1:])
+    elif ISO_DATE_RE.match(token):
+        try:
+            spent_on = date.fromisoformat(token)
+        except ValueError:
+            return None
+        return spent_on if spent_on in allowed else None
+    else:
+        return None
+
+    return allowed[-offset] if -offset < len(allowed) else None
+
+
+def parse_track_text(text: str) -> List[TrackLine]:
+    """
+    Разбирает одну или несколько строк вида "2.5h #1234 вчера комментарий".
+    Часы и задача обязательны, дата по умолчанию сегодня (недоступная дата - ошибка),
+    порядок первых слов не важен, все после них считается комментарием
+    """
+    lines = []
+    errors = []
+
+    for number, raw in enumerate(text.splitlines(), start=1):
+        tokens = raw.split()
+        if not tokens:
+            continue
+
+        hours = issue_id = spent_on = date_token = None
+        position = 0
+        for token in tokens:
+            if hours is None and HOURS_RE.match(token):
+                hours = round_hours(float(HOURS_RE.match(token).group(1).replace(',', '.')))
+            elif issue_id is None and ISSUE_RE.match(token):
+                issue_id = int(token[1:])
+            elif date_token is None and is_date(token):
+                # Недоступная дата - ошибка, а не начало комментария: иначе время
+                # молча записалось бы на сегодня
+                date_token = token
+                spent_on = parse_date(token)
+            else:
+                break
+            position += 1
+
+        comments = ' '.join(tokens[position:]) or None
+        if hours is None or not 0 < hours <= MAX_HOURS:
+            errors.append('{}: не указано время, например 1.5h (не больше {}h)'.format(number, MAX_HOURS))
+        elif issue_id is None:
+            errors.append('{}: не указана задача, например #1234'.format(number))
+        elif date_token is not None and spent_on is None:
+            errors.append('{}: нельзя затрекать на {}, только за сегодня и {} дней до него'.format(
+                number, date_token, len(TRACK_DAYS) - 1))
+        else:
+            lines.append(TrackLine(number, spent_on or date.today(), issue_id, hours, comments))
+
+    if errors:
+        raise TrackParseError(errors)
+    return lines
@@ -1,10 +1,39 @@
+import codecs
+import csv
+import io
 from datetime import date, timedelta
+from typing import BinaryIO, Iterable, List, Optional, Sequence, Tuple
 
 
 def date_from_today(range_):
     return [date.today() + timedelta(days=delta) for delta in range_]
 
 
+def period_from_args(args: List[str]) -> Optional[Tuple[date, date]]:
+    """
+    Период отчета по аргументам команды: week (по умолчанию), month,
+    одна дата (с нее по сегодня) или две даты в формате YYYY-MM-DD
+    """
+    today = date.today()
+    if not args or args[0] in ('week', 'неделя'):
+        return today - timedelta(days=today.weekday()), today
+    if args[0] in ('month', 'месяц'):
+        return today.replace(day=1), today
+
+    if args[0] in ('range', 'период'):
+        args = args[1:]
+    try:
+        dates = [date.fromisoformat(arg) for arg in args]
+    except ValueError:
+        return None
+
+    if len(dates) == 1:
+        dates.append(today)
+    if len(dates) != 2 or dates[0] > dates[1]:
+        return None
+    return dates[0], dates[1]
+
+
 def russian_date(date_: date):
     if date_ == date.today():
         return 'Сегодня'
@@ -15,12 +44,21 @@ def russian_date(date_: date):
     return '{} {} ({})'.format(date_.day, russian_month(date_), russian_weekday(date_))
 
 
+def is_weekend(date_):
+    return date_.weekday() >= 5
+
+
 def russian_weekday(date_):
     return ['ПН', 'ВТ', 'СР', 'ЧТ', 'ПТ', 'СБ', 'ВС'][date_.weekday()]
 
 
 def russian_month(date_):
-    return ['Янв', 'Фев', 'Март', 'Апр', 'Май', 'Июнь', 'Июль', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек'][date_.month]
+    return ['Янв', 'Фев', 'Март', 'Апр', 'Май', 'Июнь', 'Июль', 'Авг', 'Сен', 'Окт', 'Ноя', 'Дек'][date_.month - 1]
+
+
+def round_hours(hours: float) -> float:
+    """Часы с точностью redmine, который хранит и возвращает их с двумя знаками"""
+    return round(hours, 2)
 
 
 def build_menu(buttons,
@@ -33,3 +71,25 @@ def build_menu(buttons,
     if footer_buttons:
         menu.append(footer_buttons)
     return menu
+
+
+def write_csv(file: BinaryIO, header: Sequence[str], rows: Iterable[Sequence],
+              flush_rows: int = 1000) -> int:
+    """
+    Пишет CSV в бинарный файл по flush_rows строк, возвращает число строк без заголовка.
+    BOM нужен, чтобы Excel открыл кириллицу в UTF-8
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    file.write(codecs.BOM_UTF8)
+    writer.writerow(header)
+
+    count = 0
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % flush_rows == 0:
+            file.write(buffer.getvalue().encode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+    file.write(buffer.getvalue().encode('utf-8'))
+    return count
@@ -0,0 +1,117 @@
+import json
+import logging
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from typing import Optional
+from urllib.parse import urlparse
+
+import telegram.ext as tg
+from telegram import Bot, Update
+
+from scheduler import start_dispatcher
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    server = None  # type: WebhookServer
+
+    def do_POST(self):
+        if self.path != self.server.url_path:
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            # Пустое или не объект тело de_json превратил бы в None, а не в ошибку
+            if not data or not isinstance(data, dict):
+                raise ValueError('update must be a JSON object')
+            update = Update.de_json(data, self.server.bot)
+        except (ValueError, TypeError, KeyError):
+            self.send_error(400)
+            return
+
+        self.server.update_queue.put(update)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.logger.debug('Webhook %s - %s', self.address_string(), format % args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Прием обновлений от telegram через вебхук. Каждое обновление сразу кладется
+    в очередь диспетчера, а число одновременно обрабатываемых соединений
+    ограничено max_connections
+    """
+
+    daemon_threads = True
+
+    def __init__(self, bot: Bot, update_queue: Queue, listen: str, port: int,
+                 url_path: str, logger: logging.Logger, cert: Optional[str] = None,
+                 key: Optional[str] = None, max_connections: int = 40) -> None:
+        super().__init__((listen, port), _WebhookRequestHandler)
+        self.bot = bot
+        self.update_queue = update_queue
+        self.url_path = url_path
+        self.logger = logger
+        self._connections = threading.BoundedSemaphore(max_connections)
+        self._thread = None  # type: Optional[threading.Thread]
+
+        if cert is not None and key is not None:
+            ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_ctx.load_cert_chain(cert, key)
+            self.socket = ssl_ctx.wrap_socket(self.socket, server_side=True)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, name='webhook',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def process_request(self, request, client_address):
+        self._connections.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connections.release()
+
+
+def start_webhook(updater: tg.Updater, config, logger: logging.Logger) -> WebhookServer:
+    """Принимает обновления через собственный сервер и регистрирует вебхук в telegram"""
+    server = WebhookServer(updater.bot, updater.update_queue,
+                           listen=config.webhook_listen,
+                           port=config.webhook_port,
+                           url_path=urlparse(config.webhook_url).path or '/',
+                           logger=logger,
+                           cert=config.webhook_cert,
+                           key=config.webhook_key,
+                           max_connections=config.webhook_max_connections)
+    server.start()
+    start_dispatcher(updater)
+
+    certificate = open(config.webhook_cert, 'rb') if config.webhook_cert else None
+    try:
+        updater.bot.set_webhook(url=config.webhook_url,
+                                certificate=certificate,
+                                max_connections=config.webhook_max_connections)
+    finally:
+        if certificate is not None:
+            certificate.close()
+    return server